@@ -1,12 +1,29 @@
-from flask import Flask, render_template, request, jsonify, session
-from functools import wraps
+from flask import Flask, render_template, request, jsonify, session, Response
 import config
 import logging
-from datetime import datetime
+import game
+import ledger
+import metrics
+import page_cache
+import payment_events
+import payment_store
+import phones
+import providers
+import rate_limit
+import payouts
+import static_assets
+import payment_expiry
+from payment_store import PENDING, CONFIRMED, CONFIRMABLE, REJECTED, EXPIRED
+from datetime import datetime, timedelta
 import secrets
 import os
+import time
 
 app = Flask(__name__)
+# Route latency histograms and /metrics for Prometheus
+metrics.instrument_app(app)
+# Fingerprinted, precompressed CSS/JS from assets/ (asset_url in templates)
+static_assets.init_app(app)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000  # Cache static files for 1 year
 
@@ -14,34 +31,33 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000  # Cache static files for 1 y
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Caching decorator
-def cache_response(seconds=300):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            response = f(*args, **kwargs)
-            if isinstance(response, tuple):
-                response, status = response, 200
-            else:
-                status = 200
-            # Add cache headers
-            from flask import make_response
-            resp = make_response(response, status)
-            resp.headers['Cache-Control'] = f'public, max-age={seconds}'
-            return resp
-        return decorated_function
-    return decorator
-
-# In-memory storage (use database in production)
-pending_payments = {}  # {payment_id: {phone, amount, timestamp, status}}
-confirmed_payments = {}  # {payment_id: {phone, amount, confirmed_at}}
+# Rendered pages with ETag/304 and pre-compressed bodies
+pages = page_cache.create_cache()
+
+# Shared payment store (SQLite by default so every gunicorn worker sees it)
+store = payment_store.get_store()
+
+# Wakes long-polls and SSE streams when a payment changes
+feed = payment_events.ChangeFeed(store)
+
+# Token buckets per phone / IP / globally, checked before /pay does any work
+pay_limiter = rate_limit.create_pay_limiter()
+
+# Winners are paid in the background in batched B2C requests
+payout_engine = payouts.create_engine(store)
+# Resume payouts left queued by a previous process without waiting for a new winner
+app.before_request(payout_engine.start)
+
+# Unconfirmed payments expire; old finished ones move to the archive ledger
+expiry = payment_expiry.create_service(store)
+app.before_request(expiry.start)
 
 
 @app.route('/')
 def index():
-    return render_template('payment_page.html', 
-                         entry_fee=config.ENTRY_FEE,
-                         payment_number=config.PAYMENT_NUMBER)
+    return pages.render('payment_page.html',
+                        entry_fee=config.ENTRY_FEE,
+                        payment_number=config.PAYMENT_NUMBER)
 
 
 @app.route('/pay', methods=['POST'])
@@ -53,27 +69,52 @@ def pay():
                              success=False, 
                              message="Phone number is required")
     
-    # Generate unique payment ID
-    payment_id = f"PAY{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(3).upper()}"
+    phone = phones.try_normalize(phone)
+    if not phone:
+        return render_template('result.html',
+                             success=False,
+                             message="Enter a valid Kenyan mobile number, e.g. 0712 345 678")
     
-    # Store pending payment
-    pending_payments[payment_id] = {
-        'phone': phone,
-        'amount': config.ENTRY_FEE,
-        'timestamp': datetime.now().isoformat(),
-        'status': 'pending'
-    }
+    # A repeat submit (double tap, reload) from the session that opened the
+    # payment gets it back; it does not count against the rate limit
+    since = time.time() - config.PAY_IDEMPOTENCY_WINDOW
+    payment = store.find_open(phone, since)
+    if payment is None or payment['payment_id'] != session.get('payment_id'):
+        admission = pay_limiter.check(phone=phone, ip=rate_limit.client_ip(request))
+        if not admission.allowed:
+            return _too_many_requests(admission)
+        
+        # Generate unique payment ID
+        payment_id = f"PAY{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(3).upper()}"
+        
+        # Store pending payment, unless one is already open for this phone
+        payment, created = store.create_unless_open(payment_id, phone, config.ENTRY_FEE, since)
+        if not created and payment['payment_id'] != session.get('payment_id'):
+            # opened from another browser: never hand out someone else's payment
+            return render_template('result.html',
+                                 success=False,
+                                 message="A payment for this number is already in progress. "
+                                         "Please finish it on the device that started it, or try again in a few minutes."), 409
+        if created:
+            logging.info(f"New payment created: {payment_id} for {phone}")
+    payment_id = payment['payment_id']
     
     # Save to session for user to check status
     session['payment_id'] = payment_id
     
-    logging.info(f"New payment created: {payment_id} for {phone}")
-    
+    # Per-payment page: rendered each time, never kept in the page cache
     return render_template('payment_instructions.html',
-                         payment_id=payment_id,
-                         amount=config.ENTRY_FEE,
-                         payment_number=config.PAYMENT_NUMBER,
-                         phone=phone)
+                           payment_id=payment_id,
+                           amount=config.ENTRY_FEE,
+                           payment_number=config.PAYMENT_NUMBER,
+                           phone=phone)
+
+
+def _too_many_requests(admission):
+    retry_after = max(1, int(admission.retry_after + 0.999))
+    resp = Response(f"Too many payment attempts, try again in {retry_after}s\n", status=429, mimetype='text/plain')
+    resp.headers['Retry-After'] = str(retry_after)
+    return resp
 
 
 @app.route('/check-status')
@@ -85,39 +126,179 @@ def check_status():
                              success=False,
                              message="No payment found. Please start a new payment.")
     
+    payment = store.get(payment_id)
+    
     # Check if payment is confirmed
-    if payment_id in confirmed_payments:
+    if payment and payment['status'] == CONFIRMED:
+        if payment.get('prize') is not None:
+            return render_template('result.html',
+                                 success=False,
+                                 message=f"Payment {payment_id} has already been played. Prize: KES {payment['prize']}")
+        # Deal the box layout once, server-side; the browser never sees it
+        if payment.get('boxes') is None:
+            store.update_if(payment_id, {'status': CONFIRMED, 'boxes': None},
+                            boxes=game.deal_boxes())
         return render_template('box_game.html',
-                             payment_id=payment_id,
-                             phone=confirmed_payments[payment_id]['phone'])
+                               payment_id=payment_id,
+                               phone=payment['phone'])
     
     # Check if payment is still pending
-    if payment_id in pending_payments:
+    if payment and payment['status'] == PENDING:
         return render_template('result.html',
                              success=False,
                              message=f"Payment {payment_id} is still pending verification. Please wait for confirmation or contact admin.")
     
+    if payment and payment['status'] == EXPIRED:
+        return render_template('result.html',
+                             success=False,
+                             message=f"Payment {payment_id} expired before it was confirmed. If you already paid, "
+                                     f"contact admin with this reference; otherwise please start a new payment.")
+    
     return render_template('result.html',
                          success=False,
                          message="Payment not found.")
 
 
+@app.route('/events/payment/<payment_id>')
+def payment_status_poll(payment_id):
+    """Long-poll: answers as soon as the payment changes after ?since=<seq>"""
+    if session.get('payment_id') != payment_id:
+        return jsonify({'success': False, 'message': 'Payment not found'}), 404
+    
+    since = request.args.get('since', 0, type=int)
+    timeout = request.args.get('timeout', 20, type=float)
+    changes = feed.wait(since, timeout, payment_id=payment_id)
+    if not changes:
+        return jsonify({'success': True, 'changed': False, 'seq': since})
+    return jsonify({'success': True, 'changed': True, **payment_events.public_status(changes[-1])})
+
+
+@app.route('/events/payment/<payment_id>/stream')
+def payment_status_stream(payment_id):
+    """Server-sent events for one payment, closed once it settles"""
+    if session.get('payment_id') != payment_id:
+        return jsonify({'success': False, 'message': 'Payment not found'}), 404
+    
+    since = request.headers.get('Last-Event-ID', request.args.get('since', 0), type=int)
+    return Response(feed.stream(payment_id, since),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/admin')
 def admin():
+    # Only the shell and counters are rendered; rows are fetched page by page
     return render_template('admin_dashboard.html',
-                         pending=pending_payments,
-                         confirmed=confirmed_payments,
-                         payment_number=config.PAYMENT_NUMBER)
+                         totals=store.totals(),
+                         payment_number=config.PAYMENT_NUMBER,
+                         seq=store.latest_seq())
+
+
+def _parse_day(value, end=False):
+    """'YYYY-MM-DD' -> epoch seconds at the start (or end) of that day"""
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d')
+    if end:
+        day += timedelta(days=1)
+    return day.timestamp()
+
+
+def _admin_row(p):
+    return {
+        'payment_id': p['payment_id'],
+        'phone': p['phone'],
+        'amount': p['amount'],
+        'status': p['status'],
+        'timestamp': p['timestamp'],
+        'confirmed_at': p.get('confirmed_at'),
+        'prize': p.get('prize'),
+    }
+
+
+@app.route('/admin/api/payments')
+def admin_api_payments():
+    """Cursor-paginated payments, newest first.
+    
+    Filters: ?status=PENDING&phone=...&from=YYYY-MM-DD&to=YYYY-MM-DD&limit=50&cursor=...
+    """
+    try:
+        page, next_cursor = store.query(
+            status=request.args.get('status') or None,
+            phone=request.args.get('phone') or None,
+            since=_parse_day(request.args.get('from')),
+            until=_parse_day(request.args.get('to'), end=True),
+            cursor=request.args.get('cursor') or None,
+            limit=min(request.args.get('limit', 50, type=int), 200),
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'payments': [_admin_row(p) for p in page],
+        'next_cursor': next_cursor,
+    })
+
+
+@app.route('/admin/api/stats')
+def admin_api_stats():
+    """Precomputed aggregates (no table scan)"""
+    return jsonify({'success': True, **store.totals()})
+
+
+@app.route('/admin/api/ratelimit')
+def admin_api_ratelimit():
+    """/pay admission counters for this worker"""
+    return jsonify({'success': True, **pay_limiter.stats()})
+
+
+@app.route('/admin/api/payouts')
+def admin_api_payouts():
+    """Payout pipeline throughput and queue depth for this worker, and payouts to resolve by hand"""
+    return jsonify({'success': True, **payout_engine.stats(),
+                    'needs_attention': payout_engine.needs_attention()})
+
+
+@app.route('/admin/api/page-cache')
+def admin_api_page_cache():
+    """Rendered page cache hit ratios for this worker"""
+    return jsonify({'success': True, **pages.stats()})
+
+
+@app.route('/admin/api/expiry')
+def admin_api_expiry():
+    """Expiry heap size and expired / archived counts for this worker"""
+    return jsonify({'success': True, **expiry.stats()})
+
+
+@app.route('/admin/api/providers')
+def admin_api_providers():
+    """Provider clients (Twilio, Daraja) built so far by this worker"""
+    return jsonify({'success': True, 'providers': providers.stats()})
+
+
+@app.route('/admin/changes')
+def admin_changes():
+    """Delta feed for the dashboard: payments created or changed after ?since=<seq>"""
+    since = request.args.get('since', 0, type=int)
+    timeout = request.args.get('timeout', 20, type=float)
+    changes = feed.wait(since, timeout)
+    return jsonify({
+        'success': True,
+        'seq': changes[-1]['seq'] if changes else since,
+        'changes': [_admin_row(p) for p in changes]
+    })
 
 
 @app.route('/admin/confirm/<payment_id>', methods=['POST'])
 def confirm_payment(payment_id):
-    if payment_id in pending_payments:
-        payment = pending_payments.pop(payment_id)
-        payment['confirmed_at'] = datetime.now().isoformat()
-        confirmed_payments[payment_id] = payment
-        
+    # payments past their TTL can still be confirmed once the money is found
+    payment = store.transition(payment_id, CONFIRMED, from_statuses=CONFIRMABLE,
+                               confirmed_at=datetime.now().isoformat())
+    if payment:
         logging.info(f"✅ Payment {payment_id} confirmed for {payment['phone']}")
+        audit.append('payment_confirmed', payment_id=payment_id, phone=payment['phone'], amount=payment['amount'])
         
         return jsonify({
             'success': True,
@@ -132,10 +313,11 @@ def confirm_payment(payment_id):
 
 @app.route('/admin/reject/<payment_id>', methods=['POST'])
 def reject_payment(payment_id):
-    if payment_id in pending_payments:
-        payment = pending_payments.pop(payment_id)
-        
+    payment = store.transition(payment_id, REJECTED,
+                               rejected_at=datetime.now().isoformat())
+    if payment:
         logging.info(f"❌ Payment {payment_id} rejected for {payment['phone']}")
+        audit.append('payment_rejected', payment_id=payment_id, phone=payment['phone'], amount=payment['amount'])
         
         return jsonify({
             'success': True,
@@ -148,23 +330,117 @@ def reject_payment(payment_id):
     }), 404
 
 
+@app.route('/admin/payouts/<payment_id>/approve', methods=['POST'])
+def approve_payout(payment_id):
+    """Release a prize above PAYOUT_AUTO_APPROVE_MAX to the payout queue"""
+    payment = payout_engine.approve(payment_id)
+    if payment:
+        logging.info(f"💸 Payout for {payment_id} approved: KES {payment['payout_amount']} to {payment['phone']}")
+        audit.append('payout_approved', payment_id=payment_id, phone=payment['phone'], amount=payment['payout_amount'])
+        return jsonify({
+            'success': True,
+            'message': f'Payout for {payment_id} approved'
+        })
+
+    return jsonify({
+        'success': False,
+        'message': 'No payout awaiting approval'
+    }), 404
+
+
+# Bulk actions: action -> (new status, allowed from, timestamp field, audit event)
+BULK_ACTIONS = {
+    'confirm': (CONFIRMED, CONFIRMABLE, 'confirmed_at', 'payment_confirmed'),
+    'reject': (REJECTED, (PENDING,), 'rejected_at', 'payment_rejected'),
+}
+BULK_MAX = 500
+
+# Admin actions are recorded in ledger/audit.jsonl
+audit = ledger.get_ledger('audit')
+
+
+@app.route('/admin/bulk', methods=['POST'])
+def bulk_update():
+    """Confirm or reject many pending payments in one transaction.
+    
+    JSON body: {"action": "confirm"|"reject", "payment_ids": [...]}
+    or {"action": ..., "filter": {"phone": ..., "from": ..., "to": ...}} to
+    act on up to BULK_MAX pending payments matching the filter.
+    """
+    data = request.get_json(silent=True) or {}
+    action = BULK_ACTIONS.get(data.get('action'))
+    if not action:
+        return jsonify({'success': False, 'message': 'action must be confirm or reject'}), 400
+    to_status, from_statuses, stamp_field, event = action
+    
+    payment_ids = data.get('payment_ids')
+    if payment_ids is None and isinstance(data.get('filter'), dict):
+        flt = data['filter']
+        try:
+            page, _ = store.query(status=PENDING,
+                                  phone=flt.get('phone') or None,
+                                  since=_parse_day(flt.get('from')),
+                                  until=_parse_day(flt.get('to'), end=True),
+                                  limit=BULK_MAX)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        payment_ids = [p['payment_id'] for p in page]
+    if not isinstance(payment_ids, list) or len(payment_ids) > BULK_MAX:
+        return jsonify({'success': False, 'message': f'payment_ids must be a list of at most {BULK_MAX} ids'}), 400
+    
+    now = datetime.now()
+    results = store.transition_many([str(i) for i in payment_ids], to_status, from_statuses=from_statuses,
+                                    **{stamp_field: now.isoformat()})
+    audit.append_many([{'ts': now.isoformat(), 'event': event, 'pid': os.getpid(), 'bulk': True,
+                        'payment_id': pid, 'phone': p['phone'], 'amount': p['amount']}
+                       for pid, p in results.items() if p])
+    
+    applied = sum(1 for p in results.values() if p)
+    logging.info(f"Bulk {data['action']}: {applied}/{len(results)} payments updated")
+    return jsonify({
+        'success': True,
+        'updated': applied,
+        'results': {pid: ('ok' if p else 'not_pending') for pid, p in results.items()},
+    })
+
+
 @app.route('/game-result', methods=['POST'])
 def game_result():
-    data = request.get_json()
+    """Resolve the player's box pick against the layout dealt at unlock"""
+    data = request.get_json(silent=True) or {}
     payment_id = data.get('payment_id')
-    prize = data.get('prize')
+    box_number = data.get('box_number')
     
-    if payment_id and prize:
-        # Log the game result
-        logging.info(f"🎮 Game result for {payment_id}: Prize KES {prize}")
-        
-        # Store in confirmed_payments for record-keeping
-        if payment_id in confirmed_payments:
-            confirmed_payments[payment_id]['prize'] = prize
-        
-        return jsonify({'success': True, 'message': 'Result logged'})
+    if not payment_id or box_number is None:
+        return jsonify({'success': False, 'message': 'Invalid data'}), 400
+    
+    # Only the session that paid may play (same answer as a missing game)
+    if session.get('payment_id') != payment_id:
+        return jsonify({'success': False, 'message': 'No game available for this payment'}), 404
+    
+    payment = store.get(payment_id)
+    if not payment or payment['status'] != CONFIRMED or payment.get('boxes') is None:
+        return jsonify({'success': False, 'message': 'No game available for this payment'}), 404
+    
+    try:
+        box_number = game.parse_box(payment['boxes'], box_number)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    prize = game.reveal(payment['boxes'], box_number)
+    
+    # Only the first pick counts; the compare-and-set rejects replays
+    played = store.update_if(payment_id, {'status': CONFIRMED, 'prize': None},
+                             prize=prize, box_number=box_number,
+                             played_at=datetime.now().isoformat())
+    if not played:
+        payment = store.get(payment_id)
+        return jsonify({'success': False, 'message': 'Game already played',
+                        'prize': payment.get('prize'), 'boxes': payment['boxes']}), 409
     
-    return jsonify({'success': False, 'message': 'Invalid data'}), 400
+    logging.info(f"🎮 Game result for {payment_id}: box {box_number}, prize KES {prize}")
+    if prize:
+        payout_engine.submit(payment_id)
+    return jsonify({'success': True, 'prize': prize, 'boxes': payment['boxes']})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+"""Async serving mode: STK Push and payment callbacks on an event loop.
+
+In the sync apps every request waiting on Daraja or Flutterwave holds a
+gunicorn thread (and app_auto's dispatch queue a worker thread), so a slow
+provider caps a worker at ``--threads`` payments in progress. Here the
+upstream-bound routes run as coroutines under an ASGI server and the
+provider calls go through ``http_client.AsyncHTTPClient``; a request
+waiting on Daraja costs a socket and a few KB instead of a thread:
+
+- ``POST /pay`` records the payment and starts the STK push (or, while
+  Daraja is unhealthy, a Flutterwave checkout; see payment_router.py) as a
+  task, at most ``ASYNC_MAX_IN_FLIGHT`` per worker
+- ``POST /callback/<CALLBACK_TOKEN>`` applies Daraja's STK callback
+- ``GET /payment/callback`` verifies a Flutterwave redirect with
+  ``reconciler.verify_async``
+
+Store, rate-limit and callback bookkeeping are synchronous SQLite, and a
+write waiting on another worker's lock can block for seconds (the busy
+timeout), so the handlers run them with ``asyncio.to_thread`` rather than
+on the loop. The sync apps are unchanged. Needs ``pip install -r
+requirements-async.txt``; run with::
+
+    hypercorn --workers 2 --bind 0.0.0.0:5000 app_async:app
+"""
+import asyncio
+import logging
+import os
+import secrets
+import time
+from datetime import datetime
+
+from quart import Quart, jsonify, render_template, request, session
+
+import config
+import http_client
+import metrics
+import payment_expiry
+import payment_router
+import payment_store
+import phones
+import providers
+import rate_limit
+import reconcile
+import static_assets
+import stk_dispatch
+from mpesa_callbacks import CallbackProcessor, token_matches
+from payment_store import QUEUED, CONFIRMED, FAILED
+
+app = Quart(__name__)
+# Route latency histograms and /metrics for Prometheus
+metrics.instrument_app(app)
+# Fingerprinted, precompressed CSS/JS from assets/ (asset_url in templates)
+static_assets.init_app(app)
+app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+logging.basicConfig(level=logging.INFO)
+
+ENTRY_FEE = config.ENTRY_FEE
+PAY_IDEMPOTENCY_WINDOW = config.PAY_IDEMPOTENCY_WINDOW
+
+# Shared payment store (SQLite by default so every worker sees it)
+store = payment_store.get_store()
+
+# Unconfirmed payments expire; old finished ones move to the archive ledger
+expiry = payment_expiry.create_service(store)
+
+# Per phone / IP / global token buckets: each accepted /pay costs an STK push
+pay_limiter = rate_limit.create_pay_limiter()
+
+# Daraja results are applied on the loop; follow-ups run on a thread queue
+callbacks = CallbackProcessor(store, followups=stk_dispatch.create_dispatcher('followups'))
+
+# Pending pushes whose callback never arrives are settled by STK Query
+reconciler = reconcile.create_reconciler(store)
+# A callback whose amount or phone does not match is checked with Daraja instead
+callbacks.on_mismatch(lambda payment_id, checkout_id: reconciler.verify('daraja', checkout_id))
+
+# New payments go to the healthiest of Daraja / Flutterwave, with failover
+router = payment_router.create_router()
+
+# STK pushes waiting on Daraja in this worker
+_pushes = set()
+metrics.gauge_callback("stk_async_in_flight", "STK pushes in flight on the event loop", lambda: len(_pushes))
+
+
+@callbacks.on_settled
+@reconciler.on_settled
+def log_settled_payment(payment):
+    logging.info(f"Payment {payment['payment_id']} for {payment['phone']} is {payment['status']}")
+
+
+@app.before_serving
+async def start_services():
+    expiry.start()
+    reconciler.start()
+
+
+@app.after_serving
+async def stop_services():
+    if _pushes:
+        await asyncio.wait(list(_pushes), timeout=10)
+    await http_client.aclose()
+
+
+@app.route('/')
+async def index():
+    return await render_template('stk_push.html', entry_fee=ENTRY_FEE)
+
+
+@app.route('/pay', methods=['POST'])
+async def pay():
+    form = await request.form
+    phone = form.get('phone')
+
+    if not phone:
+        return await render_template('result.html', message='❌ Phone number required')
+
+    phone = phones.try_normalize(phone)
+    if not phone:
+        return await render_template('result.html', message='❌ Enter a valid Kenyan mobile number')
+
+    # While a prompt for this phone is queued or pending, resubmits from the
+    # session that started it join it
+    since = time.time() - PAY_IDEMPOTENCY_WINDOW
+    payment = await asyncio.to_thread(store.find_open, phone, since)
+    if payment is not None and payment['payment_id'] == session.get('payment_id'):
+        return await _pay_page(payment)
+
+    admission = await asyncio.to_thread(pay_limiter.check, phone=phone, ip=rate_limit.client_ip(request))
+    if not admission.allowed:
+        retry_after = max(1, int(admission.retry_after + 0.999))
+        return await render_template('result.html',
+                                     message=f"⏳ Too many payment attempts. Please try again in {retry_after} seconds."), \
+            429, {'Retry-After': str(retry_after)}
+
+    reference = f"STK{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(3).upper()}"
+    payment, created = await asyncio.to_thread(store.create_unless_open, reference, phone, ENTRY_FEE, since,
+                                               status=QUEUED)
+    if not created:
+        return await _join_page(payment)
+    session['payment_id'] = reference
+    if len(_pushes) >= config.ASYNC_MAX_IN_FLIGHT:
+        await asyncio.to_thread(store.transition, reference, FAILED, from_statuses=(QUEUED,), message='Server busy')
+        return await render_template('result.html',
+                                     message="❌ We're handling a lot of payments right now. Please try again in a moment."), 503
+
+    # Answer straight away; the page polls /pay/status for the outcome
+    task = asyncio.create_task(send_stk_push(reference, phone, ENTRY_FEE))
+    _pushes.add(task)
+    task.add_done_callback(_pushes.discard)
+    return await _pay_page(payment)
+
+
+async def _join_page(payment):
+    """A payment is already open for this phone: rejoin it only from the session that started it"""
+    if payment['payment_id'] == session.get('payment_id'):
+        return await _pay_page(payment)
+    return await render_template('result.html',
+                                 message="⏳ A payment for this number is already in progress. "
+                                         "Check your phone, or try again in a few minutes."), 409
+
+
+async def _pay_page(payment):
+    reference = payment['payment_id']
+    return await render_template('result.html',
+                                 message=f"⏳ Sending M-Pesa prompt to {payment['phone']}... Reference: {reference}",
+                                 status_url=f"/pay/status/{reference}")
+
+
+async def send_stk_push(reference, phone, amount):
+    """Background task: start the payment (STK Push, or Flutterwave when Daraja is unhealthy) and record the outcome"""
+    loop = asyncio.get_running_loop()
+    outcome = await router.aroute(
+        reference, phone, amount,
+        on_late=lambda late: loop.run_in_executor(None, payment_router.record_late, store, reference, late))
+    await asyncio.to_thread(payment_router.record_outcome, store, reference, outcome)
+
+
+@app.route('/pay/status/<reference>')
+async def pay_status(reference):
+    """Poll the outcome of a queued STK Push"""
+    payment = await asyncio.to_thread(store.get, reference)
+    if not payment:
+        return jsonify({'success': False, 'message': 'Payment not found'}), 404
+    return jsonify({
+        'success': True,
+        'reference': reference,
+        'status': payment['status'],
+        'checkout_id': payment.get('checkout_id'),
+        'provider': payment.get('provider'),
+        'payment_link': payment.get('payment_link'),
+        'message': payment.get('message'),
+    })
+
+
+@app.route('/callback', methods=['POST'])
+@app.route('/callback/<token>', methods=['POST'])
+async def callback(token=None):
+    """Receive M-Pesa STK callback and settle the payment"""
+    if not token_matches(token, config.CALLBACK_TOKEN):
+        logging.warning(f"Refused STK callback from {request.remote_addr}: bad or missing token")
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Rejected'}), 403
+    data = await request.get_json(force=True, silent=True)
+    outcome = await asyncio.to_thread(callbacks.handle, data)
+    logging.info(f"Callback processed: {outcome}")
+    return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+
+@app.route('/payment/callback')
+async def payment_callback():
+    """Flutterwave redirects here after payment."""
+    status = request.args.get('status')
+    tx_ref = request.args.get('tx_ref')
+
+    if status == 'successful' and tx_ref:
+        # Verify the payment (confirms it in the store when successful)
+        verdict = await reconciler.verify_async('flutterwave', tx_ref)
+        if verdict.status == CONFIRMED:
+            return await render_template('result.html', message=f'✅ Payment successful! Reference: {tx_ref}')
+        return await render_template('result.html', message='⚠️ Payment verification failed')
+    return await render_template('result.html', message='❌ Payment cancelled or failed')
+
+
+@app.route('/admin/api/upstream')
+async def admin_api_upstream():
+    """Event-loop HTTP pools, STK pushes in flight and reconcile counters for this worker"""
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'stk_in_flight': len(_pushes),
+        'pools': http_client.async_client.pool_stats(),
+        'providers': providers.stats(),
+        'reconcile': reconciler.stats(),
+        'routing': router.stats(),
+    })
+
+
+if __name__ == '__main__':
+    app.run(port=5000)
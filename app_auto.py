@@ -1,38 +1,81 @@
 """Automatic M-Pesa STK Push - User gets PIN prompt on their phone!"""
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, session
 import logging
-from datetime import datetime
-import requests
+import metrics
+import page_cache
+import payment_router
+from datetime import datetime, timedelta
+import http_client
 import base64
 import os
+import queue
+import secrets
+import time
+import payment_store
+import payment_expiry
+import phones
+import providers
+import rate_limit
+import reconcile
+import static_assets
+import stk_dispatch
+from mpesa_callbacks import CallbackProcessor, callback_url, token_matches
+from mpesa_token import TokenManager, daraja_fetcher
+from payment_store import QUEUED, CONFIRMED, FAILED
 
 app = Flask(__name__)
+# Route latency histograms and /metrics for Prometheus
+metrics.instrument_app(app)
+# Fingerprinted, precompressed CSS/JS from assets/ (asset_url in templates)
+static_assets.init_app(app)
+app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 logging.basicConfig(level=logging.INFO)
 
 # Configuration
 ENTRY_FEE = 50
+PAY_IDEMPOTENCY_WINDOW = float(os.getenv('PAY_IDEMPOTENCY_WINDOW', '120'))  # seconds
 
 # Daraja API credentials (using sandbox)
 CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY', '0NAF8Gv2pDLdkzwdHn9y7IyZYXKjAq5fmIuTK23DpKQBe2A5')
 CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET', 'J4uschSQH7lv8IEdEiPDf4l5dnCAhRXtjAMS01b6uC1GcssfCjQFDf8h9Z9A1B0B')
 SHORTCODE = '174379'  # Sandbox shortcode
 PASSKEY = 'bfb279f9aa9bdbcf158e97dd71a5a2c09b3dcb6c2f6ceda15e3b8b8e38c8d9e1'  # Sandbox passkey
-CALLBACK_URL = 'https://yourdomain.com/callback'  # Not needed for sandbox testing
+CALLBACK_URL = os.getenv('CALLBACK_URL', 'https://yourdomain.com/callback')  # Not needed for sandbox testing
+CALLBACK_TOKEN = os.getenv('CALLBACK_TOKEN')  # secret path segment; callbacks are refused without it
+DARAJA_BASE = os.getenv('MPESA_BASE_URL', "https://sandbox.safaricom.co.ke").rstrip('/')
 
-# Store payments
-payments = {}
+# Cached OAuth token, shared by all threads of this worker (built on first use)
+token_manager = providers.register(
+    'daraja.app_auto', lambda: TokenManager(daraja_fetcher(DARAJA_BASE, CONSUMER_KEY, CONSUMER_SECRET)))
+
+# Rendered pages with ETag/304 and pre-compressed bodies
+pages = page_cache.create_cache()
+
+# Shared payment store (SQLite by default so every gunicorn worker sees it)
+store = payment_store.get_store()
+
+# Unconfirmed payments expire; old finished ones move to the archive ledger
+expiry = payment_expiry.create_service(store)
+app.before_request(expiry.start)
+
+# STK pushes run in the background so /pay returns immediately
+dispatcher = stk_dispatch.create_dispatcher()
+
+# Per phone / IP / global token buckets: each accepted /pay costs an STK push
+pay_limiter = rate_limit.create_pay_limiter()
+
+# Daraja results are applied on the request thread; follow-ups run in the background
+callbacks = CallbackProcessor(store, followups=stk_dispatch.create_dispatcher('followups'))
+
+
+@callbacks.on_settled
+def log_settled_payment(payment):
+    logging.info(f"Payment {payment['payment_id']} for {payment['phone']} is {payment['status']}")
 
 
 def get_access_token():
-    """Get Daraja API access token"""
-    url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-    try:
-        r = requests.get(url, auth=(CONSUMER_KEY, CONSUMER_SECRET), timeout=10)
-        r.raise_for_status()
-        return r.json().get('access_token')
-    except Exception as e:
-        logging.error(f"Token error: {e}")
-        return None
+    """Get Daraja API access token (cached until shortly before expiry)"""
+    return token_manager().get()
 
 
 def send_stk_push(phone, amount):
@@ -41,10 +84,11 @@ def send_stk_push(phone, amount):
     if not token:
         return {'success': False, 'message': 'Failed to connect to M-Pesa'}
     
+    phone = phones.msisdn(phone)
     timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
     password = base64.b64encode(f"{SHORTCODE}{PASSKEY}{timestamp}".encode()).decode()
     
-    url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
+    url = f"{DARAJA_BASE}/mpesa/stkpush/v1/processrequest"
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
@@ -58,15 +102,17 @@ def send_stk_push(phone, amount):
         "PartyA": phone,
         "PartyB": SHORTCODE,
         "PhoneNumber": phone,
-        "CallBackURL": CALLBACK_URL,
+        "CallBackURL": callback_url(CALLBACK_URL, CALLBACK_TOKEN),
         "AccountReference": "OddsMtaani",
         "TransactionDesc": f"Payment for OddsMtaani - KES {amount}"
     }
     
     try:
         logging.info(f"Sending STK Push to {phone}")
-        r = requests.post(url, json=payload, headers=headers, timeout=15)
+        r = http_client.post(url, endpoint="daraja.stkpush", json=payload, headers=headers)
         logging.info(f"Response: {r.status_code} - {r.text}")
+        if r.status_code == 401:
+            token_manager().invalidate()
         r.raise_for_status()
         data = r.json()
         
@@ -75,6 +121,7 @@ def send_stk_push(phone, amount):
             return {
                 'success': True,
                 'checkout_id': checkout_id,
+                'merchant_request_id': data.get('MerchantRequestID'),
                 'message': 'Check your phone for M-Pesa prompt!'
             }
         else:
@@ -87,9 +134,59 @@ def send_stk_push(phone, amount):
         return {'success': False, 'message': f'Error: {str(e)}'}
 
 
+def query_stk_push(checkout_id):
+    """Ask Daraja for the outcome of an STK Push (None while still open)"""
+    token = get_access_token()
+    if not token:
+        raise RuntimeError('Failed to connect to M-Pesa')
+    
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    password = base64.b64encode(f"{SHORTCODE}{PASSKEY}{timestamp}".encode()).decode()
+    
+    url = f"{DARAJA_BASE}/mpesa/stkpushquery/v1/query"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "BusinessShortCode": SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_id
+    }
+    
+    r = http_client.post(url, endpoint="daraja.stkquery", json=payload, headers=headers)
+    if r.status_code == 401:
+        token_manager().invalidate()
+    data = r.json() if r.content else {}
+    if data.get('errorCode') == '500.001.1001':  # "The transaction is being processed"
+        return None
+    r.raise_for_status()
+    return {'result_code': int(data['ResultCode']), 'result_desc': data.get('ResultDesc', '')}
+
+
+# Pending pushes whose callback never arrives are settled by STK Query
+reconciler = reconcile.create_reconciler(store, stk_query=query_stk_push)
+reconciler.on_settled(log_settled_payment)
+# A callback whose amount or phone does not match is checked with Daraja instead
+callbacks.on_mismatch(lambda payment_id, checkout_id: reconciler.verify('daraja', checkout_id))
+app.before_request(reconciler.start)
+
+
+def push_with_daraja(reference, phone, amount):
+    """Payment router provider: this app's STK Push"""
+    result = send_stk_push(phone, amount)
+    references = tuple(r for r in (result.get('checkout_id'), result.get('merchant_request_id')) if r)
+    return payment_router.Outcome('daraja', result['success'], references, None, result['message'])
+
+
+# New payments go to the healthiest of Daraja / Flutterwave, with failover
+router = payment_router.create_router(daraja=push_with_daraja)
+
+
 @app.route('/')
 def index():
-    return render_template('stk_push.html', entry_fee=ENTRY_FEE)
+    return pages.render('stk_push.html', entry_fee=ENTRY_FEE)
 
 
 @app.route('/pay', methods=['POST'])
@@ -99,45 +196,175 @@ def pay():
     if not phone:
         return render_template('result.html', message='❌ Phone number required')
     
-    # Clean phone number
-    phone = phone.strip().replace(' ', '')
-    if not phone.startswith('254'):
-        if phone.startswith('0'):
-            phone = '254' + phone[1:]
-        elif phone.startswith('+'):
-            phone = phone[1:]
+    phone = phones.try_normalize(phone)
+    if not phone:
+        return render_template('result.html', message='❌ Enter a valid Kenyan mobile number')
     
-    # Send STK Push
-    result = send_stk_push(phone, ENTRY_FEE)
+    # Impatient players resubmit: while a prompt for this phone is queued or
+    # pending, submits from the same session join it instead of sending
+    # another STK push
+    since = time.time() - PAY_IDEMPOTENCY_WINDOW
+    payment = store.find_open(phone, since)
+    if payment is not None and payment['payment_id'] == session.get('payment_id'):
+        return _pay_page(payment)
     
-    if result['success']:
-        checkout_id = result['checkout_id']
-        payments[checkout_id] = {
-            'phone': phone,
-            'amount': ENTRY_FEE,
-            'status': 'PENDING',
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        return render_template('result.html', 
-                             message=f"✅ {result['message']}<br><br>📱 Check your phone and enter your M-Pesa PIN to complete payment.<br><br><small>Reference: {checkout_id}</small>")
-    else:
-        return render_template('result.html', 
-                             message=f"❌ {result['message']}<br><br>Please try again or contact support.")
+    admission = pay_limiter.check(phone=phone, ip=rate_limit.client_ip(request))
+    if not admission.allowed:
+        retry_after = max(1, int(admission.retry_after + 0.999))
+        return render_template('result.html',
+                             message=f"⏳ Too many payment attempts. Please try again in {retry_after} seconds."), \
+            429, {'Retry-After': str(retry_after)}
+    
+    # Queue the STK Push and answer straight away; the page polls for the outcome.
+    # Only the request that creates the record sends the push (single flight).
+    reference = f"STK{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(3).upper()}"
+    payment, created = store.create_unless_open(reference, phone, ENTRY_FEE, since, status=QUEUED)
+    if not created:
+        return _join_page(payment)
+    session['payment_id'] = reference
+    try:
+        dispatcher.submit('stk', dispatch_stk_push, reference, phone, ENTRY_FEE)
+    except (queue.Full, RuntimeError):
+        store.transition(reference, FAILED, from_statuses=(QUEUED,), message='Server busy')
+        return render_template('result.html',
+                             message="❌ We're handling a lot of payments right now. Please try again in a moment."), 503
+    
+    return _pay_page(payment)
+
+
+def _join_page(payment):
+    """A payment is already open for this phone: rejoin it only from the session that started it"""
+    if payment['payment_id'] == session.get('payment_id'):
+        return _pay_page(payment)
+    return render_template('result.html',
+                         message="⏳ A payment for this number is already in progress. "
+                                 "Check your phone, or try again in a few minutes."), 409
+
+
+def _pay_page(payment):
+    reference = payment['payment_id']
+    return render_template('result.html',
+                         message=f"⏳ Sending M-Pesa prompt to {payment['phone']}... Reference: {reference}",
+                         status_url=f"/pay/status/{reference}")
+
+
+def dispatch_stk_push(reference, phone, amount):
+    """Background job: start the payment (STK Push, or Flutterwave when Daraja is unhealthy) and record the outcome"""
+    outcome = router.route(reference, phone, amount,
+                           on_late=lambda late: payment_router.record_late(store, reference, late))
+    payment_router.record_outcome(store, reference, outcome)
+
+
+@app.route('/pay/status/<reference>')
+def pay_status(reference):
+    """Poll the outcome of a queued STK Push"""
+    payment = store.get(reference)
+    if not payment:
+        return jsonify({'success': False, 'message': 'Payment not found'}), 404
+    return jsonify({
+        'success': True,
+        'reference': reference,
+        'status': payment['status'],
+        'checkout_id': payment.get('checkout_id'),
+        'provider': payment.get('provider'),
+        'payment_link': payment.get('payment_link'),
+        'message': payment.get('message'),
+    })
 
 
 @app.route('/callback', methods=['POST'])
-def callback():
-    """Receive M-Pesa callback (for production use)"""
-    data = request.get_json(force=True)
-    logging.info(f"Callback received: {data}")
+@app.route('/callback/<token>', methods=['POST'])
+def callback(token=None):
+    """Receive M-Pesa STK callback and settle the payment"""
+    if not token_matches(token, CALLBACK_TOKEN):
+        logging.warning(f"Refused STK callback from {request.remote_addr}: bad or missing token")
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Rejected'}), 403
+    data = request.get_json(force=True, silent=True)
+    outcome = callbacks.handle(data)
+    logging.info(f"Callback processed: {outcome}")
     return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'})
 
 
-@app.route('/admin')
-def admin():
-    """Simple admin view"""
-    return render_template('admin_simple.html', payments=payments, entry_fee=ENTRY_FEE)
+@app.route('/payment/callback')
+def payment_callback():
+    """Flutterwave redirects here after a payment the router sent to it"""
+    status = request.args.get('status')
+    tx_ref = request.args.get('tx_ref')
+
+    if status == 'successful' and tx_ref:
+        # Verify the payment (confirms it in the store when successful)
+        verdict = reconciler.verify('flutterwave', tx_ref)
+        if verdict.status == CONFIRMED:
+            return render_template('result.html', message=f'✅ Payment successful! Reference: {tx_ref}')
+        return render_template('result.html', message='⚠️ Payment verification failed')
+    return render_template('result.html', message='❌ Payment cancelled or failed')
+
+
+@app.route('/admin/api/reconcile')
+def admin_api_reconcile():
+    """STK Query poller and status cache counters for this worker"""
+    return jsonify({'success': True, **reconciler.stats()})
+
+
+@app.route('/admin/api/routing')
+def admin_api_routing():
+    """Provider health, breaker states and recent routing decisions for this worker"""
+    return jsonify({'success': True, **router.stats()})
+
+
+def _parse_day(value, end=False):
+    """'YYYY-MM-DD' -> epoch seconds at the start (or end) of that day"""
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d')
+    if end:
+        day += timedelta(days=1)
+    return day.timestamp()
+
+
+def _admin_row(p):
+    return {
+        'payment_id': p['payment_id'],
+        'phone': p['phone'],
+        'amount': p['amount'],
+        'status': p['status'],
+        'timestamp': p['timestamp'],
+        'provider': p.get('provider'),
+        'checkout_id': p.get('checkout_id'),
+        'confirmed_at': p.get('confirmed_at'),
+        'message': p.get('message'),
+    }
+
+
+@app.route('/admin/api/payments')
+def admin_api_payments():
+    """Cursor-paginated payments, newest first.
+    
+    Filters: ?status=PENDING&phone=...&from=YYYY-MM-DD&to=YYYY-MM-DD&limit=50&cursor=...
+    """
+    try:
+        page, next_cursor = store.query(
+            status=request.args.get('status') or None,
+            phone=request.args.get('phone') or None,
+            since=_parse_day(request.args.get('from')),
+            until=_parse_day(request.args.get('to'), end=True),
+            cursor=request.args.get('cursor') or None,
+            limit=min(request.args.get('limit', 50, type=int), 200),
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'payments': [_admin_row(p) for p in page],
+        'next_cursor': next_cursor,
+    })
+
+
+@app.route('/admin/api/stats')
+def admin_api_stats():
+    """Precomputed aggregates (no table scan)"""
+    return jsonify({'success': True, **store.totals()})
 
 
 if __name__ == '__main__':
@@ -1,15 +1,27 @@
 from flask import Flask, render_template, request, redirect, url_for, jsonify
 import logging
+import config
 from config import ENTRY_FEE
+import mpesa
 import sms
 from datetime import datetime
+import ledger
+import payment_store
+import phones
+import reconcile
+import static_assets
+from payment_store import CONFIRMED
 
 app = Flask(__name__)
+# Fingerprinted, precompressed CSS/JS from assets/ (asset_url in templates)
+static_assets.init_app(app)
 logging.basicConfig(level=logging.INFO)
 
-# Simple in-memory store for payments
-payments = {}
-payment_counter = 1
+# Shared payment store (SQLite by default so every gunicorn worker sees it)
+store = payment_store.get_store()
+
+# Flutterwave verifications are cached, so repeated redirects cost one lookup
+reconciler = reconcile.create_reconciler(store)
 
 
 @app.route('/')
@@ -24,6 +36,7 @@ def pay():
     phone = request.form.get('phone')
     print(f"\n=== PAY ROUTE CALLED ===")
     print(f"Phone: {phone}")
+    phone = phones.try_normalize(phone)
     if not phone:
         return redirect(url_for('index'))
     # start STK push with error handling to surface issues to the UI
@@ -37,7 +50,7 @@ def pay():
         return render_template('result.html', message=f'Error initiating STK Push: {e}')
 
     if checkout:
-        payments[checkout] = {'phone': phone, 'status': 'PENDING'}
+        store.create(checkout, phone, ENTRY_FEE)
         return render_template('result.html', message=f'STK Push initiated (id={checkout}). Check your phone.')
     else:
         print("Checkout is None - falling back to simulated flow")
@@ -51,11 +64,9 @@ def payment_callback():
     tx_ref = request.args.get('tx_ref')
     
     if status == 'successful' and tx_ref:
-        # Verify the payment
-        verified = flutterwave_pay.verify_payment(tx_ref)
-        if verified:
-            if tx_ref in payments:
-                payments[tx_ref]['status'] = 'SUCCESS'
+        # Verify the payment (confirms it in the store when successful)
+        verdict = reconciler.verify('flutterwave', tx_ref)
+        if verdict.status == CONFIRMED:
             return render_template('result.html', message=f'✅ Payment successful! Reference: {tx_ref}')
         else:
             return render_template('result.html', message='⚠️ Payment verification failed')
@@ -68,6 +79,7 @@ def payout():
     # Admin endpoint to payout a winner (simulated for now)
     phone = request.form.get('phone')
     amount = request.form.get('amount')
+    phone = phones.try_normalize(phone)
     if not phone or not amount:
         return render_template('result.html', message='Phone and amount required')
     try:
@@ -77,8 +89,7 @@ def payout():
 
     # Simulate payout
     logging.info(f"Simulating payout of KES {amount} to {phone}")
-    with open("simulated_payouts.log", "a", encoding="utf-8") as f:
-        f.write(f"PAYOUT: To={phone} Amount={amount}\n")
+    ledger.get_ledger('payouts').append('payout_simulated', phone=phone, amount=amount)
     return render_template('result.html', message=f'Payout simulated: KES {amount} to {phone}')
 
 
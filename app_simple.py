@@ -3,74 +3,94 @@ from flask import Flask, render_template, request, jsonify
 import logging
 from datetime import datetime
 import os
+import secrets
+import ledger
+import metrics
+import page_cache
+import payment_store
+import payment_expiry
+import phones
+import static_assets
+from payment_store import PENDING, CONFIRMED, CONFIRMABLE
 
 app = Flask(__name__)
+# Route latency histograms and /metrics for Prometheus
+metrics.instrument_app(app)
+# Fingerprinted, precompressed CSS/JS from assets/ (asset_url in templates)
+static_assets.init_app(app)
 logging.basicConfig(level=logging.INFO)
 
 # Configuration
 ENTRY_FEE = 50
 PAYMENT_NUMBER = os.getenv('PAYMENT_NUMBER', '+254700000000')  # Your M-Pesa number
+ADMIN_PAGE_SIZE = 100  # rows per table on the admin page
 
-# Store payments in memory
-payments = {}
-payment_counter = 1
+# Shared payment store (SQLite by default so every gunicorn worker sees it)
+store = payment_store.get_store()
+
+# Unconfirmed payments expire; old finished ones move to the archive ledger
+expiry = payment_expiry.create_service(store)
+app.before_request(expiry.start)
+
+# Rendered pages with ETag/304 and pre-compressed bodies
+pages = page_cache.create_cache()
+
+# Payment and payout records for your reference (ledger/*.jsonl)
+payments_ledger = ledger.get_ledger('payments')
+payouts_ledger = ledger.get_ledger('payouts')
 
 
 @app.route('/')
 def index():
-    return render_template('index_simple.html', 
-                         entry_fee=ENTRY_FEE, 
-                         payment_number=PAYMENT_NUMBER)
+    return pages.render('index_simple.html',
+                        entry_fee=ENTRY_FEE,
+                        payment_number=PAYMENT_NUMBER)
 
 
 @app.route('/pay', methods=['POST'])
 def pay():
-    global payment_counter
     phone = request.form.get('phone')
     
     if not phone:
         return render_template('result.html', message='❌ Phone number required')
     
-    # Create payment request
-    payment_id = f"ODM{payment_counter:04d}"
-    payment_counter += 1
+    phone = phones.try_normalize(phone)
+    if not phone:
+        return render_template('result.html', message='❌ Enter a valid Kenyan mobile number')
     
-    payments[payment_id] = {
-        'phone': phone,
-        'amount': ENTRY_FEE,
-        'status': 'PENDING',
-        'timestamp': datetime.now().isoformat()
-    }
+    # Create payment request; a timestamp plus random suffix is unique across
+    # workers without counting rows (archived payments leave the store)
+    payment_id = f"ODM{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(3).upper()}"
+    store.create(payment_id, phone, ENTRY_FEE)
     
     # Log for your reference
-    with open("pending_payments.log", "a", encoding="utf-8") as f:
-        f.write(f"{datetime.now()} | ID: {payment_id} | Phone: {phone} | Amount: KES {ENTRY_FEE} | Status: PENDING\n")
+    payments_ledger.append('payment_pending', payment_id=payment_id, phone=phone, amount=ENTRY_FEE)
     
-    return render_template('payment_instructions.html', 
-                         payment_id=payment_id, 
-                         phone=phone, 
-                         amount=ENTRY_FEE,
-                         payment_number=PAYMENT_NUMBER)
+    # Per-payment page: rendered each time, never kept in the page cache
+    return render_template('payment_instructions.html',
+                           payment_id=payment_id,
+                           phone=phone,
+                           amount=ENTRY_FEE,
+                           payment_number=PAYMENT_NUMBER)
 
 
 @app.route('/admin')
 def admin():
-    """Admin page to view and confirm payments"""
-    pending = {k: v for k, v in payments.items() if v['status'] == 'PENDING'}
-    confirmed = {k: v for k, v in payments.items() if v['status'] == 'CONFIRMED'}
-    return render_template('admin.html', pending=pending, confirmed=confirmed, entry_fee=ENTRY_FEE)
+    """Admin page to view and confirm payments (first page of each; counts are precomputed)"""
+    pending = {p['payment_id']: p for p in store.by_status(PENDING, limit=ADMIN_PAGE_SIZE)}
+    confirmed = {p['payment_id']: p for p in store.query(status=CONFIRMED, limit=ADMIN_PAGE_SIZE)[0]}
+    return render_template('admin.html', pending=pending, confirmed=confirmed,
+                           totals=store.totals(), entry_fee=ENTRY_FEE)
 
 
 @app.route('/admin/confirm/<payment_id>', methods=['POST'])
 def confirm_payment(payment_id):
     """Confirm a payment was received"""
-    if payment_id in payments:
-        payments[payment_id]['status'] = 'CONFIRMED'
-        payments[payment_id]['confirmed_at'] = datetime.now().isoformat()
-        
+    payment = store.transition(payment_id, CONFIRMED, from_statuses=CONFIRMABLE,
+                               confirmed_at=datetime.now().isoformat())
+    if payment:
         # Log confirmation
-        with open("confirmed_payments.log", "a", encoding="utf-8") as f:
-            f.write(f"{datetime.now()} | ID: {payment_id} | Phone: {payments[payment_id]['phone']} | CONFIRMED\n")
+        payments_ledger.append('payment_confirmed', payment_id=payment_id, phone=payment['phone'], amount=payment['amount'])
         
         return jsonify({'success': True, 'message': 'Payment confirmed'})
     return jsonify({'success': False, 'message': 'Payment not found'})
@@ -85,14 +105,17 @@ def payout():
     if not phone or not amount:
         return render_template('result.html', message='❌ Phone and amount required')
     
+    phone = phones.try_normalize(phone)
+    if not phone:
+        return render_template('result.html', message='❌ Invalid phone number')
+    
     try:
         amount = int(amount)
     except:
         return render_template('result.html', message='❌ Invalid amount')
     
     # Log payout
-    with open("payouts.log", "a", encoding="utf-8") as f:
-        f.write(f"{datetime.now()} | To: {phone} | Amount: KES {amount} | SENT\n")
+    payouts_ledger.append('payout_recorded', phone=phone, amount=amount)
     
     return render_template('result.html', 
                          message=f'✅ Payout recorded: KES {amount} to {phone}. Send via M-Pesa now!')
@@ -0,0 +1,180 @@
+// admin_dashboard.html: paginated tables, bulk actions and the live change feed
+function confirmPayment(paymentId) {
+  if (!confirm('Confirm payment ' + paymentId + '?')) return;
+
+  fetch('/admin/confirm/' + paymentId, { method: 'POST' })
+    .then(res => res.json())
+    .then(data => {
+      if (data.success) {
+        alert('Payment confirmed!');
+      } else {
+        alert('Error: ' + data.message);
+      }
+    })
+    .catch(err => alert('Error: ' + err));
+}
+
+function rejectPayment(paymentId) {
+  if (!confirm('Reject payment ' + paymentId + '?')) return;
+
+  fetch('/admin/reject/' + paymentId, { method: 'POST' })
+    .then(res => res.json())
+    .then(data => {
+      if (data.success) {
+        alert('Payment rejected!');
+      } else {
+        alert('Error: ' + data.message);
+      }
+    })
+    .catch(err => alert('Error: ' + err));
+}
+
+function bulkAction(action) {
+  const ids = Array.from(document.querySelectorAll('.select-payment:checked')).map(box => box.value);
+  if (!ids.length) return alert('Select at least one payment');
+  if (!confirm(action + ' ' + ids.length + ' payment(s)?')) return;
+
+  fetch('/admin/bulk', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ action: action, payment_ids: ids })
+  })
+    .then(res => res.json())
+    .then(data => {
+      if (data.success) {
+        const skipped = ids.length - data.updated;
+        alert(data.updated + ' payment(s) updated' + (skipped ? ', ' + skipped + ' no longer pending' : ''));
+      } else {
+        alert('Error: ' + data.message);
+      }
+    })
+    .catch(err => alert('Error: ' + err));
+}
+
+function cell(text) {
+  const td = document.createElement('td');
+  td.textContent = text;
+  return td;
+}
+
+function idCell(paymentId) {
+  const td = document.createElement('td');
+  const code = document.createElement('code');
+  code.textContent = paymentId;
+  td.appendChild(code);
+  return td;
+}
+
+function pendingRow(p) {
+  const tr = document.createElement('tr');
+  tr.id = 'payment-' + p.payment_id;
+  const actions = document.createElement('td');
+  actions.innerHTML =
+    '<button class="btn btn-success btn-sm">✓ Confirm</button> ' +
+    '<button class="btn btn-danger btn-sm">✗ Reject</button>';
+  actions.children[0].onclick = () => confirmPayment(p.payment_id);
+  actions.children[1].onclick = () => rejectPayment(p.payment_id);
+  const select = document.createElement('td');
+  select.innerHTML = '<input type="checkbox" class="select-payment">';
+  select.firstChild.value = p.payment_id;
+  tr.append(select, idCell(p.payment_id), cell(p.phone), cell('KES ' + p.amount), cell(p.timestamp), actions);
+  return tr;
+}
+
+function confirmedRow(p) {
+  const tr = document.createElement('tr');
+  tr.id = 'confirmed-' + p.payment_id;
+  tr.append(idCell(p.payment_id), cell(p.phone), cell('KES ' + p.amount), cell(p.confirmed_at || ''));
+  return tr;
+}
+
+// Cursor-paginated tables: each "Load more" fetches the next page only
+const tables = {
+  pending: { status: 'PENDING', render: pendingRow, cursor: null },
+  confirmed: { status: 'CONFIRMED', render: confirmedRow, cursor: null }
+};
+
+function filterParams() {
+  const params = new URLSearchParams();
+  new FormData(document.getElementById('filters')).forEach((value, key) => {
+    if (value) params.set(key, value);
+  });
+  return params;
+}
+
+function loadPage(name, reset) {
+  const table = tables[name];
+  const rows = document.getElementById(name + '-rows');
+  const params = filterParams();
+  params.set('status', table.status);
+  if (reset) {
+    rows.innerHTML = '';
+    table.cursor = null;
+  } else if (table.cursor) {
+    params.set('cursor', table.cursor);
+  }
+  return fetch('/admin/api/payments?' + params)
+    .then(res => res.json())
+    .then(data => {
+      data.payments.forEach(p => rows.appendChild(table.render(p)));
+      table.cursor = data.next_cursor;
+      document.getElementById(name + '-more').classList.toggle('d-none', !data.next_cursor);
+      document.getElementById(name + '-empty').classList.toggle('d-none', rows.children.length > 0);
+    });
+}
+
+function refreshStats() {
+  fetch('/admin/api/stats')
+    .then(res => res.json())
+    .then(data => {
+      document.getElementById('pending-count').textContent = data.counts.PENDING || 0;
+      document.getElementById('confirmed-count').textContent = data.counts.CONFIRMED || 0;
+      document.getElementById('collected').textContent = Math.round(data.collected);
+      document.getElementById('prizes').textContent = Math.round(data.prizes);
+    });
+}
+
+// Apply the delta feed to rows already on the page
+let seq = Number(document.body.dataset.seq);
+
+function applyChange(p) {
+  const old = document.getElementById('payment-' + p.payment_id);
+  if (old) old.remove();
+  if (p.status === 'PENDING') {
+    document.getElementById('pending-rows').prepend(pendingRow(p));
+  }
+  if (p.status === 'CONFIRMED' && !document.getElementById('confirmed-' + p.payment_id)) {
+    document.getElementById('confirmed-rows').prepend(confirmedRow(p));
+  }
+  ['pending', 'confirmed'].forEach(name => {
+    const rows = document.getElementById(name + '-rows');
+    document.getElementById(name + '-empty').classList.toggle('d-none', rows.children.length > 0);
+  });
+}
+
+function followChanges() {
+  fetch('/admin/changes?since=' + seq)
+    .then(res => res.json())
+    .then(data => {
+      seq = data.seq;
+      data.changes.forEach(applyChange);
+      if (data.changes.length) refreshStats();
+      followChanges();
+    })
+    .catch(() => setTimeout(followChanges, 5000));
+}
+
+document.getElementById('select-all').onchange = (e) => {
+  document.querySelectorAll('.select-payment').forEach(box => { box.checked = e.target.checked; });
+};
+document.getElementById('pending-more').onclick = () => loadPage('pending');
+document.getElementById('confirmed-more').onclick = () => loadPage('confirmed');
+document.getElementById('filters').onsubmit = (e) => {
+  e.preventDefault();
+  loadPage('pending', true);
+  loadPage('confirmed', true);
+};
+
+loadPage('pending', true);
+loadPage('confirmed', true);
+followChanges();
@@ -0,0 +1,76 @@
+// box_game.html: pick a box, ask the server for the prize, show it
+let selectedBox = null;
+let selectedElement = null;
+
+function selectBox(boxNumber, element) {
+  // Remove previous selection
+  if (selectedElement) {
+    selectedElement.classList.remove('selected');
+  }
+
+  // Set new selection
+  selectedBox = boxNumber;
+  selectedElement = element;
+  element.classList.add('selected');
+
+  // Enable play button
+  document.getElementById('playBtn').disabled = false;
+}
+
+function playGame() {
+  if (selectedBox === null) return;
+
+  // Disable all boxes
+  document.querySelectorAll('.box').forEach(box => box.classList.add('disabled'));
+  document.getElementById('playBtn').disabled = true;
+
+  // The server decides the prize; we only send the box we picked
+  fetch('/game-result', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      payment_id: document.body.dataset.paymentId,
+      box_number: selectedBox
+    })
+  })
+    .then(res => res.json())
+    .then(data => {
+      if (data.prize === undefined || data.prize === null) {
+        alert('Error: ' + (data.message || 'Could not reveal your prize'));
+        return;
+      }
+      // Brief pause for the reveal animation
+      setTimeout(() => showResult(data.prize), 500);
+    })
+    .catch(err => alert('Error: ' + err));
+}
+
+function showResult(prize) {
+  const resultBox = document.getElementById('resultBox');
+  const resultText = document.getElementById('resultText');
+  const resultMessage = document.getElementById('resultMessage');
+  const prizeAmount = document.getElementById('prizeAmount');
+
+  if (prize === 0) {
+    // Loss case
+    resultBox.classList.remove('win');
+    resultBox.classList.add('loss');
+    resultText.textContent = '💫 Better Luck Next Time!';
+    resultMessage.textContent = 'You selected the special surprise box! No worries—every player wins eventually. Come back and try again!';
+    prizeAmount.textContent = '';
+  } else {
+    // Win case
+    resultBox.classList.remove('loss');
+    resultBox.classList.add('win');
+    resultText.textContent = '🎉 YOU WIN!';
+    resultMessage.textContent = 'Congratulations! Your mystery box contained:';
+    prizeAmount.textContent = `KES ${prize}`;
+  }
+
+  resultBox.classList.add('show');
+}
+
+function playAgain() {
+  // Redirect to payment page to pay again
+  window.location.href = '/';
+}
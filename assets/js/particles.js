@@ -0,0 +1,21 @@
+// Animated glow particles behind the player pages; <div id="particles" data-count="15">
+(function () {
+  const particlesContainer = document.getElementById('particles');
+  if (!particlesContainer) return;
+  const particleCount = Number(particlesContainer.dataset.count || 30);
+
+  for (let i = 0; i < particleCount; i++) {
+    const particle = document.createElement('div');
+    particle.className = 'particle';
+
+    const size = Math.random() * 80 + 40;
+    particle.style.width = size + 'px';
+    particle.style.height = size + 'px';
+    particle.style.left = Math.random() * 100 + '%';
+    particle.style.top = Math.random() * 100 + '%';
+    particle.style.animationDelay = Math.random() * 8 + 's';
+    particle.style.animationDuration = (Math.random() * 6 + 6) + 's';
+
+    particlesContainer.appendChild(particle);
+  }
+})();
@@ -0,0 +1,97 @@
+"""Compare the sync and async serving modes against a slow upstream.
+
+Runs the STK Push flow of ``app_auto`` (gunicorn, ``WORKERSxTHREADS``
+threads plus its dispatch queue) and ``app_async`` (hypercorn, same
+worker count) against one ``standin.Standin`` whose every response takes
+``--upstream-latency`` seconds, at each ``--users`` level. Where the sync
+mode tops out at the threads it has for Daraja calls, the async mode
+keeps accepting; the report shows, per mode and user count:
+
+- flows and requests per second, and errors by step
+- ``prompt`` latency: submit -> STK push accepted by Daraja
+- how many requests the stand-in held at once (upstream concurrency)
+- server RSS after warm-up and at the end
+
+::
+
+    python benchmarks/async_vs_sync.py --users 20,100,200 --upstream-latency 1.0 --out async.json
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime
+
+from payment_flow import git_commit, parse_configs, run_config
+from standin import Standin
+
+MODES = (("sync", "app_auto"), ("async", "app_async"))
+
+
+def summary_line(mode: str, result: dict) -> str:
+    prompt = result["marks"].get("prompt", {})
+    errors = sum(result["errors"].values())
+    return (f"{mode:<5} users={result['users']:<4} flows/s {result['flows_per_second']:<7} "
+            f"req/s {result['requests_per_second']:<7} prompt p50/p95 {prompt.get('p50_ms', 0):.0f}/"
+            f"{prompt.get('p95_ms', 0):.0f} ms  upstream peak {result['upstream_peak_in_flight']:<4} "
+            f"errors {errors:<5} rss {result['rss_mb']['end']} MB")
+
+
+def run(args) -> dict:
+    workers, threads = args.config
+    standin = Standin(args.upstream_latency, jitter=0.1, settle_after=args.upstream_latency, seed=args.seed).start()
+    results = []
+    try:
+        for users in args.users:
+            args_for_run = argparse.Namespace(**dict(vars(args), users=users, server="gunicorn"))
+            for mode, app in MODES:
+                result = run_config(app, workers, threads, standin, args_for_run)
+                result["mode"] = mode
+                results.append(result)
+                print(summary_line(mode, result), file=sys.stderr)
+    finally:
+        upstream = standin.stats()
+        standin.stop()
+    return {
+        "benchmark": "async_vs_sync",
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "config": f"{workers}x{threads}",
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "users": args.users,
+            "upstream_latency": args.upstream_latency,
+        },
+        "upstream_requests": upstream,
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", type=lambda v: parse_configs(v)[0], default=(2, 4),
+                        help="WORKERSxTHREADS; the async mode uses the same worker count")
+    parser.add_argument("--users", type=lambda v: [int(n) for n in v.split(",")], default=[20, 100],
+                        help="comma-separated concurrent user counts")
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--upstream-latency", type=float, default=1.0, help="stand-in delay in seconds")
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--poll-timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Replay Daraja STK callbacks against a local stand-in and measure throughput.
+
+By default this generates synthetic callbacks for freshly created PENDING
+payments (plus a share of duplicates, as Safaricom resends). Recorded
+callbacks can be replayed instead with ``--replay FILE`` (one JSON body per
+line); payments for unknown CheckoutRequestIDs are created on the fly.
+
+Targets:
+
+- ``processor`` — ``CallbackProcessor`` directly, to measure the store path
+- ``flask`` — ``POST /callback/<token>`` on ``app_auto`` through Flask's test client
+
+Example::
+
+    python benchmarks/callback_load.py --count 50000 --threads 8 --store sqlite
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def synthetic_callback(checkout_id: str, merchant_id: str, phone: str, ok: bool) -> dict:
+    cb = {
+        "MerchantRequestID": merchant_id,
+        "CheckoutRequestID": checkout_id,
+        "ResultCode": 0 if ok else 1032,
+        "ResultDesc": "The service request is processed successfully." if ok else "Request cancelled by user",
+    }
+    if ok:
+        cb["CallbackMetadata"] = {"Item": [
+            {"Name": "Amount", "Value": 50},
+            {"Name": "MpesaReceiptNumber", "Value": f"R{checkout_id[-8:]}"},
+            {"Name": "TransactionDate", "Value": int(time.strftime("%Y%m%d%H%M%S"))},
+            {"Name": "PhoneNumber", "Value": int(phone)},
+        ]}
+    return {"Body": {"stkCallback": cb}}
+
+
+def build_workload(store, args) -> list:
+    bodies = []
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            bodies = [json.loads(line) for line in f if line.strip()]
+    else:
+        for i in range(args.count):
+            phone = f"2547{random.randint(10000000, 99999999)}"
+            bodies.append(synthetic_callback(f"ws_CO_{i:012d}", f"{i}-bench-1", phone, random.random() > args.fail_ratio))
+        # Safaricom resends: replay a share of callbacks a second time
+        bodies += random.sample(bodies, int(len(bodies) * args.duplicate_ratio))
+        random.shuffle(bodies)
+
+    for body in bodies:
+        cb = body.get("Body", {}).get("stkCallback", {})
+        checkout_id = cb.get("CheckoutRequestID")
+        if checkout_id and store.resolve(checkout_id) is None:
+            payment_id = f"BENCH-{checkout_id}"
+            # amount and phone must match, or the callback is only checked by STK Query
+            items = {i.get("Name"): i.get("Value") for i in (cb.get("CallbackMetadata") or {}).get("Item", [])}
+            store.create(payment_id, str(items.get("PhoneNumber", "254700000000")), items.get("Amount", 50))
+            store.add_reference(payment_id, checkout_id)
+    return bodies
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def run(args) -> dict:
+    if args.store == "sqlite":
+        os.environ["PAYMENT_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["PAYMENT_STORE"] = args.store
+
+    import payment_store
+    from mpesa_callbacks import CallbackProcessor
+
+    if args.target == "flask":
+        os.environ.setdefault("CALLBACK_TOKEN", "bench-callback")
+        import app_auto
+        client = app_auto.app.test_client()
+        store = app_auto.store
+
+        def handle(body):
+            client.post(f"/callback/{app_auto.CALLBACK_TOKEN}", json=body)
+    else:
+        store = payment_store.get_store()
+        processor = CallbackProcessor(store)
+        handle = processor.handle
+
+    bodies = build_workload(store, args)
+    chunks = [bodies[i::args.threads] for i in range(args.threads)]
+    latencies = [[] for _ in chunks]
+
+    def worker(n):
+        out = latencies[n]
+        for body in chunks[n]:
+            t0 = time.perf_counter()
+            handle(body)
+            out.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    merged = sorted(x for chunk in latencies for x in chunk)
+    return {
+        "target": args.target,
+        "store": args.store,
+        "threads": args.threads,
+        "callbacks": len(merged),
+        "seconds": round(elapsed, 3),
+        "per_second": round(len(merged) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(merged, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(merged, 0.99) * 1000, 3),
+        "confirmed": store.count(payment_store.CONFIRMED),
+        "failed": store.count(payment_store.FAILED),
+        "pending": store.count(payment_store.PENDING),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", choices=("processor", "flask"), default="processor")
+    parser.add_argument("--store", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--count", type=int, default=10000, help="synthetic payments to settle")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1)
+    parser.add_argument("--fail-ratio", type=float, default=0.2)
+    parser.add_argument("--replay", help="JSON-lines file of recorded callback bodies")
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
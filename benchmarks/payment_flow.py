@@ -0,0 +1,465 @@
+"""Load-test the full payment flow of each Flask app.
+
+Each app runs under gunicorn (or Werkzeug's threaded server with
+``--server werkzeug``; the ASGI ``app_async`` always under hypercorn) with its own temporary SQLite store and ledger, and
+Daraja / Flutterwave replaced by ``standin.Standin``. Virtual users then
+loop through the app's flow for ``--duration`` seconds:
+
+- ``app`` — ``/`` -> ``/pay`` -> ``/admin/confirm`` -> ``/check-status`` -> ``/game-result``
+- ``app_simple`` — ``/`` -> ``/pay`` -> ``/admin/confirm`` -> ``/payout``
+- ``app_auto`` / ``app_async`` — ``/`` -> ``/pay`` -> poll ``/pay/status`` until
+  the STK push is PENDING -> Daraja ``/callback`` -> poll until CONFIRMED
+
+The report has p50/p95/p99 per step and overall, requests and flows per
+second, errors, and the server's RSS (all processes) after warm-up and at
+the end, for every ``--configs`` entry (gunicorn ``WORKERSxTHREADS``).
+Rate limits are switched off so the numbers measure the flow itself.
+
+Save a run with ``--out`` and compare a later one against it with
+``--compare``::
+
+    python benchmarks/payment_flow.py --apps app,app_auto --configs 1x4,2x4 --out base.json
+    python benchmarks/payment_flow.py --apps app,app_auto --configs 1x4,2x4 --compare base.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+from standin import Standin
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APPS = ("app", "app_simple", "app_auto", "app_async")
+
+# served by an ASGI server instead of gunicorn's threads
+ASGI_APPS = ("app_async",)
+
+_PAYMENT_ID = re.compile(r"<code>((?:PAY|ODM)[0-9A-F]+)</code>")
+_STATUS_URL = re.compile(r"/pay/status/([A-Z0-9]+)")
+
+# secret path segment the apps require on Daraja's callback URL
+CALLBACK_TOKEN = "bench-callback"
+
+_WERKZEUG = (
+    "import importlib, sys\n"
+    "from werkzeug.serving import run_simple\n"
+    "app = importlib.import_module(sys.argv[1]).app\n"
+    "run_simple('127.0.0.1', int(sys.argv[2]), app, threaded=True)\n"
+)
+
+
+class FlowError(Exception):
+    """A step returned an unexpected response; the flow is abandoned."""
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def latency_summary(values: list) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def tree_rss_mb(pid: int):
+    """Resident memory of ``pid`` and its children in MB (Linux only)."""
+    def rss(p):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    if not os.path.exists("/proc"):
+        return None
+    total = rss(pid)
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            total += rss(entry)
+    return round(total / 1e6, 1)
+
+
+class Server:
+    """One app running in a child process with isolated state."""
+
+    def __init__(self, module: str, workers: int, threads: int, standin_url: str, server: str = "gunicorn"):
+        self.module = module
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.tmp = tempfile.mkdtemp(prefix=f"bench-{module}-")
+        env = dict(
+            os.environ,
+            PAYMENT_STORE="sqlite",
+            PAYMENT_DB_PATH=os.path.join(self.tmp, "payments.db"),
+            RATE_LIMIT_DB_PATH=os.path.join(self.tmp, "ratelimit.db"),
+            LEDGER_DIR=os.path.join(self.tmp, "ledger"),
+            METRICS_DIR=os.path.join(self.tmp, "metrics"),
+            PAY_LIMIT_PER_PHONE="0",
+            PAY_LIMIT_PER_IP="0",
+            PAY_LIMIT_GLOBAL="0",
+            SECRET_KEY="bench",
+            MPESA_BASE_URL=standin_url,
+            FLW_BASE_URL=standin_url,
+            CALLBACK_URL=f"{self.url}/callback",
+            CALLBACK_TOKEN=CALLBACK_TOKEN,
+            MPESA_SHORTCODE="174379",
+            MPESA_PASSKEY="bench",
+            MPESA_CONSUMER_KEY="bench",
+            MPESA_CONSUMER_SECRET="bench",
+            MPESA_B2C_SHORTCODE="600000",
+            MPESA_B2C_INITIATOR="bench",
+            MPESA_B2C_SECURITY_CREDENTIAL="bench",
+            MPESA_B2C_RESULT_URL=f"{standin_url}/b2c/result",
+        )
+        if server == "hypercorn":
+            cmd = [sys.executable, "-m", "hypercorn", f"--workers={workers}", f"--bind=127.0.0.1:{self.port}",
+                   "--log-level=warning", f"{module}:app"]
+        elif server == "gunicorn":
+            cmd = [sys.executable, "-m", "gunicorn", f"--workers={workers}", f"--threads={threads}",
+                   "--timeout=30", f"--bind=127.0.0.1:{self.port}", "--log-level=warning", f"{module}:app"]
+        else:
+            cmd = [sys.executable, "-c", _WERKZEUG, module, str(self.port)]
+        self._log = open(os.path.join(self.tmp, "server.log"), "w")
+        self.proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 30.0) -> None:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                if requests.get(self.url + "/", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        with open(self._log.name) as f:
+            raise RuntimeError(f"{self.module} did not start:\n{f.read()[-2000:]}")
+
+    def rss_mb(self):
+        return tree_rss_mb(self.proc.pid)
+
+    def stop(self) -> None:
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(15)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self._log.close()
+
+
+class VirtualUser:
+    """Runs flows with one HTTP session and records per-step latency."""
+
+    def __init__(self, app: str, base_url: str, user_id: int, poll_interval: float, poll_timeout: float):
+        self.app = app
+        self.base = base_url
+        self.user_id = user_id
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+        self.http = requests.Session()
+        self.latencies = {}
+        self.marks = {}
+        self.flow_seconds = []
+        self.errors = {}
+        self.iteration = 0
+
+    def _step(self, name: str, method: str, path: str, expect=(200,), **kwargs) -> requests.Response:
+        started = time.perf_counter()
+        try:
+            resp = self.http.request(method, self.base + path, timeout=30, **kwargs)
+        except requests.RequestException as e:
+            raise FlowError(f"{name}: {type(e).__name__}")
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        if resp.status_code not in expect:
+            raise FlowError(f"{name}: HTTP {resp.status_code}")
+        return resp
+
+    def _phone(self) -> str:
+        self.iteration += 1
+        return f"07{(self.user_id * 1_000_000 + self.iteration) % 100_000_000:08d}"
+
+    def run_flow(self) -> None:
+        started = time.perf_counter()
+        try:
+            getattr(self, f"_flow_{self.app}")(self._phone())
+        except FlowError as e:
+            step = str(e).split(":", 1)[0]
+            self.errors[step] = self.errors.get(step, 0) + 1
+            return
+        self.flow_seconds.append(time.perf_counter() - started)
+
+    def _payment_id(self, resp) -> str:
+        match = _PAYMENT_ID.search(resp.text)
+        if not match:
+            raise FlowError("pay: no payment id in page")
+        return match.group(1)
+
+    def _flow_app(self, phone):
+        self._step("index", "GET", "/")
+        payment_id = self._payment_id(self._step("pay", "POST", "/pay", data={"phone": phone}))
+        self._step("confirm", "POST", f"/admin/confirm/{payment_id}")
+        self._step("check_status", "GET", "/check-status")
+        self._step("game_result", "POST", "/game-result",
+                   json={"payment_id": payment_id, "box_number": random.randint(1, 5)})
+
+    def _flow_app_simple(self, phone):
+        self._step("index", "GET", "/")
+        payment_id = self._payment_id(self._step("pay", "POST", "/pay", data={"phone": phone}))
+        self._step("confirm", "POST", f"/admin/confirm/{payment_id}")
+        self._step("payout", "POST", "/payout", data={"phone": phone, "amount": "100"})
+
+    def _poll(self, reference: str, until: str) -> dict:
+        deadline = time.time() + self.poll_timeout
+        while time.time() < deadline:
+            status = self._step("status", "GET", f"/pay/status/{reference}").json()
+            if status["status"] == until:
+                return status
+            if status["status"] in ("FAILED", "EXPIRED"):
+                raise FlowError(f"status: payment {status['status']}")
+            time.sleep(self.poll_interval)
+        raise FlowError(f"status: not {until} after {self.poll_timeout}s")
+
+    def _flow_app_auto(self, phone):
+        self._step("index", "GET", "/")
+        started = time.perf_counter()
+        resp = self._step("pay", "POST", "/pay", data={"phone": phone})
+        match = _STATUS_URL.search(resp.text)
+        if not match:
+            raise FlowError("pay: no status url in page")
+        reference = match.group(1)
+        status = self._poll(reference, "PENDING")
+        # submit -> prompt sent: what the customer waits for
+        self.marks.setdefault("prompt", []).append(time.perf_counter() - started)
+        # what Daraja posts once the customer enters their PIN
+        self._step("callback", "POST", f"/callback/{CALLBACK_TOKEN}", json={"Body": {"stkCallback": {
+            "MerchantRequestID": f"{reference}-bench",
+            "CheckoutRequestID": status["checkout_id"],
+            "ResultCode": 0,
+            "ResultDesc": "The service request is processed successfully.",
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": 50},
+                {"Name": "MpesaReceiptNumber", "Value": f"R{reference[-8:]}"},
+                {"Name": "PhoneNumber", "Value": int("254" + phone[1:])},
+            ]},
+        }}})
+        self._poll(reference, "CONFIRMED")
+
+    _flow_app_async = _flow_app_auto
+
+
+def drive(app: str, base_url: str, users: int, duration: float, args) -> dict:
+    """Run ``users`` virtual users against ``base_url`` for ``duration`` seconds."""
+    vus = [VirtualUser(app, base_url, n, args.poll_interval, args.poll_timeout) for n in range(users)]
+    stop = time.perf_counter() + duration
+
+    def loop(vu):
+        while time.perf_counter() < stop:
+            vu.run_flow()
+
+    threads = [threading.Thread(target=loop, args=(vu,)) for vu in vus]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    steps, marks, errors, flows = {}, {}, {}, []
+    for vu in vus:
+        for name, values in vu.latencies.items():
+            steps.setdefault(name, []).extend(values)
+        for name, values in vu.marks.items():
+            marks.setdefault(name, []).extend(values)
+        for name, n in vu.errors.items():
+            errors[name] = errors.get(name, 0) + n
+        flows.extend(vu.flow_seconds)
+    every = [x for values in steps.values() for x in values]
+    return {
+        "seconds": round(elapsed, 2),
+        "requests": len(every),
+        "requests_per_second": round(len(every) / elapsed, 1),
+        "flows": len(flows),
+        "flows_per_second": round(len(flows) / elapsed, 2),
+        "errors": errors,
+        "latency": latency_summary(every),
+        "flow_latency": latency_summary(flows),
+        "steps": {name: latency_summary(values) for name, values in sorted(steps.items())},
+        "marks": {name: latency_summary(values) for name, values in sorted(marks.items())},
+    }
+
+
+def run_config(app: str, workers: int, threads: int, standin: Standin, args) -> dict:
+    server_kind = "hypercorn" if app in ASGI_APPS else args.server
+    server = Server(app, workers, threads, standin.url, server_kind)
+    try:
+        server.wait_ready()
+        drive(app, server.url, args.users, args.warmup, args)
+        rss_start = server.rss_mb()
+        standin.reset_peak()
+        result = drive(app, server.url, args.users, args.duration, args)
+        upstream_peak = standin.reset_peak()
+        rss_end = server.rss_mb()
+    finally:
+        server.stop()
+    result.update({
+        "app": app,
+        "server": server_kind,
+        "workers": workers,
+        "threads": threads,
+        "users": args.users,
+        "upstream_peak_in_flight": upstream_peak,
+        "rss_mb": {
+            "after_warmup": rss_start,
+            "end": rss_end,
+            "growth": round(rss_end - rss_start, 1) if rss_start is not None and rss_end is not None else None,
+        },
+    })
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict) -> list:
+    """One line per (app, config) present in both runs."""
+    def key(r):
+        return r["app"], r["server"], r["workers"], r["threads"], r["users"]
+
+    before = {key(r): r for r in baseline["results"]}
+    lines = []
+    for r in current["results"]:
+        old = before.get(key(r))
+        if old is None:
+            continue
+
+        def change(new, was):
+            return f"{(new - was) / was * 100:+.1f}%" if was else "n/a"
+
+        lines.append(
+            f"{r['app']:<10} {r['workers']}x{r['threads']} users={r['users']}: "
+            f"rps {old['requests_per_second']} -> {r['requests_per_second']} "
+            f"({change(r['requests_per_second'], old['requests_per_second'])}), "
+            f"p95 {old['latency']['p95_ms']} -> {r['latency']['p95_ms']} ms "
+            f"({change(r['latency']['p95_ms'], old['latency']['p95_ms'])}), "
+            f"p99 {old['latency']['p99_ms']} -> {r['latency']['p99_ms']} ms"
+        )
+    return lines
+
+
+def run(args) -> dict:
+    standin = Standin(args.upstream_latency, error_rate=args.upstream_error_rate, seed=args.seed).start()
+    random.seed(args.seed)
+    results = []
+    try:
+        for app in args.apps:
+            for workers, threads in args.configs:
+                results.append(run_config(app, workers, threads, standin, args))
+                print(f"{app} {workers}x{threads}: {results[-1]['requests_per_second']} req/s, "
+                      f"p95 {results[-1]['latency']['p95_ms']} ms", file=sys.stderr)
+    finally:
+        upstream = standin.stats()
+        standin.stop()
+    return {
+        "benchmark": "payment_flow",
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "users": args.users,
+            "upstream_latency": args.upstream_latency,
+            "upstream_error_rate": args.upstream_error_rate,
+        },
+        "upstream_requests": upstream,
+        "results": results,
+    }
+
+
+def parse_configs(value: str) -> list:
+    configs = []
+    for item in value.split(","):
+        workers, _, threads = item.strip().lower().partition("x")
+        configs.append((int(workers), int(threads or 1)))
+    return configs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--apps", type=lambda v: v.split(","), default=list(APPS),
+                        help=f"comma-separated, from {', '.join(APPS)}")
+    parser.add_argument("--configs", type=parse_configs, default=[(1, 4), (2, 4)],
+                        help="gunicorn WORKERSxTHREADS list, e.g. 1x1,2x4,4x8")
+    parser.add_argument("--server", choices=("gunicorn", "werkzeug"), default="gunicorn")
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds per config")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="mean stand-in delay in seconds")
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--poll-timeout", type=float, default=15.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the JSON report here")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    args = parser.parse_args(argv)
+    for app in args.apps:
+        if app not in APPS:
+            parser.error(f"unknown app {app!r}")
+
+    report = run(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare(json.load(f), report)))
+
+
+if __name__ == "__main__":
+    main()
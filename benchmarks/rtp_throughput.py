@@ -0,0 +1,62 @@
+"""Measure rtp_sim throughput and peak memory across chunk sizes.
+
+Peak memory is traced with ``tracemalloc`` (NumPy reports its buffers to
+it), so it shows whether a run stays flat as ``--plays`` grows.
+
+Example::
+
+    python benchmarks/rtp_throughput.py --plays 100000000 --chunks 65536,1048576,4194304
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(args) -> list:
+    import rtp_sim
+
+    prizes, weights = rtp_sim.TABLES[args.table]
+    results = []
+    for chunk in args.chunks:
+        tracemalloc.start()
+        started = time.perf_counter()
+        report = rtp_sim.run(prizes, weights, args.entry_fee, args.plays, args.plays_per_day, args.days,
+                             args.bankroll, chunk=chunk, seed=args.seed)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append({
+            "table": args.table,
+            "chunk": chunk,
+            "plays": args.plays,
+            "days": args.days,
+            "seconds": round(elapsed, 3),
+            "plays_per_second": report["plays_per_second"],
+            "peak_mb": round(peak / 1e6, 1),
+            "rtp": report["rtp"]["rtp"] if "rtp" in report else None,
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--table", choices=("wheel", "boxes"), default="boxes")
+    parser.add_argument("--entry-fee", type=int, default=50)
+    parser.add_argument("--plays", type=int, default=50_000_000)
+    parser.add_argument("--plays-per-day", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=5000)
+    parser.add_argument("--bankroll", type=float, default=5000)
+    parser.add_argument("--chunks", type=lambda v: [int(x) for x in v.split(",")],
+                        default=[1 << 16, 1 << 20, 1 << 22], help="comma-separated chunk sizes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
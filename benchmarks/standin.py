@@ -0,0 +1,215 @@
+"""Local stand-ins for the Daraja and Flutterwave APIs.
+
+Just enough of each API for the apps' outbound calls to succeed (OAuth
+token, STK Push, STK Push Query, B2C, Flutterwave payments and verify),
+with a configurable response delay and injected error rate so benchmarks
+can see how upstream latency shows up in the apps.
+
+Point an app at it with ``MPESA_BASE_URL`` / ``FLW_BASE_URL``::
+
+    python benchmarks/standin.py --port 9000 --latency 0.2 --error-rate 0.05
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._serve()
+
+    def do_POST(self):
+        self._serve()
+
+    def _serve(self):
+        standin = self.server.standin
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        url = urlsplit(self.path)
+        route = standin.routes.get(url.path)
+        standin.enter()
+        try:
+            standin.delay()
+        finally:
+            standin.leave()
+        if route is None:
+            status, payload = 404, {"errorMessage": f"No stand-in for {url.path}"}
+        elif standin.inject_error():
+            status, payload = 503, {"errorCode": "503.001.01", "errorMessage": "Stand-in injected error"}
+        else:
+            status, payload = route(body, parse_qs(url.query))
+        standin.count(url.path, status)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 refuses connections under a few hundred users
+    request_queue_size = 1024
+
+
+class Standin:
+    """Threaded HTTP server answering like Daraja and Flutterwave.
+
+    ``latency`` is the mean delay per request in seconds (uniformly spread
+    by ``jitter``); ``error_rate`` is the share of requests answered 503.
+    An STK Push reads as still processing to STK Query for
+    ``settle_after`` seconds, then as paid.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.5, error_rate: float = 0.0,
+                 settle_after: float = 1.0, host: str = "127.0.0.1", port: int = 0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.settle_after = settle_after
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._checkouts = {}
+        self.counts = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.routes = {
+            "/oauth/v1/generate": self._oauth,
+            "/mpesa/stkpush/v1/processrequest": self._stk_push,
+            "/mpesa/stkpushquery/v1/query": self._stk_query,
+            "/mpesa/b2c/v1/paymentrequest": self._b2c,
+            "/v3/payments": self._flw_payment,
+            "/v3/transactions/verify_by_reference": self._flw_verify,
+        }
+        self._server = _Server((host, port), _Handler)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "Standin":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def delay(self) -> None:
+        if self.latency > 0:
+            with self._lock:
+                spread = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            time.sleep(self.latency * spread)
+
+    def enter(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def reset_peak(self) -> int:
+        """Highest number of requests held at once since the last reset."""
+        with self._lock:
+            peak, self.peak_in_flight = self.peak_in_flight, self.in_flight
+            return peak
+
+    def inject_error(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def count(self, path: str, status: int) -> None:
+        key = f"{path} {status}"
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(sorted(self.counts.items()))
+
+    # -- routes: (body, query) -> (status, payload) -------------------------
+
+    def _oauth(self, body, query):
+        return 200, {"access_token": "standin-token", "expires_in": "3599"}
+
+    def _stk_push(self, body, query):
+        n = next(self._ids)
+        checkout_id = f"ws_CO_STANDIN_{n:010d}"
+        with self._lock:
+            self._checkouts[checkout_id] = time.time()
+        return 200, {
+            "MerchantRequestID": f"{n}-standin-1",
+            "CheckoutRequestID": checkout_id,
+            "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing",
+            "CustomerMessage": "Success. Request accepted for processing",
+        }
+
+    def _stk_query(self, body, query):
+        with self._lock:
+            started = self._checkouts.get(body.get("CheckoutRequestID"))
+        if started is None:
+            return 400, {"errorCode": "400.002.02", "errorMessage": "Bad Request - Invalid CheckoutRequestID"}
+        if time.time() - started < self.settle_after:
+            return 500, {"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"}
+        return 200, {"ResponseCode": "0", "ResultCode": "0",
+                     "ResultDesc": "The service request is processed successfully."}
+
+    def _b2c(self, body, query):
+        n = next(self._ids)
+        return 200, {
+            "ConversationID": f"AG_STANDIN_{n:010d}",
+            "OriginatorConversationID": body.get("OriginatorConversationID") or f"{n}-standin-1",
+            "ResponseCode": "0",
+            "ResponseDescription": "Accept the service request successfully.",
+        }
+
+    def _flw_payment(self, body, query):
+        return 200, {"status": "success", "data": {"link": f"{self.url}/checkout/{body.get('tx_ref')}"}}
+
+    def _flw_verify(self, body, query):
+        tx_ref = (query.get("tx_ref") or [""])[0]
+        return 200, {"status": "success", "data": {"tx_ref": tx_ref, "status": "successful"}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response delay in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--settle-after", type=float, default=1.0)
+    args = parser.parse_args(argv)
+    standin = Standin(args.latency, error_rate=args.error_rate, settle_after=args.settle_after, port=args.port).start()
+    print(f"Stand-in listening on {standin.url}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(json.dumps(standin.stats(), indent=2))
+        standin.stop()
+
+
+if __name__ == "__main__":
+    main()
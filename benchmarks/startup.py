@@ -0,0 +1,244 @@
+"""Measure cold start and first-request latency of each app entry point.
+
+Every gunicorn worker imports its app on boot and again when it is
+respawned, so import time is paid per worker, not once per deploy. For
+each of ``wsgi`` (``app.py``), ``app_auto`` and ``app_simple`` this runs
+``--runs`` fresh interpreters, each with its own temporary store, ledger
+and metrics directory, and reports the median, min and max of:
+
+- ``cold_start``: process spawn -> app module imported
+- ``first_request``: process spawn -> first ``GET /`` answered (Flask test
+  client, so no server or socket time)
+- ``import`` / ``first_request_only`` / ``second_request``: the same split
+  up inside the process
+
+One more run under ``python -X importtime`` breaks the import down: the
+entry module's direct imports and the packages with the most import time
+of their own. ``provider_modules`` lists which provider libraries
+(``requests``, ``httpx``, ``twilio``...) were loaded after import and after
+the first request; with lazy providers (see providers.py) none are.
+
+``--gunicorn`` also times launch -> first 200 on ``/`` for one gunicorn
+worker. Bytecode caches are warmed by an untimed first run. Save a run with
+``--out`` and compare a later one with ``--compare``::
+
+    python benchmarks/startup.py --runs 10 --out startup.json
+    python benchmarks/startup.py --runs 10 --compare startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import requests
+
+from payment_flow import ROOT, Server, git_commit
+
+ENTRIES = ("wsgi", "app_auto", "app_simple")
+
+PROVIDER_MODULES = ("requests", "httpx", "twilio", "dotenv", "asyncio", "mpesa", "flutterwave_pay", "sms")
+
+_CHILD = (
+    "import json, sys, time\n"
+    "started = time.time()\n"
+    "module = __import__(sys.argv[1])  # importlib.import_module is not logged by -X importtime\n"
+    "imported = time.time()\n"
+    "loaded = [m for m in sys.argv[2:] if m in sys.modules]\n"
+    "client = module.app.test_client()\n"
+    "status = client.get('/').status_code\n"
+    "first = time.time()\n"
+    "client.get('/')\n"
+    "second = time.time()\n"
+    "print(json.dumps({'started': started, 'imported': imported, 'first': first, 'second': second,\n"
+    "                  'status': status, 'loaded_after_import': loaded,\n"
+    "                  'loaded_after_request': [m for m in sys.argv[2:] if m in sys.modules]}))\n"
+)
+
+
+def _env(tmp: str) -> dict:
+    return dict(
+        os.environ,
+        PAYMENT_STORE="sqlite",
+        PAYMENT_DB_PATH=os.path.join(tmp, "payments.db"),
+        RATE_LIMIT_DB_PATH=os.path.join(tmp, "ratelimit.db"),
+        LEDGER_DIR=os.path.join(tmp, "ledger"),
+        METRICS_DIR=os.path.join(tmp, "metrics"),
+        SECRET_KEY="bench",
+    )
+
+
+def _spawn(entry: str, importtime: bool = False):
+    """Run one fresh interpreter; returns (parsed child output, spawn time, stderr)."""
+    tmp = tempfile.mkdtemp(prefix=f"startup-{entry}-")
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", _CHILD, entry, *PROVIDER_MODULES]
+    try:
+        spawned = time.time()
+        proc = subprocess.run(cmd, cwd=ROOT, env=_env(tmp), capture_output=True, text=True, timeout=120)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{entry} failed to start:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1]), spawned, proc.stderr
+
+
+def summary(values: list) -> dict:
+    return {
+        "p50_ms": round(statistics.median(values), 1),
+        "min_ms": round(min(values), 1),
+        "max_ms": round(max(values), 1),
+    }
+
+
+def parse_importtime(stderr: str, entry: str, top: int = 10) -> dict:
+    """Total, direct imports and heaviest packages of ``entry`` from ``-X importtime`` output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((depth, name.strip(), int(self_us), int(cumulative_us)))
+
+    # children are printed before their parent; the entry is a depth-0 row
+    total, direct, pending, start = 0, [], [], 0
+    for i, (depth, name, _, cumulative) in enumerate(rows):
+        if depth == 1:
+            pending.append((name, cumulative))
+        elif depth == 0:
+            if name == entry:
+                total, direct = cumulative, pending
+                break
+            pending, start = [], i + 1
+    packages = {}
+    for depth, name, self_us, _ in rows[start:i + 1]:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return {
+        "total_ms": round(total / 1000, 1),
+        "direct": [{"module": name, "ms": round(us / 1000, 1)}
+                   for name, us in sorted(direct, key=lambda item: -item[1])[:top]],
+        "packages": [{"package": name, "self_ms": round(us / 1000, 1)}
+                     for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]],
+    }
+
+
+def gunicorn_ready_ms(entry: str, timeout: float = 60.0) -> float:
+    """Launch one gunicorn worker and time it until ``/`` answers 200."""
+    started = time.time()
+    server = Server(entry, 1, 4, "http://127.0.0.1:9")
+    try:
+        deadline = started + timeout
+        while time.time() < deadline:
+            if server.proc.poll() is not None:
+                break
+            try:
+                if requests.get(server.url + "/", timeout=1).status_code == 200:
+                    return (time.time() - started) * 1000
+            except requests.RequestException:
+                pass
+            time.sleep(0.01)
+    finally:
+        server.stop()
+        shutil.rmtree(server.tmp, ignore_errors=True)
+    raise RuntimeError(f"{entry} did not answer under gunicorn within {timeout}s")
+
+
+def run_entry(entry: str, args) -> dict:
+    _spawn(entry)  # untimed: compiles bytecode caches
+    timings = {"cold_start": [], "first_request": [], "import": [], "first_request_only": [], "second_request": []}
+    for _ in range(args.runs):
+        out, spawned, _ = _spawn(entry)
+        timings["cold_start"].append((out["imported"] - spawned) * 1000)
+        timings["first_request"].append((out["first"] - spawned) * 1000)
+        timings["import"].append((out["imported"] - out["started"]) * 1000)
+        timings["first_request_only"].append((out["first"] - out["imported"]) * 1000)
+        timings["second_request"].append((out["second"] - out["first"]) * 1000)
+    profile, _, stderr = _spawn(entry, importtime=True)
+    result = {
+        "entry": entry,
+        "runs": args.runs,
+        "status": out["status"],
+        **{name: summary(values) for name, values in timings.items()},
+        "importtime": parse_importtime(stderr, entry, args.top),
+        "provider_modules": {
+            "after_import": profile["loaded_after_import"],
+            "after_first_request": profile["loaded_after_request"],
+        },
+    }
+    if args.gunicorn:
+        result["gunicorn_ready"] = summary([gunicorn_ready_ms(entry) for _ in range(args.gunicorn_runs)])
+    return result
+
+
+def compare(baseline: dict, current: dict) -> list:
+    """One line per entry present in both runs."""
+    before = {r["entry"]: r for r in baseline["results"]}
+    lines = []
+    for r in current["results"]:
+        old = before.get(r["entry"])
+        if old is None:
+            continue
+        parts = []
+        for name in ("cold_start", "first_request", "gunicorn_ready"):
+            if name in r and name in old:
+                was, new = old[name]["p50_ms"], r[name]["p50_ms"]
+                change = f"{(new - was) / was * 100:+.1f}%" if was else "n/a"
+                parts.append(f"{name} {was} -> {new} ms ({change})")
+        lines.append(f"{r['entry']:<10} " + ", ".join(parts))
+    return lines
+
+
+def run(args) -> dict:
+    results = []
+    for entry in args.entries:
+        results.append(run_entry(entry, args))
+        r = results[-1]
+        print(f"{entry}: cold start {r['cold_start']['p50_ms']} ms, first request {r['first_request']['p50_ms']} ms, "
+              f"imports {r['importtime']['total_ms']} ms, providers loaded {r['provider_modules']['after_import']}",
+              file=sys.stderr)
+    return {
+        "benchmark": "startup",
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"runs": args.runs, "gunicorn": args.gunicorn},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=lambda v: v.split(","), default=list(ENTRIES),
+                        help=f"comma-separated, from {', '.join(ENTRIES)}")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per entry point")
+    parser.add_argument("--top", type=int, default=10, help="modules and packages listed from -X importtime")
+    parser.add_argument("--gunicorn", action="store_true", help="also time gunicorn launch -> first 200")
+    parser.add_argument("--gunicorn-runs", type=int, default=3)
+    parser.add_argument("--out", help="write the JSON report here")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    args = parser.parse_args(argv)
+    for entry in args.entries:
+        if entry not in ENTRIES:
+            parser.error(f"unknown entry point {entry!r}")
+
+    report = run(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare(json.load(f), report)))
+
+
+if __name__ == "__main__":
+    main()
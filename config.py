@@ -8,14 +8,27 @@ secrets manager.
 from pathlib import Path
 import os
 
-try:
-	# optional dependency: if present, load a .env file
-	from dotenv import load_dotenv
+
+def _find_env_file() -> Path | None:
+	# what load_dotenv() would find: config.env, else the nearest .env
+	# going up from this directory. Looking first means deployments without
+	# one (settings in the environment) never import dotenv.
 	env_path = Path(__file__).with_suffix('.env')
-	if env_path.exists():
+	if env_path.is_file():
+		return env_path
+	here = Path(__file__).resolve().parent
+	for directory in (here, *here.parents):
+		if (directory / '.env').is_file():
+			return directory / '.env'
+	return None
+
+
+try:
+	env_path = _find_env_file()
+	if env_path is not None:
+		# optional dependency: if present, load the .env file
+		from dotenv import load_dotenv
 		load_dotenv(env_path)
-	else:
-		load_dotenv()
 except Exception:
 	# dotenv not installed or failed — environment variables will be used
 	pass
@@ -35,13 +48,129 @@ TWILIO_SID = _get_env("TWILIO_SID")
 TWILIO_TOKEN = _get_env("TWILIO_TOKEN")
 TWILIO_NUMBER = _get_env("TWILIO_NUMBER")
 
+# Bulk SMS (see sms.send_bulk_sms): messages per second and sender threads
+SMS_RATE = float(_get_env("SMS_RATE", "10"))
+SMS_WORKERS = int(_get_env("SMS_WORKERS", "8"))
+
 # M-Pesa settings (optional)
 MPESA_SHORTCODE = _get_env("MPESA_SHORTCODE")
 MPESA_PASSKEY = _get_env("MPESA_PASSKEY")
 MPESA_CONSUMER_KEY = _get_env("MPESA_CONSUMER_KEY")
 MPESA_CONSUMER_SECRET = _get_env("MPESA_CONSUMER_SECRET")
 CALLBACK_URL = _get_env("CALLBACK_URL")
+# Secret path segment appended to CALLBACK_URL; /callback/<token> refuses any
+# other token, and every callback when this is unset (STK Query still settles)
+CALLBACK_TOKEN = _get_env("CALLBACK_TOKEN")
+# Daraja API root (sandbox by default; also points the benchmarks at a stand-in)
+MPESA_BASE_URL = _get_env("MPESA_BASE_URL", "https://sandbox.safaricom.co.ke")
+
+# M-Pesa B2C payouts (optional; payouts are simulated unless all are set)
+MPESA_B2C_SHORTCODE = _get_env("MPESA_B2C_SHORTCODE")
+MPESA_B2C_INITIATOR = _get_env("MPESA_B2C_INITIATOR")
+MPESA_B2C_SECURITY_CREDENTIAL = _get_env("MPESA_B2C_SECURITY_CREDENTIAL")
+MPESA_B2C_RESULT_URL = _get_env("MPESA_B2C_RESULT_URL")
+MPESA_B2C_TIMEOUT_URL = _get_env("MPESA_B2C_TIMEOUT_URL", MPESA_B2C_RESULT_URL)
 
 # Convenience booleans
 USE_TWILIO = bool(TWILIO_SID and TWILIO_TOKEN and TWILIO_NUMBER)
 USE_MPESA = bool(MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET and MPESA_PASSKEY)
+USE_MPESA_B2C = bool(MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET and MPESA_B2C_SHORTCODE
+                     and MPESA_B2C_INITIATOR and MPESA_B2C_SECURITY_CREDENTIAL and MPESA_B2C_RESULT_URL)
+
+# Payment store: "sqlite" (shared by all gunicorn workers) or "memory"
+PAYMENT_STORE = _get_env("PAYMENT_STORE", "sqlite")
+PAYMENT_DB_PATH = _get_env("PAYMENT_DB_PATH", "payments.db")
+
+# /pay admission control (see rate_limit.py): "<count>/<seconds>", "0" disables.
+# "sqlite" shares buckets across gunicorn workers; "memory" is per-process.
+RATE_LIMIT_BACKEND = _get_env("RATE_LIMIT_BACKEND", "sqlite")
+RATE_LIMIT_DB_PATH = _get_env("RATE_LIMIT_DB_PATH", "ratelimit.db")
+# Reverse proxies in front of the app that append to X-Forwarded-For; 0 ignores
+# the header (a client can send any value), 1 behind a single proxy such as Render's
+RATE_LIMIT_TRUST_PROXY = int(_get_env("RATE_LIMIT_TRUST_PROXY", "0"))
+PAY_LIMIT_PER_PHONE = _get_env("PAY_LIMIT_PER_PHONE", "5/300")
+PAY_LIMIT_PER_IP = _get_env("PAY_LIMIT_PER_IP", "20/60")
+PAY_LIMIT_GLOBAL = _get_env("PAY_LIMIT_GLOBAL", "50/1")
+
+# Seconds during which a repeat /pay from the same phone returns the
+# payment still open for it instead of creating another
+PAY_IDEMPOTENCY_WINDOW = float(_get_env("PAY_IDEMPOTENCY_WINDOW", "120"))
+
+# Rendered page cache (see page_cache.py): entries per worker, browser
+# max-age for shared pages, and how often config/templates are re-checked
+PAGE_CACHE_MAX_ENTRIES = int(_get_env("PAGE_CACHE_MAX_ENTRIES", "1000"))
+PAGE_CACHE_MAX_AGE = int(_get_env("PAGE_CACHE_MAX_AGE", "300"))
+PAGE_CACHE_CHECK_INTERVAL = float(_get_env("PAGE_CACHE_CHECK_INTERVAL", "2"))
+
+# Payment expiry and archiving (see payment_expiry.py), in seconds:
+# open payments expire after PAYMENT_TTL; finished ones move to the
+# archive ledger after PAYMENT_ARCHIVE_AFTER (0 keeps them)
+PAYMENT_TTL = float(_get_env("PAYMENT_TTL", "1800"))
+PAYMENT_ARCHIVE_AFTER = float(_get_env("PAYMENT_ARCHIVE_AFTER", str(7 * 86400)))
+PAYMENT_SWEEP_INTERVAL = float(_get_env("PAYMENT_SWEEP_INTERVAL", "60"))
+
+# Status queries for open payments (see reconcile.py): first Daraja/Flutterwave
+# query FIRST_POLL seconds after the push, then backing off to MAX_INTERVAL.
+# Final answers are cached for STATUS_CACHE_TTL, "not yet"/errors for
+# STATUS_CACHE_NEGATIVE_TTL.
+RECONCILE_FIRST_POLL = float(_get_env("RECONCILE_FIRST_POLL", "15"))
+RECONCILE_MAX_INTERVAL = float(_get_env("RECONCILE_MAX_INTERVAL", "120"))
+RECONCILE_BATCH_SIZE = int(_get_env("RECONCILE_BATCH_SIZE", "20"))
+RECONCILE_CONCURRENCY = int(_get_env("RECONCILE_CONCURRENCY", "4"))
+STATUS_CACHE_TTL = float(_get_env("STATUS_CACHE_TTL", "3600"))
+STATUS_CACHE_NEGATIVE_TTL = float(_get_env("STATUS_CACHE_NEGATIVE_TTL", "5"))
+
+# Metrics (see metrics.py): each worker writes its values to METRICS_DIR
+# every METRICS_FLUSH_INTERVAL seconds for /metrics; files of exited
+# workers are dropped after METRICS_RETENTION seconds
+METRICS_DIR = _get_env("METRICS_DIR", "metrics")
+METRICS_FLUSH_INTERVAL = float(_get_env("METRICS_FLUSH_INTERVAL", "5"))
+METRICS_RETENTION = float(_get_env("METRICS_RETENTION", "3600"))
+
+# Outbound HTTP: connections kept per provider host (match gunicorn --threads)
+HTTP_POOL_SIZE = int(_get_env("HTTP_POOL_SIZE", "4"))
+HTTP_MAX_RETRIES = int(_get_env("HTTP_MAX_RETRIES", "2"))
+
+# Async serving mode (app_async.py): connections per provider host for the
+# event loop's client, and STK pushes one worker may have waiting on Daraja
+HTTP_ASYNC_POOL_SIZE = int(_get_env("HTTP_ASYNC_POOL_SIZE", "100"))
+ASYNC_MAX_IN_FLIGHT = int(_get_env("ASYNC_MAX_IN_FLIGHT", "500"))
+
+# Payment routing (see payment_router.py): providers new payments may use,
+# in order of preference (Flutterwave only when its keys are set). A
+# provider's breaker opens when, over PAYMENT_ROUTE_WINDOW seconds and at
+# least PAYMENT_BREAKER_MIN_CALLS calls, its error rate or p95 latency
+# reaches the limit, and lets a probe through after PAYMENT_BREAKER_COOLDOWN.
+# PAYMENT_HEDGE_AFTER > 0 starts the next provider when the first has not
+# answered after that many seconds (0 = off).
+PAYMENT_PROVIDERS = _get_env("PAYMENT_PROVIDERS", "daraja,flutterwave")
+PAYMENT_ROUTE_WINDOW = float(_get_env("PAYMENT_ROUTE_WINDOW", "60"))
+PAYMENT_BREAKER_MIN_CALLS = int(_get_env("PAYMENT_BREAKER_MIN_CALLS", "5"))
+PAYMENT_BREAKER_ERROR_RATE = float(_get_env("PAYMENT_BREAKER_ERROR_RATE", "0.5"))
+PAYMENT_BREAKER_SLOW_SECONDS = float(_get_env("PAYMENT_BREAKER_SLOW_SECONDS", "8"))
+PAYMENT_BREAKER_COOLDOWN = float(_get_env("PAYMENT_BREAKER_COOLDOWN", "30"))
+PAYMENT_HEDGE_AFTER = float(_get_env("PAYMENT_HEDGE_AFTER", "0"))
+
+# Background dispatch of STK pushes (see stk_dispatch.py). DISPATCH_MAX_IN_FLIGHT
+# caps payment starts in flight per worker, whichever provider the router picks.
+# Keep HTTP_POOL_SIZE >= DISPATCH_MAX_IN_FLIGHT so workers never wait on a socket.
+DISPATCH_WORKERS = int(_get_env("DISPATCH_WORKERS", "4"))
+DISPATCH_MAX_QUEUE = int(_get_env("DISPATCH_MAX_QUEUE", "100"))
+DISPATCH_MAX_IN_FLIGHT = int(_get_env("DISPATCH_MAX_IN_FLIGHT", "4"))
+
+# Ledger (JSON-lines event files, see ledger.py)
+LEDGER_DIR = _get_env("LEDGER_DIR", "ledger")
+LEDGER_MAX_BYTES = int(_get_env("LEDGER_MAX_BYTES", str(10 * 1024 * 1024)))
+LEDGER_ROTATE_SECONDS = float(_get_env("LEDGER_ROTATE_SECONDS", "86400"))
+LEDGER_FLUSH_INTERVAL = float(_get_env("LEDGER_FLUSH_INTERVAL", "1.0"))
+LEDGER_FSYNC_INTERVAL = float(_get_env("LEDGER_FSYNC_INTERVAL", "5.0"))
+
+# Winner payouts (see payouts.py): batching, concurrency and B2C rate
+PAYOUT_BATCH_SIZE = int(_get_env("PAYOUT_BATCH_SIZE", "20"))
+PAYOUT_LINGER = float(_get_env("PAYOUT_LINGER", "0.5"))
+PAYOUT_WORKERS = int(_get_env("PAYOUT_WORKERS", "2"))
+PAYOUT_RATE = float(_get_env("PAYOUT_RATE", "5"))
+PAYOUT_MAX_QUEUE = int(_get_env("PAYOUT_MAX_QUEUE", "1000"))
+PAYOUT_MAX_ATTEMPTS = int(_get_env("PAYOUT_MAX_ATTEMPTS", "3"))
+# Prizes above this many KES wait for an admin to approve them (0 = approve every payout)
+PAYOUT_AUTO_APPROVE_MAX = int(_get_env("PAYOUT_AUTO_APPROVE_MAX", "0"))
@@ -3,8 +3,10 @@
 Flutterwave supports M-Pesa, cards, mobile money, and more.
 Get your API keys from https://dashboard.flutterwave.com/
 """
-import requests
+import http_client
+import ledger
 import logging
+import metrics
 from typing import Optional
 from config import ENTRY_FEE
 import os
@@ -15,38 +17,43 @@ logger = logging.getLogger(__name__)
 FLW_PUBLIC_KEY = os.getenv('FLW_PUBLIC_KEY', '')
 FLW_SECRET_KEY = os.getenv('FLW_SECRET_KEY', '')
 FLW_ENCRYPTION_KEY = os.getenv('FLW_ENCRYPTION_KEY', '')
+FLW_BASE_URL = os.getenv('FLW_BASE_URL', 'https://api.flutterwave.com').rstrip('/')
+# Where Flutterwave sends the customer after paying (the app's /payment/callback)
+FLW_REDIRECT_URL = os.getenv('FLW_REDIRECT_URL', 'http://127.0.0.1:5000/payment/callback')
+# Customer email for checkouts started without one (payment_router.py fallback)
+FLW_CUSTOMER_EMAIL = os.getenv('FLW_CUSTOMER_EMAIL', 'payments@oddsmtaani.com')
 
 
-def create_payment(phone: str, email: str, amount: int = ENTRY_FEE) -> dict:
-    """Create a Flutterwave payment.
-    
-    Returns dict with:
-    - link: Payment URL to redirect user to
-    - tx_ref: Transaction reference
-    - simulated: True if simulated
-    """
+def configured() -> bool:
+    """Whether real Flutterwave keys are set (otherwise payments are simulated)."""
+    return bool(FLW_SECRET_KEY and FLW_PUBLIC_KEY)
+
+
+def _simulated(phone: str, email: str, amount: int, tx_ref: Optional[str] = None) -> Optional[dict]:
     # If no keys configured, simulate
-    if not FLW_SECRET_KEY or not FLW_PUBLIC_KEY:
-        logger.info("Flutterwave not configured. Simulating payment...")
-        tx_ref = f"SIM-{phone}-{amount}"
-        with open("simulated_payments.log", "a", encoding="utf-8") as f:
-            f.write(f"Payment SIMULATED: Phone={phone} Email={email} Amount={amount} TxRef={tx_ref}\n")
-        return {
-            'simulated': True,
-            'tx_ref': tx_ref,
-            'link': None,
-            'message': f'Payment simulated successfully! Ref: {tx_ref}'
-        }
-    
-    # Real Flutterwave payment
-    url = "https://api.flutterwave.com/v3/payments"
-    tx_ref = f"ODM-{phone}-{amount}"
+    if configured():
+        return None
+    logger.info("Flutterwave not configured. Simulating payment...")
+    tx_ref = f"SIM-{tx_ref or f'{phone}-{amount}'}"
+    ledger.get_ledger("simulated").append("payment_simulated", phone=phone, email=email, amount=amount, tx_ref=tx_ref)
+    return {
+        'simulated': True,
+        'tx_ref': tx_ref,
+        'link': None,
+        'message': f'Payment simulated successfully! Ref: {tx_ref}'
+    }
+
+
+def _payment_request(phone: str, email: str, amount: int, tx_ref: Optional[str] = None):
+    """(url, tx_ref, payload, headers) for a hosted payment."""
+    url = f"{FLW_BASE_URL}/v3/payments"
+    tx_ref = tx_ref or f"ODM-{phone}-{amount}"
     
     payload = {
         "tx_ref": tx_ref,
         "amount": str(amount),
         "currency": "KES",
-        "redirect_url": "http://127.0.0.1:5000/payment/callback",
+        "redirect_url": FLW_REDIRECT_URL,
         "payment_options": "mpesa,card,mobilemoney",
         "customer": {
             "email": email,
@@ -64,48 +71,119 @@ def create_payment(phone: str, email: str, amount: int = ENTRY_FEE) -> dict:
         "Authorization": f"Bearer {FLW_SECRET_KEY}",
         "Content-Type": "application/json"
     }
+    return url, tx_ref, payload, headers
+
+
+def _payment_result(r, tx_ref: str) -> dict:
+    logger.info(f"Flutterwave response status: {r.status_code}")
+    logger.info(f"Flutterwave response: {r.text}")
+    r.raise_for_status()
+    data = r.json()
+    
+    if data.get('status') == 'success':
+        return {
+            'simulated': False,
+            'tx_ref': tx_ref,
+            'link': data['data']['link'],
+            'message': 'Payment initiated successfully!'
+        }
+    else:
+        logger.error(f"Flutterwave error: {data}")
+        return {'simulated': False, 'tx_ref': None, 'link': None, 'message': 'Payment failed'}
+
+
+@metrics.timed_call("flutterwave.create_payment")
+def create_payment(phone: str, email: str, amount: int = ENTRY_FEE, tx_ref: Optional[str] = None) -> dict:
+    """Create a Flutterwave payment.
+    
+    ``tx_ref`` defaults to one made from phone and amount; pass the
+    payment_id so the redirect and status queries resolve to it.
+
+    Returns dict with:
+    - link: Payment URL to redirect user to
+    - tx_ref: Transaction reference
+    - simulated: True if simulated
+    """
+    simulated = _simulated(phone, email, amount, tx_ref)
+    if simulated:
+        return simulated
     
+    # Real Flutterwave payment
+    url, tx_ref, payload, headers = _payment_request(phone, email, amount, tx_ref)
     try:
         logger.info(f"Creating Flutterwave payment for {phone}")
-        r = requests.post(url, json=payload, headers=headers, timeout=15)
-        logger.info(f"Flutterwave response status: {r.status_code}")
-        logger.info(f"Flutterwave response: {r.text}")
-        r.raise_for_status()
-        data = r.json()
-        
-        if data.get('status') == 'success':
-            return {
-                'simulated': False,
-                'tx_ref': tx_ref,
-                'link': data['data']['link'],
-                'message': 'Payment initiated successfully!'
-            }
-        else:
-            logger.error(f"Flutterwave error: {data}")
-            return {'simulated': False, 'tx_ref': None, 'link': None, 'message': 'Payment failed'}
+        r = http_client.post(url, endpoint="flutterwave.payments", json=payload, headers=headers)
+        return _payment_result(r, tx_ref)
     except Exception as e:
         logger.exception(f"Flutterwave payment failed: {e}")
         return {'simulated': False, 'tx_ref': None, 'link': None, 'message': f'Error: {e}'}
 
 
-def verify_payment(tx_ref: str) -> bool:
-    """Verify a payment was completed."""
+@metrics.timed_call("flutterwave.create_payment")
+async def create_payment_async(phone: str, email: str, amount: int = ENTRY_FEE, tx_ref: Optional[str] = None) -> dict:
+    """``create_payment`` for the async serving mode (see app_async.py)."""
+    simulated = _simulated(phone, email, amount, tx_ref)
+    if simulated:
+        return simulated
+    url, tx_ref, payload, headers = _payment_request(phone, email, amount, tx_ref)
+    try:
+        r = await http_client.apost(url, endpoint="flutterwave.payments", json=payload, headers=headers)
+        return _payment_result(r, tx_ref)
+    except Exception as e:
+        logger.exception(f"Flutterwave payment failed: {e}")
+        return {'simulated': False, 'tx_ref': None, 'link': None, 'message': f'Error: {e}'}
+
+
+def _verify_request(tx_ref: str):
+    if not FLW_SECRET_KEY:
+        raise RuntimeError("Flutterwave not configured")
+    url = f"{FLW_BASE_URL}/v3/transactions/verify_by_reference"
+    return url, {'tx_ref': tx_ref}, {"Authorization": f"Bearer {FLW_SECRET_KEY}"}
+
+
+def _verify_result(r) -> Optional[str]:
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return (r.json().get('data') or {}).get('status')
+
+
+@metrics.timed_call("flutterwave.verify")
+def query_status(tx_ref: str) -> Optional[str]:
+    """Flutterwave's status for ``tx_ref`` ('successful', 'failed', ...).
+
+    Returns None if Flutterwave has no transaction for it (yet). Raises on
+    transport or API errors; see reconcile.py for the cached wrapper.
+    """
     if tx_ref.startswith('SIM-'):
         logger.info(f"Simulated payment {tx_ref} - auto verified")
-        return True
-    
-    if not FLW_SECRET_KEY:
+        return 'successful'
+    url, params, headers = _verify_request(tx_ref)
+    return _verify_result(http_client.get(url, endpoint="flutterwave.verify", params=params, headers=headers))
+
+
+@metrics.timed_call("flutterwave.verify")
+async def query_status_async(tx_ref: str) -> Optional[str]:
+    """``query_status`` for the async serving mode."""
+    if tx_ref.startswith('SIM-'):
+        return 'successful'
+    url, params, headers = _verify_request(tx_ref)
+    return _verify_result(await http_client.aget(url, endpoint="flutterwave.verify", params=params, headers=headers))
+
+
+def verify_payment(tx_ref: str) -> bool:
+    """Verify a payment was completed."""
+    try:
+        return query_status(tx_ref) == 'successful'
+    except Exception as e:
+        logger.exception(f"Payment verification failed: {e}")
         return False
-    
-    url = f"https://api.flutterwave.com/v3/transactions/verify_by_reference?tx_ref={tx_ref}"
-    headers = {"Authorization": f"Bearer {FLW_SECRET_KEY}"}
-    
+
+
+async def verify_payment_async(tx_ref: str) -> bool:
+    """``verify_payment`` for the async serving mode."""
     try:
-        r = requests.get(url, headers=headers, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        status = data.get('data', {}).get('status')
-        return status == 'successful'
+        return await query_status_async(tx_ref) == 'successful'
     except Exception as e:
         logger.exception(f"Payment verification failed: {e}")
         return False
@@ -1,7 +1,92 @@
 # game.py
+"""Server-side prize engine.
+
+Prizes are decided here, never in the browser:
+
+- ``get_random_prize()`` samples the weighted prize table through a
+  precomputed alias table, so each draw is O(1) and nothing is rebuilt
+- ``deal_boxes()`` issues the mystery-box layout for one paid game; every
+  arrangement of ``BOX_PRIZES`` is generated once at import, so dealing is a
+  single random choice. The layout is stored with the payment and the client
+  only ever sends the box number it picked.
+
+Draws use ``random.SystemRandom`` (the OS CSPRNG) so outcomes cannot be
+predicted from earlier results.
+"""
+import itertools
 import random
 
-def get_random_prize():
-    prizes = [0, 20, 50, 100, 200, 500]
-    weights = [40, 25, 15, 10, 7, 3]
-    return random.choices(prizes, weights=weights)[0]
+PRIZES = [0, 20, 50, 100, 200, 500]
+WEIGHTS = [40, 25, 15, 10, 7, 3]
+
+# Prizes hidden in the five mystery boxes (box_game.html)
+BOX_PRIZES = (50, 100, 200, 300, 0)
+
+_rng = random.SystemRandom()
+
+
+class AliasTable:
+    """Vose's alias method: O(n) setup, O(1) weighted sampling."""
+
+    def __init__(self, values, weights):
+        if len(values) != len(weights) or not values:
+            raise ValueError("values and weights must be non-empty and the same length")
+        total = float(sum(weights))
+        if total <= 0 or any(w < 0 for w in weights):
+            raise ValueError("weights must be non-negative with a positive sum")
+        n = len(values)
+        self.values = list(values)
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            # leftovers are 1.0 up to rounding error
+            self.prob[i] = 1.0
+
+    def sample(self, rng=_rng):
+        i = rng.randrange(len(self.values))
+        return self.values[i] if rng.random() < self.prob[i] else self.values[self.alias[i]]
+
+
+_PRIZE_TABLE = AliasTable(PRIZES, WEIGHTS)
+
+# All 120 orderings of the box prizes
+_BOX_LAYOUTS = tuple(itertools.permutations(BOX_PRIZES))
+
+
+def get_random_prize(rng=_rng):
+    return _PRIZE_TABLE.sample(rng)
+
+
+def deal_boxes(rng=_rng) -> list:
+    """A fresh box layout: ``layout[n - 1]`` is the prize in box ``n``."""
+    return list(rng.choice(_BOX_LAYOUTS))
+
+
+def parse_box(layout, box_number) -> int:
+    """``box_number`` as a 1-based int. Raises ValueError unless it is an exact whole number in range.
+
+    ``int()`` alone would quietly turn a pick of 2.9 into box 2.
+    """
+    if isinstance(box_number, int) and not isinstance(box_number, bool):
+        box = box_number
+    elif isinstance(box_number, str) and box_number.strip().isdigit():
+        box = int(box_number.strip())
+    else:
+        raise ValueError(f"Invalid box number: {box_number!r}")
+    if not 1 <= box <= len(layout):
+        raise ValueError(f"Box number must be between 1 and {len(layout)}")
+    return box
+
+
+def reveal(layout, box_number) -> int:
+    """Prize in ``box_number`` (1-based). Raises ValueError for a bad pick."""
+    return layout[parse_box(layout, box_number) - 1]
@@ -0,0 +1,329 @@
+"""Shared keep-alive HTTP client for outbound provider calls.
+
+Bare ``requests.get/post`` opens a fresh TCP+TLS connection to Safaricom or
+Flutterwave on every call. This module keeps one ``requests.Session`` per
+host with a connection pool sized to the gunicorn thread count, so
+connections are reused across requests in the same worker.
+
+Idempotent calls (GET/HEAD, or anything passed ``idempotent=True``) are
+retried on connection errors and 502/503/504 with jittered exponential
+backoff. STK pushes and payment creation are POSTs and are never retried
+implicitly — a retry there would prompt the customer twice.
+
+Usage::
+
+    import http_client
+    r = http_client.get(url, endpoint="flutterwave.verify", headers=headers)
+
+The async serving mode (app_async.py) uses ``AsyncHTTPClient`` instead:
+the same timeouts, retry policy and metrics on ``httpx.AsyncClient``, so a
+worker waiting on Daraja holds a coroutine rather than a thread::
+
+    r = await http_client.apost(url, endpoint="daraja.stkpush", json=payload)
+
+``requests`` and ``httpx`` are imported when the first session for a host
+is opened, not with this module: pages that never call a provider, and
+workers that have not yet, skip ~100 ms of imports at start-up.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import urlsplit
+
+import config
+import metrics
+
+if TYPE_CHECKING:
+    import httpx
+    import requests
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds per logical endpoint
+ENDPOINT_TIMEOUTS = {
+    "daraja.oauth": (3.05, 10),
+    "daraja.stkpush": (3.05, 15),
+    "daraja.stkquery": (3.05, 10),
+    "daraja.b2c": (3.05, 15),
+    "flutterwave.payments": (3.05, 15),
+    "flutterwave.verify": (3.05, 10),
+}
+DEFAULT_TIMEOUT = (3.05, 10)
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+RETRY_STATUSES = frozenset({502, 503, 504})
+
+
+class _HostPool:
+    def __init__(self, session, size: int):
+        self.session = session
+        self.size = size
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+
+
+class HTTPClient:
+    """Per-host pooled sessions with retry and timeout policy."""
+
+    def __init__(self, pool_size: int = 4, max_retries: int = 2, backoff: float = 0.25):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._pid = os.getpid()
+
+    def _pool(self, host: str) -> _HostPool:
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: sockets belong to the parent
+                self._pools = {}
+                self._pid = os.getpid()
+            pool = self._pools.get(host)
+            if pool is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                pool = self._pools[host] = _HostPool(session, self.pool_size)
+            return pool
+
+    def _sleep_before_retry(self, attempt: int) -> None:
+        # "full jitter": spread retries so workers do not retry in lockstep
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def request(self, method: str, url: str, endpoint: Optional[str] = None, idempotent: Optional[bool] = None, **kwargs) -> "requests.Response":
+        import requests
+
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault("timeout", ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+        host = urlsplit(url).netloc
+        pool = self._pool(host)
+        attempts = 1 + (self.max_retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            with self._lock:
+                pool.in_flight += 1
+                pool.requests += 1
+                pool.peak_in_flight = max(pool.peak_in_flight, pool.in_flight)
+            started = time.perf_counter()
+            status = None
+            try:
+                response = pool.session.request(method, url, **kwargs)
+                status = response.status_code
+            except (requests.ConnectionError, requests.Timeout):
+                with self._lock:
+                    pool.errors += 1
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning("%s %s failed (attempt %d), retrying", method, endpoint or host, attempt + 1)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt + 1 >= attempts:
+                    return response
+                logger.warning("%s %s returned %s (attempt %d), retrying", method, endpoint or host, response.status_code, attempt + 1)
+                response.close()
+            finally:
+                with self._lock:
+                    pool.in_flight -= 1
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint or host,
+                                                 status=metrics.status_class(status))
+            with self._lock:
+                pool.retries += 1
+            self._sleep_before_retry(attempt)
+
+    def get(self, url: str, **kwargs) -> "requests.Response":
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> "requests.Response":
+        return self.request("POST", url, **kwargs)
+
+    def pool_stats(self) -> dict:
+        """Utilisation counters per host, for logging or a metrics endpoint."""
+        with self._lock:
+            return {
+                host: {
+                    "pool_size": p.size,
+                    "in_flight": p.in_flight,
+                    "peak_in_flight": p.peak_in_flight,
+                    "utilisation": p.in_flight / p.size if p.size else 0.0,
+                    "requests": p.requests,
+                    "retries": p.retries,
+                    "errors": p.errors,
+                }
+                for host, p in self._pools.items()
+            }
+
+
+class AsyncHTTPClient:
+    """``HTTPClient`` for coroutines: one pooled ``httpx.AsyncClient`` per host.
+
+    Clients are bound to the event loop that created them, so each loop gets
+    its own; ``aclose()`` closes the running loop's clients and belongs in
+    the app's shutdown hook (Quart ``after_serving``). A forked worker
+    starts with none.
+    """
+
+    def __init__(self, pool_size: int = 100, max_retries: int = 2, backoff: float = 0.25):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._pools = {}  # event loop -> {host: _HostPool}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _pool(self, host: str) -> _HostPool:
+        import asyncio
+
+        try:
+            import httpx
+        except ImportError:  # only needed for the async serving mode
+            raise RuntimeError("httpx is required for async HTTP calls (pip install httpx)") from None
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._pid != os.getpid():
+                # the parent's connections are the parent's to close
+                self._pools, self._pid = {}, os.getpid()
+            pools = self._pools.get(loop)
+            if pools is None:
+                self._forget_closed_loops()
+                pools = self._pools[loop] = {}
+            pool = pools.get(host)
+            if pool is None:
+                limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+                pool = pools[host] = _HostPool(httpx.AsyncClient(limits=limits), self.pool_size)
+        return pool
+
+    def _forget_closed_loops(self) -> None:
+        # caller holds self._lock; a closed loop's clients can no longer be awaited
+        for loop in [l for l in self._pools if l.is_closed()]:
+            if self._pools.pop(loop):
+                logger.warning("Event loop closed without AsyncHTTPClient.aclose(); dropping its connections")
+
+    @staticmethod
+    def _timeout(timeout) -> "httpx.Timeout":
+        import httpx
+
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        # pool: how long to wait for a free connection before giving up
+        return httpx.Timeout(read, connect=connect, pool=connect)
+
+    async def request(self, method: str, url: str, endpoint: Optional[str] = None, idempotent: Optional[bool] = None, **kwargs) -> "httpx.Response":
+        import asyncio
+
+        import httpx
+
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        kwargs["timeout"] = self._timeout(kwargs.get("timeout") or ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+        host = urlsplit(url).netloc
+        pool = self._pool(host)
+        attempts = 1 + (self.max_retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            pool.in_flight += 1
+            pool.requests += 1
+            pool.peak_in_flight = max(pool.peak_in_flight, pool.in_flight)
+            started = time.perf_counter()
+            status = None
+            try:
+                response = await pool.session.request(method, url, **kwargs)
+                status = response.status_code
+            except (httpx.TransportError, httpx.TimeoutException):
+                pool.errors += 1
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning("%s %s failed (attempt %d), retrying", method, endpoint or host, attempt + 1)
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt + 1 >= attempts:
+                    return response
+                logger.warning("%s %s returned %s (attempt %d), retrying", method, endpoint or host, response.status_code, attempt + 1)
+            finally:
+                pool.in_flight -= 1
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint or host,
+                                                 status=metrics.status_class(status))
+            pool.retries += 1
+            await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    async def get(self, url: str, **kwargs) -> "httpx.Response":
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> "httpx.Response":
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self) -> None:
+        """Close the clients bound to the running event loop."""
+        import asyncio
+
+        with self._lock:
+            pools = self._pools.pop(asyncio.get_running_loop(), {})
+        for pool in pools.values():
+            await pool.session.aclose()
+
+    def pool_stats(self) -> dict:
+        """Per-host figures, summed over the pools of every event loop."""
+        stats = {}
+        with self._lock:
+            pools = [(host, p) for per_loop in self._pools.values() for host, p in per_loop.items()]
+        for host, p in pools:
+            s = stats.setdefault(host, {"pool_size": 0, "in_flight": 0, "peak_in_flight": 0, "requests": 0,
+                                        "retries": 0, "errors": 0})
+            s["pool_size"] += p.size
+            s["in_flight"] += p.in_flight
+            s["peak_in_flight"] = max(s["peak_in_flight"], p.peak_in_flight)
+            s["requests"] += p.requests
+            s["retries"] += p.retries
+            s["errors"] += p.errors
+        for s in stats.values():
+            s["utilisation"] = s["in_flight"] / s["pool_size"] if s["pool_size"] else 0.0
+        return stats
+
+
+client = HTTPClient(pool_size=config.HTTP_POOL_SIZE, max_retries=config.HTTP_MAX_RETRIES)
+async_client = AsyncHTTPClient(pool_size=config.HTTP_ASYNC_POOL_SIZE, max_retries=config.HTTP_MAX_RETRIES)
+
+
+def _in_flight() -> dict:
+    counts = {}
+    for stats in (client.pool_stats(), async_client.pool_stats()):
+        for host, p in stats.items():
+            counts[host] = counts.get(host, 0) + p["in_flight"]
+    return counts
+
+
+metrics.gauge_callback("upstream_in_flight", "Outbound requests in flight per provider host", _in_flight, ("host",))
+
+
+def get(url: str, **kwargs) -> "requests.Response":
+    return client.get(url, **kwargs)
+
+
+def post(url: str, **kwargs) -> "requests.Response":
+    return client.post(url, **kwargs)
+
+
+def pool_stats() -> dict:
+    return client.pool_stats()
+
+
+async def aget(url: str, **kwargs) -> "httpx.Response":
+    return await async_client.get(url, **kwargs)
+
+
+async def apost(url: str, **kwargs) -> "httpx.Response":
+    return await async_client.post(url, **kwargs)
+
+
+async def aclose() -> None:
+    await async_client.aclose()
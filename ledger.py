@@ -0,0 +1,290 @@
+"""Buffered, rotating JSON-lines ledger.
+
+The apps used to ``open(..., "a")`` a log file for every event, which costs
+an open/write/close per request and interleaves badly when several gunicorn
+workers append at once. A ``Ledger`` instead:
+
+- appends events to an in-memory buffer (the request only takes a lock)
+- flushes the buffer from a background thread every ``flush_interval``
+  seconds, or sooner once ``high_water`` events are waiting; the appending
+  thread never writes, so a disk error cannot fail a request
+- holds at most ``max_buffer`` events: past that, new events are dropped
+  and counted in ``dropped`` rather than growing without bound
+- takes an exclusive ``flock`` on ``<file>.lock`` around each batch, so
+  workers never interleave lines or rotate the file under each other
+- rotates by size and age, and fsyncs at most every ``fsync_interval``
+
+Events still in the buffer when a worker is killed with SIGKILL are lost;
+call ``flush()`` where that matters. A batch whose write fails (disk full,
+permissions) goes back to the front of the buffer for the next flush.
+``read()`` replays current and rotated files in order for reconciliation.
+
+Usage::
+
+    import ledger
+    ledger.get_ledger("payouts").append("payout_simulated", phone=phone, amount=amount)
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Iterator, Optional
+
+import config
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no flock; fine for the single-process development server
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class Ledger:
+    """One JSON-lines ledger file, shared by every process that opens it."""
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, rotate_seconds: float = 86400,
+                 flush_interval: float = 1.0, fsync_interval: float = 5.0, high_water: int = 500,
+                 max_buffer: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.high_water = high_water
+        self.max_buffer = max_buffer
+        self._buffer = deque()
+        self._file_age = (None, 0.0)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, event: str, **fields) -> None:
+        """Queue one event; it is written on the next flush."""
+        entry = {"ts": datetime.now().isoformat(), "event": event, "pid": os.getpid()}
+        entry.update(fields)
+        self.append_many([entry])
+
+    def append_many(self, entries: list) -> None:
+        """Queue several prepared entries (dicts) as one batch.
+
+        Entries that do not fit under ``max_buffer`` are dropped and counted.
+        """
+        if not entries:
+            return
+        self._ensure_flusher()
+        with self._lock:
+            room = self.max_buffer - len(self._buffer)
+            if room < len(entries):
+                self._drop(len(entries) - max(room, 0))
+                entries = entries[:max(room, 0)]
+            self._buffer.extend(entries)
+            backlog = len(self._buffer)
+        if backlog >= self.high_water:
+            self._wake.set()
+
+    def _drop(self, n: int) -> None:
+        # caller holds self._lock
+        if not self.dropped:
+            logger.error("Ledger %s buffer full (%d entries); dropping new entries", self.path, self.max_buffer)
+        self.dropped += n
+
+    def append_durable(self, entries: list) -> int:
+        """Write ``entries`` now and fsync them, bypassing the buffer.
+
+        For callers that delete the original once this returns (archiving):
+        a buffered entry may already have been written by the background
+        flusher without an fsync, so ``flush(fsync=True)`` cannot vouch
+        for it.
+        """
+        if not entries:
+            return 0
+        with self._flush_lock:
+            self._write(entries, fsync=True)
+            self.written += len(entries)
+            self.flushes += 1
+        return len(entries)
+
+    def _ensure_flusher(self) -> None:
+        if self._pid == os.getpid() or self._closed:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # (re)start after a fork: the parent's thread does not exist here
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f"ledger-{os.path.basename(self.path)}", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Ledger flush failed for %s", self.path)
+
+    def flush(self, fsync: bool = False) -> int:
+        """Write everything buffered so far. Returns the number of entries."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._buffer:
+                    return 0
+                batch = list(self._buffer)
+                self._buffer.clear()
+            try:
+                self._write(batch, fsync)
+            except BaseException:
+                # keep the entries (ahead of anything appended meanwhile);
+                # a partly written batch may repeat lines, never lose them
+                with self._lock:
+                    self._buffer.extendleft(reversed(batch))
+                    excess = len(self._buffer) - self.max_buffer
+                    if excess > 0:
+                        # keep the oldest entries; the newest go over the cap
+                        for _ in range(excess):
+                            self._buffer.pop()
+                        self._drop(excess)
+                raise
+            self.written += len(batch)
+            self.flushes += 1
+            return len(batch)
+
+    def _write(self, batch: list, fsync: bool) -> None:
+        # caller holds self._flush_lock
+        data = "".join(json.dumps(e, default=str, ensure_ascii=False) + "\n" for e in batch)
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._rotate_if_needed()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(data)
+                    f.flush()
+                    now = time.monotonic()
+                    if fsync or now - self._last_fsync >= self.fsync_interval:
+                        os.fsync(f.fileno())
+                        self._last_fsync = now
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _rotate_if_needed(self) -> None:
+        # caller holds the cross-process lock
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        too_big = st.st_size >= self.max_bytes
+        too_old = self.rotate_seconds and time.time() - self._created_at(st) >= self.rotate_seconds
+        if not (too_big or too_old):
+            return
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        os.replace(self.path, f"{self.path}.{stamp}")
+
+    def _created_at(self, st: os.stat_result) -> float:
+        # the first line's timestamp is the file's age (st_ctime is not
+        # creation time on Linux); cached per inode
+        inode, created = self._file_age
+        if inode == st.st_ino:
+            return created
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                first = json.loads(f.readline())
+            created = datetime.fromisoformat(first["ts"]).timestamp()
+        except Exception:
+            created = st.st_mtime
+        self._file_age = (st.st_ino, created)
+        return created
+
+    def files(self) -> list:
+        """Rotated files oldest first, then the live file."""
+        rotated = sorted(glob.glob(glob.escape(self.path) + ".2*"))
+        return rotated + ([self.path] if os.path.exists(self.path) else [])
+
+    def read(self, event: Optional[str] = None, since: Optional[str] = None) -> Iterator[dict]:
+        """Replay entries in write order, optionally filtered.
+
+        ``since`` is an ISO timestamp; entries older than it are skipped.
+        Only flushed entries are visible — call ``flush()`` first if needed.
+        """
+        for path in self.files():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logger.warning("Skipping corrupt ledger line in %s", path)
+                        continue
+                    if event is not None and entry.get("event") != event:
+                        continue
+                    if since is not None and entry.get("ts", "") < since:
+                        continue
+                    yield entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            buffered = len(self._buffer)
+        return {"path": self.path, "buffered": buffered, "written": self.written, "flushes": self.flushes,
+                "dropped": self.dropped}
+
+    def close(self) -> None:
+        self._closed = True
+        self._wake.set()
+        self.flush(fsync=True)
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(name: str) -> Ledger:
+    """Process-wide ledger ``<LEDGER_DIR>/<name>.jsonl``, flushed at exit."""
+    with _ledgers_lock:
+        ledger = _ledgers.get(name)
+        if ledger is None:
+            ledger = _ledgers[name] = Ledger(
+                os.path.join(config.LEDGER_DIR, f"{name}.jsonl"),
+                max_bytes=config.LEDGER_MAX_BYTES,
+                rotate_seconds=config.LEDGER_ROTATE_SECONDS,
+                flush_interval=config.LEDGER_FLUSH_INTERVAL,
+                fsync_interval=config.LEDGER_FSYNC_INTERVAL,
+            )
+        return ledger
+
+
+@atexit.register
+def close_all() -> None:
+    with _ledgers_lock:
+        ledgers = list(_ledgers.values())
+    for ledger in ledgers:
+        try:
+            ledger.close()
+        except Exception:
+            logger.exception("Failed to close ledger %s", ledger.path)
+
+
+if __name__ == "__main__":
+    # python ledger.py payouts [event] — dump a ledger for reconciliation
+    import sys
+
+    if len(sys.argv) < 2:
+        sys.exit("usage: python ledger.py <name> [event]")
+    for entry in get_ledger(sys.argv[1]).read(event=sys.argv[2] if len(sys.argv) > 2 else None):
+        print(json.dumps(entry, ensure_ascii=False))
@@ -0,0 +1,458 @@
+"""Prometheus-style metrics shared by all gunicorn workers.
+
+Counters, gauges and histograms live in process memory: recording one is a
+dict update under a lock, with no I/O. Every ``METRICS_FLUSH_INTERVAL``
+seconds (checked after a request, and at exit) a worker writes its values
+to ``METRICS_DIR/<pid>.json``. ``/metrics`` merges every worker's file and
+renders the Prometheus text format:
+
+- counters and histograms are summed across workers, dead ones included
+  (until their file is older than ``METRICS_RETENTION``), so totals do not
+  drop when gunicorn recycles a worker
+- process gauges (queue depths, in-flight requests) are summed over live
+  workers only
+- global gauges (payments per status) are read from the shared store when
+  scraped, once
+
+Usage::
+
+    STK_SECONDS = metrics.histogram("stk_seconds", "STK push time", ("outcome",))
+    with STK_SECONDS.time(outcome="ok"): ...
+
+    @metrics.timed_call("mpesa.stk_push")
+    def stk_push(...): ...
+
+    metrics.instrument_app(app)   # route histograms and GET /metrics
+"""
+import asyncio
+import atexit
+import bisect
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(k), v] for k, v in self._values.items()]
+        return {"type": self.kind, "help": self.help, "labels": list(self.labels), "values": values}
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Per-process value, summed over live workers when scraped."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        # per-bucket (non-cumulative) counts, then +Inf, sum and count
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 3)
+            counts[slot] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, **labels) -> "_Timer":
+        """Context manager observing the elapsed wall time."""
+        return _Timer(self, labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = [[list(k), list(v)] for k, v in self._values.items()]
+        return {"type": self.kind, "help": self.help, "labels": list(self.labels),
+                "buckets": list(self.buckets), "values": values}
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Registry:
+    """Metrics of this process plus the file-based cross-worker merge."""
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = 5.0, retention: float = 3600.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self._metrics = {}
+        self._process_gauges = []
+        self._global_gauges = []
+        self._lock = threading.Lock()
+        self._next_flush = 0.0
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"Metric {metric.name} already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge_callback(self, name: str, help: str, fn: Callable, labels: Iterable[str] = (),
+                       scope: str = "process") -> Gauge:
+        """Gauge filled from ``fn()`` when flushed (``scope="process"``) or scraped (``"global"``).
+
+        ``fn`` returns a number, or ``{label_value_tuple: number}`` for
+        labelled gauges.
+        """
+        if scope == "global":
+            gauge = Gauge(name, help, labels)
+        else:
+            gauge = self._add(Gauge(name, help, labels))
+        with self._lock:
+            (self._global_gauges if scope == "global" else self._process_gauges).append((gauge, fn))
+        return gauge
+
+    @staticmethod
+    def _fill(callbacks: list) -> None:
+        # several callbacks may feed one gauge (e.g. one per queue label)
+        filled = {}
+        for gauge, fn in callbacks:
+            values = filled.setdefault(gauge, {})
+            try:
+                value = fn()
+            except Exception:
+                logger.exception("Metric callback for %s failed", gauge.name)
+                continue
+            if isinstance(value, dict):
+                for k, n in value.items():
+                    values[tuple(str(v) for v in (k if isinstance(k, tuple) else (k,)))] = n
+            elif value is not None:
+                values[()] = value
+        for gauge, values in filled.items():
+            with gauge._lock:
+                gauge._values = values
+
+    # -- cross-worker files -------------------------------------------------
+
+    def snapshot(self) -> dict:
+        self._fill(self._process_gauges)
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {"pid": os.getpid(), "time": time.time(), "metrics": {m.name: m.snapshot() for m in metrics}}
+
+    def flush(self) -> None:
+        """Write this worker's values for the other workers' ``/metrics``."""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def flush_due(self) -> bool:
+        return time.monotonic() >= self._next_flush
+
+    def maybe_flush(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if now < self._next_flush and not force:
+            return
+        self._next_flush = now + self.flush_interval
+        try:
+            self.flush()
+        except OSError:
+            logger.exception("Could not write metrics to %s", self.directory)
+
+    def _snapshots(self) -> list:
+        own = self.snapshot()
+        if not self.directory or not os.path.isdir(self.directory):
+            return [own]
+        snapshots = [own]
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or name == f"{own['pid']}.json":
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snap = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(snap.get("pid"))
+            if not alive and now - snap.get("time", 0) > self.retention:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            snap["alive"] = alive
+            snapshots.append(snap)
+        return snapshots
+
+    def collect(self) -> dict:
+        """``{name: merged snapshot}`` over every worker."""
+        merged = {}
+        for snap in self._snapshots():
+            alive = snap.get("alive", True)
+            for name, metric in snap["metrics"].items():
+                if metric["type"] == "gauge" and not alive:
+                    continue
+                target = merged.setdefault(name, dict(metric, values={}))
+                for key, value in metric["values"]:
+                    key = tuple(key)
+                    if metric["type"] == "histogram":
+                        acc = target["values"].get(key)
+                        target["values"][key] = [a + b for a, b in zip(acc, value)] if acc else list(value)
+                    else:
+                        target["values"][key] = target["values"].get(key, 0) + value
+        self._fill(self._global_gauges)
+        for gauge in dict.fromkeys(g for g, _ in self._global_gauges):
+            snap = gauge.snapshot()
+            merged[gauge.name] = dict(snap, values={tuple(k): v for k, v in snap["values"]})
+        return merged
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in sorted(metric["values"].items()):
+                labels = list(zip(metric["labels"], key))
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric["buckets"]) + ["+Inf"], value[:-2]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _number(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(value[-2])}")
+                lines.append(f"{name}_count{_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, TypeError, ValueError):
+        return False
+    return True
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs: list) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry(config.METRICS_DIR, config.METRICS_FLUSH_INTERVAL, config.METRICS_RETENTION)
+atexit.register(REGISTRY.maybe_flush, force=True)
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+gauge_callback = REGISTRY.gauge_callback
+render = REGISTRY.render
+
+# Shared instruments used across modules
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds", "Flask request latency by route", ("app", "route", "method", "status"))
+UPSTREAM_SECONDS = histogram(
+    "upstream_request_duration_seconds", "Outbound provider HTTP calls by endpoint (each attempt)",
+    ("endpoint", "status"))
+PROVIDER_CALL_SECONDS = histogram(
+    "provider_call_duration_seconds", "Provider operations end to end (token, retries included)",
+    ("call", "outcome"))
+STORE_OP_SECONDS = histogram(
+    "payment_store_operation_seconds", "Payment store calls by operation", ("backend", "op"),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+PAYMENT_CHANGES = counter(
+    "payment_changes_total", "Payment record writes by resulting status", ("status",))
+
+
+def status_class(status: Optional[int]) -> str:
+    """``"2xx"``/``"4xx"``/...; ``"error"`` when there was no response."""
+    return f"{status // 100}xx" if status else "error"
+
+
+def timed_call(call: str, histogram: Histogram = PROVIDER_CALL_SECONDS):
+    """Decorator timing ``fn`` with ``call=...`` and ``outcome`` ok/error.
+
+    Works on coroutine functions too (the await is timed).
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                outcome = "error"
+                try:
+                    result = await fn(*args, **kwargs)
+                    outcome = "ok"
+                    return result
+                finally:
+                    histogram.observe(time.perf_counter() - started, call=call, outcome=outcome)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = fn(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                histogram.observe(time.perf_counter() - started, call=call, outcome=outcome)
+        return wrapper
+    return decorator
+
+
+def time_methods(obj, names: Iterable[str], histogram: Histogram = STORE_OP_SECONDS, **labels):
+    """Time calls to ``obj``'s methods ``names`` as ``op=<name>``; returns ``obj``."""
+    for name in names:
+        method = getattr(obj, name, None)
+        if method is None:
+            continue
+
+        def wrapper(*args, _method=method, _op=name, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, op=_op, **labels)
+
+        functools.update_wrapper(wrapper, method)
+        setattr(obj, name, wrapper)
+    return obj
+
+
+def instrument_app(app, name: Optional[str] = None) -> None:
+    """Route latency histogram for a Flask (or Quart) ``app`` plus ``GET /metrics``."""
+    name = name or app.import_name
+    if type(app).__module__.startswith("quart"):
+        return _instrument_quart(app, name)
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, app=name, route=route,
+                                         method=request.method, status=response.status_code)
+        REGISTRY.maybe_flush()
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        REGISTRY.maybe_flush()
+        return Response(render(), content_type=CONTENT_TYPE)
+
+
+def _scrape() -> str:
+    REGISTRY.maybe_flush()
+    return render()
+
+
+def _instrument_quart(app, name: str) -> None:
+    # same hooks as coroutines, so Quart runs them on the loop, not in a
+    # thread; file writes and the store-backed gauges go to a worker thread
+    from quart import Response, g, request
+
+    @app.before_request
+    async def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    async def _observe(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, app=name, route=route,
+                                         method=request.method, status=response.status_code)
+        if REGISTRY.flush_due():
+            await asyncio.to_thread(REGISTRY.maybe_flush)
+        return response
+
+    @app.route("/metrics")
+    async def metrics():
+        return Response(await asyncio.to_thread(_scrape), content_type=CONTENT_TYPE)
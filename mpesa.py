@@ -1,90 +1,94 @@
 """Simple MPESA helper supporting Daraja STK Push (sandbox) and simulated payouts.
 
-This module implements token retrieval and STK Push using Safaricom's Daraja
-API endpoints (sandbox by default). Payouts (B2C) are simulated unless you
-provide production credentials and enable B2C via environment variables.
+This module implements token retrieval, STK Push and STK Push Query using
+Safaricom's Daraja API endpoints (sandbox by default), with ``*_async``
+variants of the STK calls for the async serving mode. Payouts (B2C) are simulated unless the
+``MPESA_B2C_*`` settings are provided; see payouts.py for batching.
 """
 import base64
-import requests
+import secrets
+import http_client
+import ledger
+import metrics
+import phones
+import providers
 import datetime
 import logging
 from typing import Optional
+from mpesa_callbacks import callback_url as _callback_url
+from mpesa_token import TokenManager, daraja_fetcher
 from config import (
     MPESA_CONSUMER_KEY,
     MPESA_CONSUMER_SECRET,
     MPESA_PASSKEY,
     MPESA_SHORTCODE,
     CALLBACK_URL,
-    USE_MPESA,
+    CALLBACK_TOKEN,
+    MPESA_BASE_URL,
+    MPESA_B2C_SHORTCODE,
+    MPESA_B2C_INITIATOR,
+    MPESA_B2C_SECURITY_CREDENTIAL,
+    MPESA_B2C_RESULT_URL,
+    MPESA_B2C_TIMEOUT_URL,
+    USE_MPESA_B2C,
 )
 
 logger = logging.getLogger(__name__)
 
-# Default to sandbox endpoints; override by setting MPESA_BASE_URL environment
-# variable in `config.py` if you need production.
-MPESA_BASE = "https://sandbox.safaricom.co.ke"
+# Sandbox endpoints by default; set the MPESA_BASE_URL environment variable
+# (see `config.py`) for production.
+MPESA_BASE = MPESA_BASE_URL.rstrip("/")
+
+# What Daraja posts results to, secret path token included
+STK_CALLBACK_URL = _callback_url(CALLBACK_URL, CALLBACK_TOKEN)
+
+# Tokens are cached until shortly before expiry; see mpesa_token.py. The
+# manager is built on first use (see providers.py).
+token_manager = providers.register(
+    "daraja", lambda: TokenManager(daraja_fetcher(MPESA_BASE, MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET)))
 
 
 def get_access_token() -> Optional[str]:
-    """Retrieve OAuth access token from Daraja sandbox.
+    """Return a cached OAuth access token for Daraja.
 
     Returns the access token string or None if retrieval failed.
     """
     if not (MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET):
         logger.debug("MPESA consumer credentials not configured")
         return None
-    url = f"{MPESA_BASE}/oauth/v1/generate?grant_type=client_credentials"
-    auth = (MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET)
-    try:
-        r = requests.get(url, auth=auth, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        return data.get("access_token")
-    except Exception as e:
-        logger.exception("Failed to retrieve MPESA access token: %s", e)
-        return None
+    return token_manager().get()
 
 
 def _timestamp() -> str:
     return datetime.datetime.now().strftime("%Y%m%d%H%M%S")
 
 
-def stk_push(phone: str, amount: int, account_reference: str = "OddsMtaani", callback_url: str = CALLBACK_URL) -> Optional[str]:
-    """Initiate STK Push to the given phone number.
-
-    Returns the CheckoutRequestID (string) on success, or None on failure.
-    """
-    # Log the configuration status
-    logger.info("=== STK Push Debug Info ===")
-    logger.info(f"MPESA_CONSUMER_KEY present: {bool(MPESA_CONSUMER_KEY)}")
-    logger.info(f"MPESA_CONSUMER_SECRET present: {bool(MPESA_CONSUMER_SECRET)}")
-    logger.info(f"MPESA_PASSKEY: {MPESA_PASSKEY}")
-    logger.info(f"MPESA_SHORTCODE: {MPESA_SHORTCODE}")
-    logger.info(f"CALLBACK_URL: {callback_url}")
-    logger.info(f"Phone: {phone}, Amount: {amount}")
-    
+def _simulated(phone: str, amount: int) -> Optional[str]:
+    """A simulated CheckoutRequestID when the passkey is not configured."""
     # If passkey is not set (still "YOUR_PASSKEY"), use simulated flow
-    if MPESA_PASSKEY == "YOUR_PASSKEY" or not MPESA_PASSKEY:
-        logger.info("MPESA Passkey not configured. Simulating STK Push...")
-        # Simulate successful STK Push
-        checkout_id = f"SIMULATED-{phone}-{amount}"
-        with open("simulated_stk_push.log", "a", encoding="utf-8") as f:
-            f.write(f"STK Push SIMULATED: Phone={phone} Amount={amount} CheckoutID={checkout_id}\n")
-        logger.info(f"Simulated STK Push result: {checkout_id}")
-        return checkout_id
-    
-    token = get_access_token()
-    if not token:
-        logger.error("Failed to get access token - check consumer key/secret")
+    if MPESA_PASSKEY and MPESA_PASSKEY != "YOUR_PASSKEY":
         return None
+    logger.info("MPESA Passkey not configured. Simulating STK Push...")
+    # Simulate successful STK Push; ids must be unique in the payment store
+    checkout_id = f"SIMULATED-{phone}-{amount}-{secrets.token_hex(3).upper()}"
+    ledger.get_ledger("simulated").append("stk_push_simulated", phone=phone, amount=amount, checkout_id=checkout_id)
+    logger.info(f"Simulated STK Push result: {checkout_id}")
+    return checkout_id
+
+
+def _password(timestamp: str) -> str:
+    return base64.b64encode(f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}".encode()).decode()
 
+
+def _stk_push_request(token: str, phone: str, amount: int, account_reference: str, callback_url: str):
+    """(url, payload, headers) for an STK Push."""
+    phone = phones.msisdn(phone)
     timestamp = _timestamp()
-    password = base64.b64encode(f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}".encode()).decode()
     url = f"{MPESA_BASE}/mpesa/stkpush/v1/processrequest"
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     payload = {
         "BusinessShortCode": MPESA_SHORTCODE,
-        "Password": password,
+        "Password": _password(timestamp),
         "Timestamp": timestamp,
         "TransactionType": "CustomerPayBillOnline",
         "Amount": int(amount),
@@ -95,40 +99,200 @@ def stk_push(phone: str, amount: int, account_reference: str = "OddsMtaani", cal
         "AccountReference": account_reference,
         "TransactionDesc": "Payment for OddsMtaani",
     }
+    return url, payload, headers
+
 
+def _stk_push_result(r) -> Optional[str]:
+    logger.info(f"Response status: {r.status_code}")
+    logger.info(f"Response body: {r.text}")
+    if r.status_code == 401:
+        token_manager().invalidate()
+    r.raise_for_status()
+    data = r.json()
+    # On success, Daraja returns CheckoutRequestID inside response
+    checkout_id = data.get("CheckoutRequestID") or data.get("ResponseDescription")
+    logger.info("STK Push initiated: %s", data)
+    return checkout_id
+
+
+@metrics.timed_call("mpesa.stk_push")
+def stk_push(phone: str, amount: int, account_reference: str = "OddsMtaani", callback_url: str = STK_CALLBACK_URL) -> Optional[str]:
+    """Initiate STK Push to the given phone number.
+
+    Returns the CheckoutRequestID (string) on success, or None on failure.
+    """
+    # Log the configuration status
+    logger.info("=== STK Push Debug Info ===")
+    logger.info(f"MPESA_CONSUMER_KEY present: {bool(MPESA_CONSUMER_KEY)}")
+    logger.info(f"MPESA_CONSUMER_SECRET present: {bool(MPESA_CONSUMER_SECRET)}")
+    logger.info(f"MPESA_PASSKEY: {MPESA_PASSKEY}")
+    logger.info(f"MPESA_SHORTCODE: {MPESA_SHORTCODE}")
+    # never log the secret token
+    logger.info(f"CALLBACK_URL: {CALLBACK_URL if callback_url == STK_CALLBACK_URL else callback_url}")
+    logger.info(f"Phone: {phone}, Amount: {amount}")
+
+    simulated = _simulated(phone, amount)
+    if simulated:
+        return simulated
+
+    token = get_access_token()
+    if not token:
+        logger.error("Failed to get access token - check consumer key/secret")
+        return None
+
+    url, payload, headers = _stk_push_request(token, phone, amount, account_reference, callback_url)
     try:
         logger.info(f"Sending STK Push request to {url}")
-        r = requests.post(url, json=payload, headers=headers, timeout=15)
-        logger.info(f"Response status: {r.status_code}")
-        logger.info(f"Response body: {r.text}")
-        r.raise_for_status()
-        data = r.json()
-        # On success, Daraja returns CheckoutRequestID inside response
-        checkout_id = data.get("CheckoutRequestID") or data.get("ResponseDescription")
-        logger.info("STK Push initiated: %s", data)
-        return checkout_id
+        r = http_client.post(url, endpoint="daraja.stkpush", json=payload, headers=headers)
+        return _stk_push_result(r)
+    except Exception as e:
+        logger.exception("STK Push failed: %s", e)
+        return None
+
+
+@metrics.timed_call("mpesa.stk_push")
+async def stk_push_async(phone: str, amount: int, account_reference: str = "OddsMtaani", callback_url: str = STK_CALLBACK_URL) -> Optional[str]:
+    """``stk_push`` for the async serving mode (see app_async.py)."""
+    simulated = _simulated(phone, amount)
+    if simulated:
+        return simulated
+
+    if not (MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET):
+        logger.error("MPESA consumer credentials not configured")
+        return None
+    token = await token_manager().get_async()
+    if not token:
+        logger.error("Failed to get access token - check consumer key/secret")
+        return None
+
+    url, payload, headers = _stk_push_request(token, phone, amount, account_reference, callback_url)
+    try:
+        r = await http_client.apost(url, endpoint="daraja.stkpush", json=payload, headers=headers)
+        return _stk_push_result(r)
     except Exception as e:
         logger.exception("STK Push failed: %s", e)
         return None
 
 
-def send_payout(phone: str, amount: int) -> str:
-    """Send payout to a user.
+# errorCode Daraja's STK Query returns while the customer has not answered yet
+STK_QUERY_PROCESSING = "500.001.1001"
+
+
+def _stk_query_request(token: str, checkout_id: str):
+    timestamp = _timestamp()
+    payload = {
+        "BusinessShortCode": MPESA_SHORTCODE,
+        "Password": _password(timestamp),
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_id,
+    }
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    return f"{MPESA_BASE}/mpesa/stkpushquery/v1/query", payload, headers
+
+
+def _stk_query_result(r) -> Optional[dict]:
+    if r.status_code == 401:
+        token_manager().invalidate()
+    data = r.json() if r.content else {}
+    if data.get("errorCode") == STK_QUERY_PROCESSING:
+        return None
+    r.raise_for_status()
+    if "ResultCode" not in data:
+        raise RuntimeError(f"Unexpected STK Query response: {data}")
+    return {"result_code": int(data["ResultCode"]), "result_desc": data.get("ResultDesc", "")}
+
+
+@metrics.timed_call("mpesa.stk_query")
+def stk_query(checkout_id: str) -> Optional[dict]:
+    """Ask Daraja for the outcome of an STK Push (see reconcile.py).
 
-    NOTE: B2C payouts require special credentials and account setup with
-    Safaricom. By default this function simulates the payout and logs it.
-    If you set the appropriate credentials and endpoints you can extend this
-    function to call the real B2C API.
+    Returns None while the prompt is still open on the customer's phone,
+    otherwise ``{"result_code": int, "result_desc": str}`` (0 = paid).
+    Simulated checkouts are never settled here. Raises on transport or API
+    errors.
     """
-    if not USE_MPESA:
+    if checkout_id.startswith("SIMULATED-"):
+        return None
+    token = get_access_token()
+    if not token:
+        raise RuntimeError("Failed to get access token")
+    url, payload, headers = _stk_query_request(token, checkout_id)
+    return _stk_query_result(http_client.post(url, endpoint="daraja.stkquery", json=payload, headers=headers))
+
+
+@metrics.timed_call("mpesa.stk_query")
+async def stk_query_async(checkout_id: str) -> Optional[dict]:
+    """``stk_query`` for the async serving mode."""
+    if checkout_id.startswith("SIMULATED-"):
+        return None
+    token = await token_manager().get_async() if (MPESA_CONSUMER_KEY and MPESA_CONSUMER_SECRET) else None
+    if not token:
+        raise RuntimeError("Failed to get access token")
+    url, payload, headers = _stk_query_request(token, checkout_id)
+    return _stk_query_result(await http_client.apost(url, endpoint="daraja.stkquery", json=payload, headers=headers))
+
+
+class PayoutRejected(Exception):
+    """Daraja answered and did not accept the payout; safe to retry."""
+
+
+class PayoutOutcomeUnknown(Exception):
+    """Daraja answered with a server error; the payout may have been accepted."""
+
+
+@metrics.timed_call("mpesa.b2c")
+def send_payout(phone: str, amount: int, idempotency_key: Optional[str] = None) -> str:
+    """Send a B2C payout to a winner.
+
+    Returns the Daraja ConversationID once the request is accepted (the
+    final result arrives later on ``MPESA_B2C_RESULT_URL``), or "SIMULATED"
+    when B2C is not configured. ``idempotency_key`` is sent as the
+    OriginatorConversationID so repeated attempts for one prize can be
+    matched up.
+
+    Raises ``PayoutRejected`` if Daraja refuses the request (a 4xx answer or
+    a non-zero ResponseCode). A 5xx answer raises ``PayoutOutcomeUnknown``:
+    like a timeout, the request may have been accepted, so it and any other
+    exception mean the payout must not be blindly resent.
+    """
+    if not USE_MPESA_B2C:
         logger.info("Simulating payout of KES %s to %s", amount, phone)
-        # append to a local log file for traceability
-        with open("simulated_payouts.log", "a", encoding="utf-8") as f:
-            f.write(f"PAYOUT SIMULATED: To={phone} Amount={amount}\n")
+        # record in the payouts ledger for traceability
+        ledger.get_ledger("payouts").append("payout_simulated", phone=phone, amount=amount, key=idempotency_key)
         return "SIMULATED"
 
-    # If USE_MPESA is True, but real B2C not implemented, fallback to simulated
-    logger.warning("MPESA configured but B2C payout not implemented; simulating")
-    with open("simulated_payouts.log", "a", encoding="utf-8") as f:
-        f.write(f"PAYOUT (SIMULATED FALLBACK): To={phone} Amount={amount}\n")
-    return "SIMULATED"
+    party_b = phones.try_normalize(phone)
+    if not party_b:
+        raise PayoutRejected(f"Invalid payout phone {phone!r}")
+    token = get_access_token()
+    if not token:
+        raise PayoutRejected("Failed to get access token")
+
+    payload = {
+        "InitiatorName": MPESA_B2C_INITIATOR,
+        "SecurityCredential": MPESA_B2C_SECURITY_CREDENTIAL,
+        "CommandID": "BusinessPayment",
+        "Amount": int(amount),
+        "PartyA": MPESA_B2C_SHORTCODE,
+        "PartyB": party_b[1:],
+        "Remarks": "OddsMtaani prize",
+        "QueueTimeOutURL": MPESA_B2C_TIMEOUT_URL,
+        "ResultURL": MPESA_B2C_RESULT_URL,
+        "Occasion": "Prize",
+    }
+    if idempotency_key:
+        payload["OriginatorConversationID"] = idempotency_key
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    r = http_client.post(f"{MPESA_BASE}/mpesa/b2c/v1/paymentrequest", endpoint="daraja.b2c", json=payload, headers=headers)
+    if r.status_code == 401:
+        token_manager().invalidate()
+    if r.status_code >= 500:
+        raise PayoutOutcomeUnknown(f"B2C HTTP {r.status_code}: {r.text[:200]}")
+    if r.status_code >= 400:
+        raise PayoutRejected(f"B2C HTTP {r.status_code}: {r.text[:200]}")
+    data = r.json()
+    if str(data.get("ResponseCode")) != "0":
+        raise PayoutRejected(f"B2C not accepted: {data.get('ResponseDescription') or data}")
+    ledger.get_ledger("payouts").append("payout_requested", phone=phone, amount=amount, key=idempotency_key,
+                                        conversation_id=data.get("ConversationID"))
+    return data.get("ConversationID") or data.get("OriginatorConversationID") or "ACCEPTED"
@@ -0,0 +1,212 @@
+"""Daraja STK callback ingestion.
+
+Safaricom expects the callback endpoint to acknowledge quickly and will
+resend results it thinks were lost, so bursts and duplicates are normal.
+``CallbackProcessor.handle`` does the minimum on the request thread:
+
+1. parse the ``stkCallback`` body
+2. drop duplicates already applied by this worker (CheckoutRequestID /
+   MerchantRequestID)
+3. check a success against the stored payment: ``Amount`` must equal the
+   amount and ``PhoneNumber`` the phone. A mismatch settles nothing; the
+   ``on_mismatch`` hooks ask Daraja instead (STK Query)
+4. apply PENDING -> CONFIRMED/FAILED with a single atomic store transition,
+   which also makes duplicates delivered to *another* worker harmless
+
+Anyone can POST to a public URL, so the apps only accept callbacks on
+``/callback/<CALLBACK_TOKEN>`` (``token_matches``) and register that URL with
+Daraja (``callback_url``). Anything slower (SMS, unlocking the game,
+payouts) is registered with ``on_settled`` and runs later on a background
+dispatch queue.
+"""
+import hmac
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Optional
+
+import phones
+from payment_store import QUEUED, PENDING, CONFIRMED, CONFIRMABLE, FAILED, PaymentStore
+from stk_dispatch import DispatchQueue
+
+logger = logging.getLogger(__name__)
+
+# Outcomes returned by ``CallbackProcessor.handle``
+INVALID = "invalid"
+DUPLICATE = "duplicate"
+UNKNOWN = "unknown"
+ALREADY_SETTLED = "already_settled"
+MISMATCH = "mismatch"
+
+
+def callback_url(base: Optional[str], token: Optional[str]) -> Optional[str]:
+    """The URL to give Daraja: ``base`` with the secret path token appended."""
+    if not (base and token):
+        return base
+    return f"{base.rstrip('/')}/{token}"
+
+
+def token_matches(token: Optional[str], expected: Optional[str]) -> bool:
+    """Whether a callback's path token is the configured secret.
+
+    With no secret configured every callback is refused; the reconciler
+    still settles payments by STK Query.
+    """
+    return bool(expected) and token is not None and hmac.compare_digest(token.encode(), expected.encode())
+
+
+def mismatch(result: dict, payment: dict) -> Optional[str]:
+    """Why a successful callback does not fit ``payment`` (None if it does)."""
+    try:
+        paid = float(result.get("Amount"))
+    except (TypeError, ValueError):
+        return f"amount {result.get('Amount')!r}"
+    if paid != float(payment["amount"]):
+        return f"amount {result.get('Amount')!r}, expected {payment['amount']}"
+    if phones.try_normalize(result.get("PhoneNumber")) != payment["phone"]:
+        return "phone number"
+    return None
+
+
+def parse_stk_callback(body) -> Optional[dict]:
+    """Flatten a Daraja ``Body.stkCallback`` payload.
+
+    Returns None if the body is not an STK callback. ``CallbackMetadata``
+    items (Amount, MpesaReceiptNumber, PhoneNumber, ...) become top-level keys.
+    """
+    try:
+        cb = body["Body"]["stkCallback"]
+        result = {
+            "checkout_id": cb["CheckoutRequestID"],
+            "merchant_request_id": cb.get("MerchantRequestID"),
+            "result_code": int(cb["ResultCode"]),
+            "result_desc": cb.get("ResultDesc", ""),
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+    for item in (cb.get("CallbackMetadata") or {}).get("Item", []):
+        if isinstance(item, dict) and "Name" in item:
+            result[item["Name"]] = item.get("Value")
+    return result
+
+
+class CallbackProcessor:
+    """Applies STK callbacks to a payment store."""
+
+    def __init__(self, store: PaymentStore, followups: Optional[DispatchQueue] = None, dedupe_size: int = 10000):
+        self.store = store
+        self.followups = followups
+        self.dedupe_size = dedupe_size
+        self._recent = OrderedDict()
+        self._hooks = []
+        self._mismatch_hooks = []
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def on_settled(self, fn: Callable[[dict], None]) -> Callable[[dict], None]:
+        """Register ``fn(payment)`` to run after a payment is confirmed or failed.
+
+        Usable as a decorator.
+        """
+        self._hooks.append(fn)
+        return fn
+
+    def on_mismatch(self, fn: Callable[[str, str], None]) -> Callable[[str, str], None]:
+        """Register ``fn(payment_id, checkout_id)`` for a success callback that did not match its payment.
+
+        Typically an STK Query, so Daraja rather than the callback body
+        decides the outcome. Usable as a decorator.
+        """
+        self._mismatch_hooks.append(fn)
+        return fn
+
+    def _recently_seen(self, keys) -> bool:
+        with self._lock:
+            return any(k in self._recent for k in keys)
+
+    def _remember(self, keys) -> None:
+        with self._lock:
+            for k in keys:
+                self._recent[k] = None
+                self._recent.move_to_end(k)
+            while len(self._recent) > self.dedupe_size:
+                self._recent.popitem(last=False)
+
+    def _count(self, outcome: str) -> str:
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        return outcome
+
+    def handle(self, body) -> str:
+        """Apply one callback body; returns the outcome for logging."""
+        result = parse_stk_callback(body)
+        if result is None:
+            return self._count(INVALID)
+        checkout_id = result["checkout_id"]
+        keys = [k for k in (checkout_id, result["merchant_request_id"]) if k]
+        if self._recently_seen(keys):
+            return self._count(DUPLICATE)
+
+        payment_id = self.store.resolve(checkout_id)
+        if payment_id is None and result["merchant_request_id"]:
+            payment_id = self.store.resolve(result["merchant_request_id"])
+        if payment_id is None:
+            # not remembered: a resend may arrive after the STK dispatch
+            # job has recorded the CheckoutRequestID
+            logger.warning("Callback for unknown checkout %s", checkout_id)
+            return self._count(UNKNOWN)
+
+        if result["result_code"] == 0:
+            payment = self.store.get(payment_id)
+            problem = payment and mismatch(result, payment)
+            if problem:
+                # not remembered: the genuine callback may still follow
+                logger.warning("Callback for %s does not match the payment (%s); asking Daraja", payment_id, problem)
+                for hook in self._mismatch_hooks:
+                    self._submit(hook, payment_id, payment_id, checkout_id)
+                return self._count(MISMATCH)
+
+        fields = {"result_code": result["result_code"], "result_desc": result["result_desc"]}
+        if result["result_code"] == 0:
+            to_status = CONFIRMED
+            fields["receipt"] = result.get("MpesaReceiptNumber")
+            fields["transaction_date"] = result.get("TransactionDate")
+            fields["confirmed_at"] = datetime.now().isoformat()
+        else:
+            to_status = FAILED
+        # a payment received after its TTL still confirms; a late failure leaves it EXPIRED
+        from_statuses = CONFIRMABLE if to_status == CONFIRMED else (QUEUED, PENDING)
+        payment = self.store.transition(payment_id, to_status, from_statuses=from_statuses, **fields)
+        self._remember(keys)
+        if payment is None:
+            return self._count(ALREADY_SETTLED)
+
+        self._schedule(payment)
+        return self._count(to_status.lower())
+
+    def _schedule(self, payment: dict) -> None:
+        for hook in self._hooks:
+            self._submit(hook, payment["payment_id"], payment)
+
+    def _submit(self, hook: Callable, payment_id: str, *args) -> None:
+        if self.followups is None:
+            self._run_hook(hook, payment_id, *args)
+            return
+        try:
+            self.followups.submit("followup", self._run_hook, hook, payment_id, *args)
+        except (queue.Full, RuntimeError):
+            logger.warning("Follow-up queue full; skipped %s for %s", getattr(hook, "__name__", hook), payment_id)
+            self._count("followup_dropped")
+
+    @staticmethod
+    def _run_hook(hook: Callable, payment_id: str, *args) -> None:
+        try:
+            hook(*args)
+        except Exception:
+            logger.exception("Follow-up %s failed for %s", getattr(hook, "__name__", hook), payment_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts, recent_keys=len(self._recent))
@@ -0,0 +1,148 @@
+"""Cached Daraja OAuth token manager.
+
+Daraja tokens are valid for about an hour, so fetching one before every STK
+push doubles the latency of ``/pay`` for no reason. ``TokenManager`` keeps
+the current token until shortly before it expires:
+
+- inside the refresh margin the cached token is still returned, and a
+  background thread fetches the next one
+- once expired (or on first use) callers block, but concurrent callers share
+  a single upstream request instead of each issuing their own
+"""
+import logging
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+import http_client
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Used when Daraja omits ``expires_in`` (it normally sends "3599").
+DEFAULT_EXPIRES_IN = 3599.0
+
+
+def daraja_fetcher(base_url: str, consumer_key: str, consumer_secret: str) -> Callable[[], Tuple[str, float]]:
+    """Build a fetch function for ``TokenManager`` against ``base_url``."""
+    url = f"{base_url}/oauth/v1/generate?grant_type=client_credentials"
+
+    @metrics.timed_call("daraja.token")
+    def fetch() -> Tuple[str, float]:
+        r = http_client.get(url, endpoint="daraja.oauth", auth=(consumer_key, consumer_secret))
+        r.raise_for_status()
+        data = r.json()
+        return data["access_token"], float(data.get("expires_in") or DEFAULT_EXPIRES_IN)
+
+    return fetch
+
+
+class _Call:
+    """One in-flight fetch that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.token = None
+
+
+class TokenManager:
+    """Thread-safe token cache with proactive refresh.
+
+    ``fetch`` must return ``(token, expires_in_seconds)`` or raise.
+    """
+
+    def __init__(self, fetch: Callable[[], Tuple[str, float]], refresh_margin: float = 60.0, wait_timeout: float = 15.0):
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._inflight = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def get(self) -> Optional[str]:
+        """Return a valid token, or None if one could not be obtained."""
+        now = time.monotonic()
+        with self._lock:
+            token = self._token
+            if token and now < self._expires_at:
+                self.hits += 1
+                stale = now >= self._refresh_at
+                start_background = stale and self._inflight is None
+            else:
+                self.misses += 1
+                token = None
+                start_background = False
+        if token:
+            if start_background:
+                threading.Thread(target=self._refresh, name="daraja-token-refresh", daemon=True).start()
+            return token
+        return self._refresh()
+
+    async def get_async(self) -> Optional[str]:
+        """``get`` for event-loop callers; only a fetch runs in a thread."""
+        with self._lock:
+            cached = self._token is not None and time.monotonic() < self._expires_at
+        if cached:
+            return self.get()
+        import asyncio  # not at module level: sync workers never need it
+
+        return await asyncio.to_thread(self.get)
+
+    def invalidate(self) -> None:
+        """Drop the cached token, e.g. after Daraja answers 401."""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "expires_in": max(0.0, self._expires_at - time.monotonic()) if self._token else 0.0,
+            }
+
+    def _refresh(self) -> Optional[str]:
+        with self._lock:
+            call = self._inflight
+            leader = call is None
+            if leader:
+                call = self._inflight = _Call()
+        if not leader:
+            call.done.wait(self.wait_timeout)
+            return call.token
+
+        try:
+            token, expires_in = self._fetch()
+        except Exception as e:
+            logger.exception("Failed to refresh Daraja access token: %s", e)
+            with self._lock:
+                self.failures += 1
+                self._inflight = None
+                # keep serving the old token if it has not expired yet
+                if self._token and time.monotonic() < self._expires_at:
+                    call.token = self._token
+            call.done.set()
+            return call.token
+
+        expires_in = float(expires_in)
+        with self._lock:
+            now = time.monotonic()
+            self._token = token
+            self._expires_at = now + expires_in
+            # short-lived tokens would otherwise be "stale" from the start
+            self._refresh_at = now + max(expires_in - self.refresh_margin, expires_in / 2)
+            self.refreshes += 1
+            self._inflight = None
+        call.token = token
+        call.done.set()
+        logger.info("Daraja access token refreshed (expires in %ss)", expires_in)
+        return token
@@ -0,0 +1,216 @@
+"""Cache of rendered pages with ETag revalidation and pre-compressed bodies.
+
+The landing pages are rendered from a handful of config values (entry
+fee, payment number), yet every hit used to run Jinja again and send the
+full page. ``PageCache.render`` keeps the rendered bytes per template and
+context. Per-payment pages (instructions, box game) are not cached: each
+entry would be used once, hold a phone number in memory and push the
+shared pages out of the LRU.
+
+- an entry is keyed by template name plus the context values, and is
+  compressed once when stored (gzip, and brotli if the ``brotli`` package
+  is installed) so repeat hits only pick the encoding the client accepts
+- responses carry a strong ``ETag`` (content hash) and ``Vary:
+  Accept-Encoding``; a matching ``If-None-Match`` gets ``304`` with no body
+- every ``check_interval`` seconds the config values and each cached
+  template's source are checked; a config change clears the cache, an
+  edited template drops its own entries, and the new ETags make browsers
+  fetch the new page
+- hit / miss / 304 counts per template are in ``stats()`` and the
+  ``page_cache_requests`` metric
+
+Entries are per worker (LRU, ``max_entries``); ETags are content hashes, so
+every worker answers a revalidation alike. Templates must not read
+``request`` or ``session`` — everything a page shows has to be in the
+context.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Optional
+
+import config
+import metrics
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+PAGE_CACHE_REQUESTS = metrics.counter(
+    "page_cache_requests", "Cached page renders by template and result (hit, miss, not_modified)",
+    ("template", "result"))
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 512
+
+_Entry = namedtuple("_Entry", "template etag bodies uptodate")
+
+
+def config_fingerprint() -> str:
+    """Hash of every setting in ``config``; changes when any value does."""
+    values = sorted((k, repr(v)) for k, v in vars(config).items() if k.isupper())
+    return hashlib.sha1(repr(values).encode()).hexdigest()[:12]
+
+
+def _context_key(context: dict):
+    # plain values (the usual case) key directly; anything else by its JSON hash
+    key = tuple(sorted(context.items()))
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return hashlib.sha1(json.dumps(context, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def accepts_encoding(header: Optional[str], coding: str) -> bool:
+    """Whether an ``Accept-Encoding`` header allows ``coding``."""
+    # "gzip, deflate, br" / "br;q=1.0, gzip;q=0.8" / "gzip;q=0"
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() in (coding, "*"):
+            q = params.strip()
+            try:
+                return not (q.startswith("q=") and float(q[2:] or 0) == 0)
+            except ValueError:
+                return False
+    return False
+
+
+def _tags(header: Optional[str]) -> set:
+    # compare the content hash whatever representation the client holds
+    return {t.strip().lstrip("W/").strip('"').split("-")[0] for t in (header or "").split(",") if t.strip()}
+
+
+class PageCache:
+    """Rendered Flask templates keyed by template and context."""
+
+    def __init__(self, max_entries: int = 1000, max_age: int = 300, check_interval: float = 2.0):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint = config_fingerprint()
+        self._next_check = time.monotonic() + check_interval
+        self.counts = {}
+        self.invalidations = 0
+
+    def _count(self, template: str, result: str) -> None:
+        with self._lock:
+            counts = self.counts.setdefault(template, {"hit": 0, "miss": 0, "not_modified": 0})
+            counts[result] += 1
+        PAGE_CACHE_REQUESTS.inc(template=template, result=result)
+
+    def _check(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        fingerprint = config_fingerprint()
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                logger.info("Config changed; dropping %d cached pages", len(self._entries))
+                self._fingerprint = fingerprint
+                self._entries.clear()
+                self.invalidations += 1
+                return
+            # one source check per template, not per cached context
+            fresh = {}
+            for entry in self._entries.values():
+                if entry.template not in fresh:
+                    fresh[entry.template] = entry.uptodate()
+            stale = [key for key, entry in self._entries.items() if not fresh[entry.template]]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            logger.info("Templates changed; dropped %d cached pages", len(stale))
+
+    def _build(self, template: str, context: dict) -> _Entry:
+        from flask import current_app, render_template
+
+        body = render_template(template, **context).encode("utf-8")
+        _, _, uptodate = current_app.jinja_env.loader.get_source(current_app.jinja_env, template)
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        bodies = {"identity": body}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            bodies["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                bodies["br"] = brotli.compress(body, quality=11)
+        return _Entry(template, etag, bodies, uptodate or (lambda: True))
+
+    def render(self, template: str, **context):
+        """``render_template(template, **context)`` as a cached, conditional response, shared for ``max_age``.
+
+        Only for pages whose context is the same for every visitor.
+        """
+        from flask import Response, request
+
+        self._check()
+        key = (template, _context_key(context))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            entry = self._build(template, context)
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            result = "miss"
+        else:
+            result = "hit"
+
+        accept = request.headers.get("Accept-Encoding")
+        coding = next((c for c in ("br", "gzip") if c in entry.bodies and accepts_encoding(accept, c)), "identity")
+        headers = {
+            "ETag": f'"{entry.etag}"' if coding == "identity" else f'"{entry.etag}-{coding}"',
+            "Vary": "Accept-Encoding",
+            "Cache-Control": f"public, max-age={self.max_age}",
+        }
+        if entry.etag in _tags(request.headers.get("If-None-Match")):
+            self._count(template, "not_modified")
+            return Response(status=304, headers=headers)
+        self._count(template, result)
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return Response(entry.bodies[coding], mimetype="text/html", headers=headers)
+
+    def invalidate(self) -> int:
+        """Drop every cached page; returns how many there were."""
+        with self._lock:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self.invalidations += 1
+        return dropped
+
+    def stats(self) -> dict:
+        with self._lock:
+            templates = {}
+            for template, c in self.counts.items():
+                served = c["hit"] + c["miss"] + c["not_modified"]
+                templates[template] = dict(c, hit_ratio=round((c["hit"] + c["not_modified"]) / served, 3) if served else 0)
+            total = {k: sum(c[k] for c in self.counts.values()) for k in ("hit", "miss", "not_modified")}
+            served = sum(total.values())
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(len(b) for e in self._entries.values() for b in e.bodies.values()),
+                "encodings": ["br", "gzip"] if brotli is not None else ["gzip"],
+                "invalidations": self.invalidations,
+                "hit_ratio": round((total["hit"] + total["not_modified"]) / served, 3) if served else 0,
+                **total,
+                "templates": templates,
+            }
+
+
+def create_cache() -> PageCache:
+    """Page cache configured from ``config``."""
+    return PageCache(max_entries=config.PAGE_CACHE_MAX_ENTRIES, max_age=config.PAGE_CACHE_MAX_AGE,
+                     check_interval=config.PAGE_CACHE_CHECK_INTERVAL)
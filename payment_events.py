@@ -0,0 +1,84 @@
+"""Push-style payment status feeds built on the store's change log.
+
+Players used to reload ``/check-status`` and the admin dashboard reloaded
+itself every 30s, re-rendering full templates each time. ``ChangeFeed`` lets
+a route wait for the next change instead:
+
+- writes made by this worker wake waiters immediately (store listener)
+- writes made by other gunicorn workers are picked up by re-reading the
+  store's change log every ``poll_interval`` seconds (an indexed query)
+
+Waits hold a gunicorn thread, so keep timeouts below ``--timeout``.
+"""
+import json
+import threading
+import time
+from typing import Iterator, Optional
+
+from payment_store import QUEUED, PENDING, PaymentStore
+
+# Statuses after which a payment will not change again on its own
+OPEN_STATUSES = (QUEUED, PENDING)
+
+# Longest single wait; gunicorn kills requests after --timeout=30
+MAX_WAIT = 25.0
+
+
+class ChangeFeed:
+    """Blocking waits on payment changes."""
+
+    def __init__(self, store: PaymentStore, poll_interval: float = 0.5):
+        self.store = store
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        store.add_listener(self._on_change)
+
+    def _on_change(self, record: dict) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, since: int, timeout: float, payment_id: Optional[str] = None, limit: int = 100) -> list:
+        """Return changes after ``since``, waiting up to ``timeout`` seconds.
+
+        Returns an empty list if nothing changed in time.
+        """
+        deadline = time.monotonic() + min(max(timeout, 0.0), MAX_WAIT)
+        while True:
+            changes = self.store.changes(since, limit=limit, payment_id=payment_id)
+            if changes:
+                return changes
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            with self._cond:
+                self._cond.wait(min(self.poll_interval, remaining))
+
+    def stream(self, payment_id: str, since: int = 0, duration: float = MAX_WAIT, heartbeat: float = 10.0) -> Iterator[str]:
+        """Yield server-sent events for ``payment_id`` until it settles.
+
+        Each change is sent as ``data: {...}``; comment lines keep idle
+        connections open through proxies.
+        """
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            changes = self.wait(since, min(heartbeat, remaining), payment_id=payment_id)
+            if not changes:
+                yield ": keep-alive\n\n"
+                continue
+            for change in changes:
+                since = change["seq"]
+                yield f"id: {since}\ndata: {json.dumps(public_status(change))}\n\n"
+                if change["status"] not in OPEN_STATUSES:
+                    return
+
+
+def public_status(record: dict) -> dict:
+    """The subset of a payment record that is safe to show its payer."""
+    return {
+        "payment_id": record["payment_id"],
+        "status": record["status"],
+        "seq": record.get("seq"),
+    }
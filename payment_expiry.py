@@ -0,0 +1,248 @@
+"""Expiry and archiving of payment records.
+
+Nothing used to remove a payment: abandoned PENDING entries stayed forever
+and every finished one stayed in the hot store, so the admin pages and the
+indexes kept growing. ``ExpiryService`` runs one background thread that:
+
+- keeps a min-heap of ``(deadline, payment_id)`` for QUEUED/PENDING
+  payments, fed by the store listener for this worker's writes and
+  re-seeded from the store every ``sweep_interval`` for other workers'
+- marks payments still open at their deadline ``EXPIRED`` with one batched
+  compare-and-set (``transition_many``), so a payment confirmed at the last
+  moment is never overwritten
+- every sweep, moves finished payments older than ``archive_after`` to the
+  ``archive`` ledger (fsynced) and then deletes them from the store, and
+  compacts the store's change log. A confirmed payment whose game has not
+  been played, or whose payout is not ``sent``, is still owed something and
+  stays in the store
+
+EXPIRED is not final for money that turns up late: callbacks, status
+queries and the admin confirm from it (``payment_store.CONFIRMABLE``).
+
+With the SQLite store only one gunicorn worker runs the service; the
+others stand by on a non-blocking ``flock`` and take over if it exits.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+import config
+import ledger
+import metrics
+from payment_store import QUEUED, PENDING, CONFIRMED, REJECTED, FAILED, EXPIRED, PaymentStore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+OPEN_STATUSES = (QUEUED, PENDING)
+FINISHED_STATUSES = (CONFIRMED, REJECTED, FAILED, EXPIRED)
+
+# Payout states that need nothing more; queued/sending are in progress and
+# failed/unknown wait for an admin (payouts.PayoutEngine.needs_attention)
+_PAYOUT_SETTLED = (None, "sent")
+
+
+def _archivable(record: dict) -> bool:
+    """Whether nothing is owed on ``record``: no unplayed game, no open payout."""
+    if record["status"] == CONFIRMED and record.get("prize") is None:
+        return False
+    return record.get("payout_status") in _PAYOUT_SETTLED
+
+
+class ExpiryService:
+    """Background TTL expiry plus archiving for one payment store."""
+
+    def __init__(self, store: PaymentStore, ttl: float, archive_after: float, archive: Optional[ledger.Ledger] = None,
+                 sweep_interval: float = 60.0, batch_size: int = 200, lock_path: Optional[str] = None):
+        self.store = store
+        self.ttl = ttl
+        self.archive_after = archive_after
+        self.archive_ledger = archive
+        self.sweep_interval = sweep_interval
+        self.batch_size = batch_size
+        self.lock_path = lock_path
+        self._heap = []
+        self._scheduled = set()
+        self._cond = threading.Condition()
+        self._pid = None
+        self._lock_file = None
+        self._leading = False
+        self._closed = False
+        self.expired = 0
+        self.archived = 0
+        self.compacted = 0
+        self.sweeps = 0
+        store.add_listener(self._on_change)
+
+    def _schedule(self, record: dict) -> None:
+        # caller holds self._cond
+        payment_id = record["payment_id"]
+        if payment_id in self._scheduled:
+            return
+        deadline = record["created_at"] + self.ttl
+        self._scheduled.add(payment_id)
+        heapq.heappush(self._heap, (deadline, payment_id))
+        if self._heap[0][1] == payment_id:
+            self._cond.notify()
+
+    def _on_change(self, record: dict) -> None:
+        # standby workers leave scheduling to the leader's sweeps
+        if self._leading and record["status"] in OPEN_STATUSES:
+            with self._cond:
+                self._schedule(record)
+
+    def start(self) -> None:
+        """Start the worker thread in this process (idempotent, fork-aware)."""
+        if self._pid == os.getpid() or self._closed:
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # forked children inherit the parent's heap; rebuild from the store
+            self._heap, self._scheduled = [], set()
+            self._leading = False
+        threading.Thread(target=self._run, name="payment-expiry", daemon=True).start()
+
+    def _lead(self) -> bool:
+        """Whether this process should run the sweeps (one per lock file)."""
+        if not self.lock_path or fcntl is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _run(self) -> None:
+        while not self._lead():
+            if self._closed:
+                return
+            time.sleep(self.sweep_interval)
+        self._leading = True
+        logger.info("Payment expiry running in pid %s (ttl=%ss)", os.getpid(), self.ttl)
+        next_sweep = 0.0
+        while not self._closed:
+            try:
+                if time.time() >= next_sweep:
+                    self.sweep()
+                    next_sweep = time.time() + self.sweep_interval
+                self.expire_due()
+            except Exception:
+                logger.exception("Payment expiry pass failed")
+            with self._cond:
+                wake = next_sweep
+                if self._heap:
+                    wake = min(wake, self._heap[0][0])
+                self._cond.wait(max(0.05, wake - time.time()))
+
+    def _seed(self) -> None:
+        for status in OPEN_STATUSES:
+            records = self.store.by_status(status)
+            with self._cond:
+                for record in records:
+                    self._schedule(record)
+
+    def expire_due(self, now: Optional[float] = None) -> int:
+        """Expire every scheduled payment whose deadline has passed."""
+        now = time.time() if now is None else now
+        expired = 0
+        while True:
+            with self._cond:
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                    _, payment_id = heapq.heappop(self._heap)
+                    self._scheduled.discard(payment_id)
+                    due.append(payment_id)
+            if not due:
+                break
+            results = self.store.transition_many(due, EXPIRED, from_statuses=OPEN_STATUSES,
+                                                 expired_at=datetime.now().isoformat())
+            expired += sum(1 for r in results.values() if r)
+        if expired:
+            logger.info("Expired %d unconfirmed payments", expired)
+            self.expired += expired
+        return expired
+
+    def archive(self, now: Optional[float] = None) -> int:
+        """Move finished payments older than ``archive_after`` to the ledger."""
+        if self.archive_ledger is None or not self.archive_after:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.archive_after
+        archived = 0
+        for status in FINISHED_STATUSES:
+            cursor = None
+            while True:
+                page, cursor = self.store.query(status=status, until=cutoff, cursor=cursor, limit=self.batch_size)
+                done = [r for r in page if _archivable(r)]
+                if done:
+                    # durable copy first (written and fsynced here, not left to
+                    # the buffered flusher): a crash only leaves a repeat line
+                    # (same payment_id) in the archive
+                    self.archive_ledger.append_durable([
+                        {"ts": datetime.now().isoformat(), "event": "payment_archived", "pid": os.getpid(), "payment": r}
+                        for r in done
+                    ])
+                    archived += len(self.store.remove_many(done))
+                if not cursor:
+                    break
+        if archived:
+            logger.info("Archived %d finished payments", archived)
+            self.archived += archived
+        return archived
+
+    def sweep(self) -> None:
+        """Re-seed the expiry heap, archive, and compact the change log."""
+        self._seed()
+        self.archive()
+        self.compacted += self.store.compact_events()
+        self.sweeps += 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            scheduled = len(self._heap)
+            next_deadline = self._heap[0][0] if self._heap else None
+        return {
+            "scheduled": scheduled,
+            "next_expiry_in": round(next_deadline - time.time(), 1) if next_deadline else None,
+            "ttl": self.ttl,
+            "archive_after": self.archive_after,
+            "expired": self.expired,
+            "archived": self.archived,
+            "compacted_events": self.compacted,
+            "sweeps": self.sweeps,
+            "leader": self._leading,
+        }
+
+    def close(self) -> None:
+        self._closed = True
+        with self._cond:
+            self._cond.notify_all()
+
+
+def create_service(store: PaymentStore) -> ExpiryService:
+    """Service for ``store`` configured from ``config``; call ``start()`` in the worker."""
+    lock_path = None
+    if getattr(store, "path", None):
+        lock_path = store.path + ".expiry.lock"
+    service = ExpiryService(
+        store,
+        ttl=config.PAYMENT_TTL,
+        archive_after=config.PAYMENT_ARCHIVE_AFTER,
+        archive=ledger.get_ledger("archive"),
+        sweep_interval=config.PAYMENT_SWEEP_INTERVAL,
+        lock_path=lock_path,
+    )
+    metrics.gauge_callback("payment_expiry_scheduled", "Open payments on the expiry heap",
+                           lambda: len(service._heap))
+    return service
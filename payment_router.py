@@ -0,0 +1,488 @@
+"""Route new payments between Daraja and Flutterwave by provider health.
+
+When Daraja is slow, ``/pay`` used to wait out the 15 s STK Push timeout
+and fail, while the complete Flutterwave checkout path sat unused.
+``PaymentRouter`` starts each new payment with one of several providers:
+
+- every call's latency and success feed a rolling ``window`` per provider
+  (``ProviderHealth``)
+- a provider's breaker opens when, over at least ``min_calls`` calls, its
+  error rate reaches ``error_rate`` or its p95 latency reaches
+  ``slow_seconds``. Open providers get no payments; after ``cooldown``
+  seconds one probe payment is let through (half-open), and its result
+  closes or reopens the breaker
+- payments go to the first provider in preference order (``order``, Daraja
+  first: the customer gets a prompt, not a link) whose breaker is closed
+  and which is not degraded (past half of either threshold); a provider
+  that fails to start a payment is failed over to the next one at once
+- with ``hedge_after`` > 0, a primary that has not answered after that
+  many seconds gets the next provider started alongside it, and the first
+  to succeed wins. If the loser starts too, its ids are still indexed on
+  the payment so paying through it settles the same record — but the
+  customer may then see both a prompt and a checkout link, so hedging is
+  off by default
+
+Health is per worker. Decisions and breaker states are in ``stats()``,
+the ``payment_routes`` and ``payment_breaker_transitions`` counters and
+the ``payment_breaker_state`` gauge. ``route`` runs the sync providers,
+``aroute`` the coroutine ones (app_async.py).
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Callable, Optional
+
+import config
+import metrics
+from payment_store import QUEUED, PENDING, FAILED, PaymentStore
+from reconcile import REFERENCE_FIELDS
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+PAYMENT_ROUTES = metrics.counter(
+    "payment_routes", "Payment starts by provider, routing decision (primary, failover, hedge) and result",
+    ("provider", "decision", "result"))
+BREAKER_TRANSITIONS = metrics.counter(
+    "payment_breaker_transitions", "Provider circuit breaker state changes", ("provider", "state"))
+
+
+class Outcome(namedtuple("Outcome", "provider ok references link message")):
+    """Result of starting a payment with one provider.
+
+    ``references`` are the provider's ids for it (CheckoutRequestID,
+    tx_ref...), first the one status queries use; ``link`` is a checkout
+    URL for the customer, if the provider needs one.
+    """
+    __slots__ = ()
+
+    @property
+    def reference(self) -> Optional[str]:
+        return self.references[0] if self.references else None
+
+
+NO_PROVIDER = Outcome(None, False, (), None, "No payment provider is available right now")
+
+
+class ProviderHealth:
+    """Rolling latency / error window and circuit breaker for one provider."""
+
+    def __init__(self, name: str, window: float = 60.0, min_calls: int = 5, error_rate: float = 0.5,
+                 slow_seconds: float = 8.0, cooldown: float = 30.0, max_samples: int = 500):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self._samples = deque(maxlen=max_samples)  # (monotonic time, seconds, ok)
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self.calls = 0
+        self.errors = 0
+        self.opened = 0
+
+    def _trim(self, now: float) -> None:
+        # caller holds self._lock
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+
+    def _summary(self, now: float) -> tuple:
+        # caller holds self._lock; (calls, error rate, p50, p95) over the window
+        self._trim(now)
+        if not self._samples:
+            return 0, 0.0, 0.0, 0.0
+        latencies = sorted(s[1] for s in self._samples)
+        errors = sum(1 for s in self._samples if not s[2])
+        n = len(latencies)
+        return n, errors / n, latencies[n // 2], latencies[min(n - 1, int(n * 0.95))]
+
+    def _set_state(self, state: str, now: float) -> None:
+        # caller holds self._lock
+        if state == self.state:
+            return
+        self.state = state
+        if state == OPEN:
+            self._opened_at = now
+            self.opened += 1
+        self._probing = False
+        BREAKER_TRANSITIONS.inc(provider=self.name, state=state)
+        logger.warning("Payment provider %s breaker %s", self.name, state)
+
+    def current_state(self) -> str:
+        """Breaker state, moving OPEN to HALF_OPEN once the cooldown is over."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self._opened_at >= self.cooldown:
+                self._set_state(HALF_OPEN, now)
+            return self.state
+
+    def degraded(self) -> bool:
+        """Past half of either breaker threshold while still closed."""
+        with self._lock:
+            calls, error_rate, _, p95 = self._summary(time.monotonic())
+        return calls >= self.min_calls and (error_rate >= self.error_rate / 2 or p95 >= self.slow_seconds / 2)
+
+    def allow(self) -> bool:
+        """Whether a payment may be started now (takes the probe slot when half-open)."""
+        state = self.current_state()
+        with self._lock:
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, seconds: float, ok: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            if self.state == HALF_OPEN:
+                if ok:
+                    # a fresh start: the samples that opened it are history
+                    self._samples.clear()
+                    self._set_state(CLOSED, now)
+                else:
+                    self._set_state(OPEN, now)
+            self._samples.append((now, seconds, ok))
+            if self.state == CLOSED:
+                calls, error_rate, _, p95 = self._summary(now)
+                if calls >= self.min_calls and (error_rate >= self.error_rate or p95 >= self.slow_seconds):
+                    self._set_state(OPEN, now)
+
+    def stats(self) -> dict:
+        state = self.current_state()
+        with self._lock:
+            calls, error_rate, p50, p95 = self._summary(time.monotonic())
+            return {
+                "state": state,
+                "window_calls": calls,
+                "error_rate": round(error_rate, 3),
+                "p50_ms": round(p50 * 1000, 1),
+                "p95_ms": round(p95 * 1000, 1),
+                "calls": self.calls,
+                "errors": self.errors,
+                "opened": self.opened,
+            }
+
+
+class PaymentRouter:
+    """Starts payments with the healthiest provider; see the module docstring.
+
+    ``providers`` maps a provider name (see ``reconcile.REFERENCE_FIELDS``)
+    to ``start(reference, phone, amount) -> Outcome``; ``async_providers``
+    likewise to a coroutine function, for ``aroute``. ``order`` is the
+    preference among healthy providers.
+    """
+
+    def __init__(self, providers: dict, async_providers: Optional[dict] = None, order: Optional[list] = None,
+                 hedge_after: float = 0.0, hedge_workers: int = 4, recent: int = 50, **health):
+        self.providers = providers
+        self.async_providers = async_providers or {}
+        self.order = [name for name in (order or list(providers)) if name in providers or name in self.async_providers]
+        self.hedge_after = hedge_after
+        self.hedge_workers = hedge_workers
+        self.health = {name: ProviderHealth(name, **health) for name in self.order}
+        self.decisions = {name: {"primary": 0, "failover": 0, "hedge": 0, "won": 0} for name in self.order}
+        self.recent = deque(maxlen=recent)
+        self.unrouted = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._late_tasks = set()
+
+    def candidates(self) -> list:
+        """Providers in the order the next payment would try them (open breakers left out)."""
+        ranked = []
+        for index, name in enumerate(self.order):
+            health = self.health[name]
+            state = health.current_state()
+            if state != OPEN:
+                # a half-open provider keeps its place: the probe is how it recovers
+                ranked.append((state == CLOSED and health.degraded(), index, name))
+        return [name for _, _, name in sorted(ranked)]
+
+    def _start(self, decision: str, queue: list) -> Optional[str]:
+        """Next provider in ``queue`` whose breaker lets a payment through."""
+        while queue:
+            name = queue.pop(0)
+            if self.health[name].allow():
+                with self._lock:
+                    self.decisions[name][decision] += 1
+                return name
+        return None
+
+    def _finish(self, reference: str, name: str, decision: str, outcome: Outcome, seconds: float, won: bool) -> None:
+        self.health[name].record(seconds, outcome.ok)
+        PAYMENT_ROUTES.inc(provider=name, decision=decision, result="ok" if outcome.ok else "failed")
+        with self._lock:
+            if won:
+                self.decisions[name]["won"] += 1
+            self.recent.append({
+                "at": datetime.now().isoformat(timespec="seconds"),
+                "payment_id": reference,
+                "provider": name,
+                "decision": decision,
+                "ok": outcome.ok,
+                "won": won,
+                "ms": round(seconds * 1000, 1),
+                "message": outcome.message,
+            })
+
+    def _call(self, name: str, reference: str, phone: str, amount: int) -> tuple:
+        started = time.perf_counter()
+        try:
+            outcome = self.providers[name](reference, phone, amount)
+        except Exception as e:
+            logger.exception("Starting payment %s with %s failed", reference, name)
+            outcome = Outcome(name, False, (), None, f"Error: {e}")
+        return outcome, time.perf_counter() - started
+
+    async def _acall(self, name: str, reference: str, phone: str, amount: int) -> tuple:
+        started = time.perf_counter()
+        try:
+            outcome = await self.async_providers[name](reference, phone, amount)
+        except Exception as e:
+            logger.exception("Starting payment %s with %s failed", reference, name)
+            outcome = Outcome(name, False, (), None, f"Error: {e}")
+        return outcome, time.perf_counter() - started
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix="hedge")
+                self._pid = os.getpid()
+            return self._executor
+
+    def _no_provider(self, reference: str) -> Outcome:
+        with self._lock:
+            self.unrouted += 1
+        logger.error("No payment provider available for %s", reference)
+        return NO_PROVIDER
+
+    def route(self, reference: str, phone: str, amount: int,
+              on_late: Optional[Callable[[Outcome], None]] = None) -> Outcome:
+        """Start payment ``reference``; returns the winning (or last failed) ``Outcome``.
+
+        ``on_late(outcome)`` is called for a hedged call that also succeeded
+        after the winner was returned.
+        """
+        queue = self.candidates()
+        name = self._start("primary", queue)
+        if name is None:
+            return self._no_provider(reference)
+        if not (self.hedge_after > 0 and queue):
+            decision = "primary"
+            while True:
+                outcome, seconds = self._call(name, reference, phone, amount)
+                self._finish(reference, name, decision, outcome, seconds, outcome.ok)
+                if outcome.ok:
+                    return outcome
+                name, decision = self._start("failover", queue), "failover"
+                if name is None:
+                    return outcome
+
+        pool = self._pool()
+        pending = {pool.submit(self._call, name, reference, phone, amount): (name, "primary")}
+        deadline = time.monotonic() + self.hedge_after
+        hedged = False
+        last = None
+        while pending:
+            timeout = None if hedged else max(0.0, deadline - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                name = self._start("hedge", queue)
+                if name is not None:
+                    logger.info("Payment %s: no answer from %s after %.1fs, hedging to %s",
+                                reference, pending[next(iter(pending))][0], self.hedge_after, name)
+                    pending[pool.submit(self._call, name, reference, phone, amount)] = (name, "hedge")
+                continue
+            for future in done:
+                name, decision = pending.pop(future)
+                last, seconds = future.result()
+                self._finish(reference, name, decision, last, seconds, last.ok)
+                if last.ok:
+                    for other, (other_name, other_decision) in pending.items():
+                        other.add_done_callback(self._late(reference, other_name, other_decision, on_late))
+                    return last
+            if not pending:
+                name = self._start("failover", queue)
+                if name is not None:
+                    pending[pool.submit(self._call, name, reference, phone, amount)] = (name, "failover")
+        return last
+
+    def _late(self, reference: str, name: str, decision: str, on_late):
+        def done(future):
+            outcome, seconds = future.result()
+            self._finish(reference, name, decision, outcome, seconds, False)
+            if outcome.ok and on_late is not None:
+                try:
+                    on_late(outcome)
+                except Exception:
+                    logger.exception("Late outcome handler failed for %s", reference)
+        return done
+
+    async def aroute(self, reference: str, phone: str, amount: int,
+                     on_late: Optional[Callable[[Outcome], None]] = None) -> Outcome:
+        """``route`` for coroutine providers (``async_providers``)."""
+        import asyncio  # not at module level: sync workers never need it
+
+        queue = self.candidates()
+        name = self._start("primary", queue)
+        if name is None:
+            return self._no_provider(reference)
+        pending = {asyncio.create_task(self._acall(name, reference, phone, amount)): (name, "primary")}
+        deadline = time.monotonic() + self.hedge_after
+        hedged = not (self.hedge_after > 0)
+        last = None
+        while pending:
+            timeout = None if hedged else max(0.0, deadline - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                name = self._start("hedge", queue)
+                if name is not None:
+                    pending[asyncio.create_task(self._acall(name, reference, phone, amount))] = (name, "hedge")
+                continue
+            for task in done:
+                name, decision = pending.pop(task)
+                last, seconds = task.result()
+                self._finish(reference, name, decision, last, seconds, last.ok)
+                if last.ok:
+                    for other, (other_name, other_decision) in pending.items():
+                        # keep a reference: the loop only holds tasks weakly
+                        self._late_tasks.add(other)
+                        other.add_done_callback(self._late_tasks.discard)
+                        other.add_done_callback(self._late(reference, other_name, other_decision, on_late))
+                    return last
+            if not pending:
+                name = self._start("failover", queue)
+                if name is not None:
+                    pending[asyncio.create_task(self._acall(name, reference, phone, amount))] = (name, "failover")
+        return last
+
+    def stats(self) -> dict:
+        with self._lock:
+            decisions = {name: dict(d) for name, d in self.decisions.items()}
+            recent = list(self.recent)
+            unrouted = self.unrouted
+        return {
+            "order": self.order,
+            "next": self.candidates(),
+            "hedge_after": self.hedge_after,
+            "unrouted": unrouted,
+            "providers": {name: dict(h.stats(), decisions=decisions[name]) for name, h in self.health.items()},
+            "recent": recent,
+        }
+
+
+def record_outcome(store: PaymentStore, payment_id: str, outcome: Outcome) -> Optional[dict]:
+    """Move a QUEUED payment to PENDING with the provider's ids indexed, or to FAILED."""
+    if not outcome.ok:
+        return store.transition(payment_id, FAILED, from_statuses=(QUEUED,),
+                                message=outcome.message or "Payment could not be started")
+    # index the provider's ids so its callback / status query finds this payment
+    for reference in outcome.references:
+        store.add_reference(payment_id, reference)
+    fields = {"provider": outcome.provider, "message": outcome.message}
+    if outcome.reference and outcome.provider in REFERENCE_FIELDS:
+        fields[REFERENCE_FIELDS[outcome.provider]] = outcome.reference
+    if outcome.link:
+        fields["payment_link"] = outcome.link
+    return store.transition(payment_id, PENDING, from_statuses=(QUEUED,), **fields)
+
+
+def record_late(store: PaymentStore, payment_id: str, outcome: Outcome) -> None:
+    """A hedged call that also started: paying through it must settle the same payment."""
+    for reference in outcome.references:
+        store.add_reference(payment_id, reference)
+    logger.warning("Payment %s was also started with %s (%s); a second payment would need a refund",
+                   payment_id, outcome.provider, outcome.reference)
+
+
+def daraja_provider(stk_push: Callable[[str, int], Optional[str]]) -> Callable[[str, str, int], Outcome]:
+    """Router provider for an ``mpesa.stk_push``-style call returning a CheckoutRequestID or None."""
+    def start(reference, phone, amount):
+        checkout_id = stk_push(phone, amount)
+        if checkout_id:
+            return Outcome("daraja", True, (checkout_id,), None, "Check your phone for M-Pesa prompt!")
+        return Outcome("daraja", False, (), None, "STK Push failed")
+    return start
+
+
+def daraja_provider_async(stk_push_async) -> Callable:
+    """``daraja_provider`` for ``mpesa.stk_push_async``."""
+    async def start(reference, phone, amount):
+        checkout_id = await stk_push_async(phone, amount)
+        if checkout_id:
+            return Outcome("daraja", True, (checkout_id,), None, "Check your phone for M-Pesa prompt!")
+        return Outcome("daraja", False, (), None, "STK Push failed")
+    return start
+
+
+def flutterwave_outcome(result: dict) -> Outcome:
+    """Outcome for a ``flutterwave_pay.create_payment`` result."""
+    if result.get("tx_ref") and (result.get("link") or result.get("simulated")):
+        return Outcome("flutterwave", True, (result["tx_ref"],), result.get("link"),
+                       "M-Pesa prompts are delayed; complete your payment with Flutterwave")
+    return Outcome("flutterwave", False, (), None, result.get("message") or "Flutterwave payment failed")
+
+
+def create_router(daraja: Optional[Callable] = None, daraja_async: Optional[Callable] = None) -> PaymentRouter:
+    """Router configured from ``config`` over ``PAYMENT_PROVIDERS``.
+
+    ``daraja`` / ``daraja_async`` default to ``mpesa``'s STK push; apps with
+    their own Daraja credentials pass theirs. Flutterwave takes part only
+    when its keys are set: its simulated mode would confirm a payment the
+    customer never made.
+    """
+    import flutterwave_pay
+    import mpesa
+
+    def flutterwave(reference, phone, amount):
+        return flutterwave_outcome(flutterwave_pay.create_payment(
+            phone, flutterwave_pay.FLW_CUSTOMER_EMAIL, amount, tx_ref=reference))
+
+    async def flutterwave_async(reference, phone, amount):
+        return flutterwave_outcome(await flutterwave_pay.create_payment_async(
+            phone, flutterwave_pay.FLW_CUSTOMER_EMAIL, amount, tx_ref=reference))
+
+    providers = {"daraja": daraja or daraja_provider(mpesa.stk_push)}
+    async_providers = {"daraja": daraja_async or daraja_provider_async(mpesa.stk_push_async)}
+    if flutterwave_pay.configured():
+        providers["flutterwave"] = flutterwave
+        async_providers["flutterwave"] = flutterwave_async
+    order = [name.strip() for name in config.PAYMENT_PROVIDERS.split(",") if name.strip()]
+    skipped = [name for name in order if name not in providers]
+    if skipped:
+        logger.info("Payment providers not configured, not routed to: %s", ", ".join(skipped))
+    router = PaymentRouter(
+        providers,
+        async_providers=async_providers,
+        order=order,
+        hedge_after=config.PAYMENT_HEDGE_AFTER,
+        hedge_workers=2 * config.DISPATCH_WORKERS,
+        window=config.PAYMENT_ROUTE_WINDOW,
+        min_calls=config.PAYMENT_BREAKER_MIN_CALLS,
+        error_rate=config.PAYMENT_BREAKER_ERROR_RATE,
+        slow_seconds=config.PAYMENT_BREAKER_SLOW_SECONDS,
+        cooldown=config.PAYMENT_BREAKER_COOLDOWN,
+    )
+    metrics.gauge_callback("payment_breaker_state", "Provider circuit breaker: 0 closed, 1 half-open, 2 open",
+                           lambda: {name: _STATE_VALUES[h.state] for name, h in router.health.items()},
+                           ("provider",))
+    return router
@@ -0,0 +1,947 @@
+"""Payment store shared by the Flask apps.
+
+Gunicorn runs several worker processes, so module-level dicts give each
+worker its own private view of payments. This module provides a small store
+interface with two backends:
+
+- ``MemoryPaymentStore`` — process-local, handy for tests and ``python app.py``
+- ``SQLitePaymentStore`` — a WAL-mode SQLite file shared by every worker
+
+Both keep indexes on payment_id, phone and status so lookups never scan the
+full table. Use ``get_store()`` to get the backend selected in ``config``.
+"""
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Iterable, Optional
+
+import config
+import metrics
+import phones
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "QUEUED"  # accepted, upstream request not sent yet
+PENDING = "PENDING"
+CONFIRMED = "CONFIRMED"
+REJECTED = "REJECTED"
+FAILED = "FAILED"
+EXPIRED = "EXPIRED"  # still open when its TTL ran out (payment_expiry.py)
+
+# Statuses a payment may be confirmed from: money that arrives (or an admin
+# who checks it) after the TTL still settles the payment
+CONFIRMABLE = (QUEUED, PENDING, EXPIRED)
+
+# Columns stored natively; anything else goes into the JSON ``data`` blob.
+_CORE_FIELDS = ("payment_id", "phone", "amount", "status", "created_at", "updated_at")
+
+
+def _phone_key(phone: str) -> str:
+    """Canonical form used for storage and lookups; unrecognised input is kept as is."""
+    return phones.try_normalize(phone) or phone
+
+
+def _new_record(payment_id: str, phone: str, amount: int, status: str, extra: dict) -> dict:
+    now = time.time()
+    record = {
+        "payment_id": payment_id,
+        "phone": _phone_key(phone),
+        "amount": int(amount),
+        "status": status,
+        "timestamp": datetime.fromtimestamp(now).isoformat(),
+        "created_at": now,
+        "updated_at": now,
+    }
+    record.update(extra)
+    return record
+
+
+def _number(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _totals_delta(old: Optional[dict], new: dict) -> dict:
+    """Change to the aggregate counters when ``old`` becomes ``new``."""
+    delta = {}
+    for record, sign in ((old, -1), (new, 1)):
+        if record is None:
+            continue
+        key = f"count:{record['status']}"
+        delta[key] = delta.get(key, 0) + sign
+        if record["status"] == CONFIRMED:
+            delta["collected"] = delta.get("collected", 0) + sign * record["amount"]
+        prize = _number(record.get("prize"))
+        if prize:
+            delta["prizes"] = delta.get("prizes", 0) + sign * prize
+    return {k: v for k, v in delta.items() if v}
+
+
+def _totals_view(counters: dict) -> dict:
+    counts = {k[6:]: int(v) for k, v in counters.items() if k.startswith("count:") and v}
+    return {
+        "counts": counts,
+        "total": sum(counts.values()),
+        "collected": counters.get("collected", 0),
+        "prizes": counters.get("prizes", 0),
+    }
+
+
+def _matches(record: dict, expected: dict) -> bool:
+    return all(record.get(k) == v for k, v in expected.items())
+
+
+def encode_cursor(record: dict) -> str:
+    """Opaque keyset cursor pointing just past ``record``."""
+    raw = json.dumps([record["created_at"], record["payment_id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of ``encode_cursor``; raises ValueError on garbage."""
+    try:
+        created_at, payment_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(created_at), str(payment_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+class PaymentStore:
+    """Interface shared by the store backends.
+
+    Records are plain dicts with at least ``payment_id``, ``phone``,
+    ``amount``, ``status``, ``timestamp``, ``created_at`` and ``updated_at``.
+    Callers always get copies; mutate through ``update``/``transition``.
+
+    Every write also appends to a change log with an increasing sequence
+    number, which ``changes`` reads to build status and admin delta feeds.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def add_listener(self, fn) -> None:
+        """Call ``fn(record)`` after every write made by this process."""
+        self._listeners.append(fn)
+
+    def _notify(self, record: dict) -> None:
+        for fn in self._listeners:
+            try:
+                fn(record)
+            except Exception:
+                logger.exception("Payment store listener failed")
+
+    def create(self, payment_id: str, phone: str, amount: int, status: str = PENDING, **extra) -> dict:
+        raise NotImplementedError
+
+    def create_unless_open(self, payment_id: str, phone: str, amount: int, since: float, status: str = PENDING,
+                           open_statuses: Iterable[str] = (QUEUED, PENDING), **extra) -> tuple:
+        """Create a payment unless ``phone`` already has an open one.
+
+        Atomically returns ``(find_open(...), False)`` if there is a payment
+        for ``phone`` created at or after ``since`` that is still in
+        ``open_statuses``, else ``(new record, True)``.
+        """
+        raise NotImplementedError
+
+    def find_open(self, phone: str, since: float, open_statuses: Iterable[str] = (QUEUED, PENDING)) -> Optional[dict]:
+        """Newest payment for ``phone`` created since ``since`` and still open."""
+        raise NotImplementedError
+
+    def get(self, payment_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def update(self, payment_id: str, **fields) -> Optional[dict]:
+        """Merge ``fields`` into a record. Returns the new record or None."""
+        raise NotImplementedError
+
+    def transition(self, payment_id: str, to_status: str, from_statuses: Iterable[str] = (PENDING,), **fields) -> Optional[dict]:
+        """Atomically move a record to ``to_status``.
+
+        The change only happens if the current status is in
+        ``from_statuses``; otherwise None is returned and nothing is written.
+        """
+        raise NotImplementedError
+
+    def update_if(self, payment_id: str, expected: dict, **fields) -> Optional[dict]:
+        """Compare-and-set: merge ``fields`` only if every ``expected`` field
+        currently has that value (None matches a missing field).
+
+        Returns the new record, or None if the record is missing or differs.
+        """
+        raise NotImplementedError
+
+    def transition_many(self, payment_ids: Iterable[str], to_status: str, from_statuses: Iterable[str] = (PENDING,), **fields) -> dict:
+        """``transition`` for many payments in one transaction.
+
+        Returns ``{payment_id: record or None}`` in input order; repeated
+        ids are applied once.
+        """
+        raise NotImplementedError
+
+    def add_reference(self, payment_id: str, reference: str) -> None:
+        """Index a provider id (e.g. a Daraja CheckoutRequestID) for ``payment_id``."""
+        raise NotImplementedError
+
+    def resolve(self, reference: str) -> Optional[str]:
+        """Map a provider id, or a payment_id itself, to a payment_id."""
+        raise NotImplementedError
+
+    def by_phone(self, phone: str, status: Optional[str] = None) -> list:
+        raise NotImplementedError
+
+    def by_status(self, status: str, limit: Optional[int] = None) -> list:
+        """Records with ``status``, oldest first."""
+        raise NotImplementedError
+
+    def by_payout_status(self, payout_statuses: Iterable[str], limit: Optional[int] = None) -> list:
+        """Records whose ``payout_status`` is one of ``payout_statuses``, oldest first (indexed)."""
+        raise NotImplementedError
+
+    def count(self, status: Optional[str] = None) -> int:
+        raise NotImplementedError
+
+    def query(self, status: Optional[str] = None, phone: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, cursor: Optional[str] = None, limit: int = 50) -> tuple:
+        """One page of records, newest first.
+
+        ``since``/``until`` bound ``created_at`` (epoch seconds, until is
+        exclusive). Returns ``(records, next_cursor)``; ``next_cursor`` is
+        None on the last page.
+        """
+        raise NotImplementedError
+
+    def totals(self) -> dict:
+        """Aggregates maintained on every write, so reading them is O(1).
+
+        ``{"counts": {status: n}, "total": n, "collected": KES confirmed,
+        "prizes": KES in prizes}``
+        """
+        raise NotImplementedError
+
+    def latest_seq(self) -> int:
+        """Sequence number of the most recent change (0 if none)."""
+        raise NotImplementedError
+
+    def changes(self, since: int, limit: int = 100, payment_id: Optional[str] = None) -> list:
+        """Records changed after sequence ``since``, oldest change first.
+
+        Each payment appears once, in its current state, with a ``seq`` key
+        holding its latest change number.
+        """
+        raise NotImplementedError
+
+    def remove_many(self, records: Iterable[dict]) -> list:
+        """Delete payments (and their references and change events).
+
+        Only records whose ``updated_at`` still matches the given snapshot
+        are removed, so a payment that changed since it was read (e.g. for
+        archiving) is kept. Returns the removed payment_ids. Totals are
+        lifetime figures and are not reduced.
+        """
+        raise NotImplementedError
+
+    def compact_events(self) -> int:
+        """Drop change-log rows superseded by a later change to the same
+        payment; ``changes`` only ever returns the latest. Returns rows removed."""
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryPaymentStore(PaymentStore):
+    """Thread-safe in-process store with dict-based secondary indexes."""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._records = {}
+        self._by_phone = {}
+        # dicts (not sets) so insertion order gives oldest-first iteration
+        self._by_status = {}
+        self._by_payout = {}
+        self._references = {}
+        # payment_id -> seq of its last change, kept in seq order
+        self._changed = OrderedDict()
+        self._seq = 0
+        self._totals = {}
+
+    def _log_change(self, record: dict, old: Optional[dict] = None) -> None:
+        for key, value in _totals_delta(old, record).items():
+            self._totals[key] = self._totals.get(key, 0) + value
+        self._seq += 1
+        self._changed[record["payment_id"]] = self._seq
+        self._changed.move_to_end(record["payment_id"])
+
+    def _index(self, record: dict) -> None:
+        self._by_phone.setdefault(record["phone"], {})[record["payment_id"]] = None
+        self._by_status.setdefault(record["status"], {})[record["payment_id"]] = None
+        if record.get("payout_status") is not None:
+            self._by_payout.setdefault(record["payout_status"], {})[record["payment_id"]] = None
+
+    def _unindex(self, record: dict) -> None:
+        self._by_phone.get(record["phone"], {}).pop(record["payment_id"], None)
+        self._by_status.get(record["status"], {}).pop(record["payment_id"], None)
+        if record.get("payout_status") is not None:
+            self._by_payout.get(record["payout_status"], {}).pop(record["payment_id"], None)
+
+    def create(self, payment_id, phone, amount, status=PENDING, **extra):
+        record = _new_record(payment_id, phone, amount, status, extra)
+        with self._lock:
+            if payment_id in self._records:
+                raise KeyError(f"Payment {payment_id} already exists")
+            self._records[payment_id] = record
+            self._index(record)
+            self._log_change(record)
+            record = dict(record)
+        self._notify(record)
+        return record
+
+    def _find_open(self, phone: str, since: float, open_statuses: tuple) -> Optional[dict]:
+        # caller holds the lock
+        newest = None
+        for payment_id in self._by_phone.get(phone, {}):
+            r = self._records[payment_id]
+            if r["created_at"] >= since and r["status"] in open_statuses:
+                if newest is None or r["created_at"] > newest["created_at"]:
+                    newest = r
+        return newest
+
+    def find_open(self, phone, since, open_statuses=(QUEUED, PENDING)):
+        with self._lock:
+            record = self._find_open(_phone_key(phone), since, tuple(open_statuses))
+            return dict(record) if record else None
+
+    def create_unless_open(self, payment_id, phone, amount, since, status=PENDING,
+                           open_statuses=(QUEUED, PENDING), **extra):
+        record = _new_record(payment_id, phone, amount, status, extra)
+        with self._lock:
+            existing = self._find_open(record["phone"], since, tuple(open_statuses))
+            if existing is not None:
+                return dict(existing), False
+            if payment_id in self._records:
+                raise KeyError(f"Payment {payment_id} already exists")
+            self._records[payment_id] = record
+            self._index(record)
+            self._log_change(record)
+            record = dict(record)
+        self._notify(record)
+        return record, True
+
+    def get(self, payment_id):
+        with self._lock:
+            record = self._records.get(payment_id)
+            return dict(record) if record else None
+
+    def _apply(self, record: dict, fields: dict) -> dict:
+        old = dict(record)
+        self._unindex(record)
+        record.update(fields)
+        record["updated_at"] = time.time()
+        self._index(record)
+        self._log_change(record, old)
+        return dict(record)
+
+    def update(self, payment_id, **fields):
+        fields.pop("payment_id", None)
+        with self._lock:
+            record = self._records.get(payment_id)
+            if record is None:
+                return None
+            record = self._apply(record, fields)
+        self._notify(record)
+        return record
+
+    def transition(self, payment_id, to_status, from_statuses=(PENDING,), **fields):
+        with self._lock:
+            record = self._records.get(payment_id)
+            if record is None or record["status"] not in tuple(from_statuses):
+                return None
+            fields["status"] = to_status
+            record = self._apply(record, fields)
+        self._notify(record)
+        return record
+
+    def update_if(self, payment_id, expected, **fields):
+        fields.pop("payment_id", None)
+        with self._lock:
+            record = self._records.get(payment_id)
+            if record is None or not _matches(record, expected):
+                return None
+            record = self._apply(record, fields)
+        self._notify(record)
+        return record
+
+    def transition_many(self, payment_ids, to_status, from_statuses=(PENDING,), **fields):
+        from_statuses = tuple(from_statuses)
+        fields["status"] = to_status
+        results = {}
+        with self._lock:
+            for payment_id in dict.fromkeys(payment_ids):
+                record = self._records.get(payment_id)
+                if record is None or record["status"] not in from_statuses:
+                    results[payment_id] = None
+                else:
+                    results[payment_id] = self._apply(record, dict(fields))
+        for record in results.values():
+            if record:
+                self._notify(record)
+        return results
+
+    def add_reference(self, payment_id, reference):
+        with self._lock:
+            self._references[reference] = payment_id
+
+    def resolve(self, reference):
+        with self._lock:
+            if reference in self._records:
+                return reference
+            return self._references.get(reference)
+
+    def by_phone(self, phone, status=None):
+        phone = _phone_key(phone)
+        with self._lock:
+            ids = self._by_phone.get(phone, {})
+            records = [self._records[i] for i in ids]
+            if status is not None:
+                records = [r for r in records if r["status"] == status]
+            return [dict(r) for r in records]
+
+    def by_status(self, status, limit=None):
+        with self._lock:
+            out = []
+            for payment_id in self._by_status.get(status, {}):
+                if limit is not None and len(out) >= limit:
+                    break
+                out.append(dict(self._records[payment_id]))
+            return out
+
+    def by_payout_status(self, payout_statuses, limit=None):
+        with self._lock:
+            records = [self._records[i] for s in payout_statuses for i in self._by_payout.get(s, {})]
+            records.sort(key=lambda r: r["created_at"])
+            return [dict(r) for r in records[:limit]]
+
+    def count(self, status=None):
+        with self._lock:
+            if status is None:
+                return len(self._records)
+            return len(self._by_status.get(status, {}))
+
+    def query(self, status=None, phone=None, since=None, until=None, cursor=None, limit=50):
+        after = decode_cursor(cursor) if cursor else None
+        with self._lock:
+            if phone is not None:
+                ids = self._by_phone.get(_phone_key(phone), {})
+            elif status is not None:
+                ids = self._by_status.get(status, {})
+            else:
+                ids = self._records
+            matches = []
+            for payment_id in ids:
+                r = self._records[payment_id]
+                if status is not None and r["status"] != status:
+                    continue
+                if since is not None and r["created_at"] < since:
+                    continue
+                if until is not None and r["created_at"] >= until:
+                    continue
+                if after is not None and (r["created_at"], payment_id) >= after:
+                    continue
+                matches.append(r)
+            # index order follows updates, not creation, so sort the page here
+            matches.sort(key=lambda r: (r["created_at"], r["payment_id"]), reverse=True)
+            page = [dict(r) for r in matches[:limit]]
+        next_cursor = encode_cursor(page[-1]) if len(matches) > limit else None
+        return page, next_cursor
+
+    def totals(self):
+        with self._lock:
+            return _totals_view(self._totals)
+
+    def latest_seq(self):
+        with self._lock:
+            return self._seq
+
+    def remove_many(self, records):
+        removed = []
+        with self._lock:
+            for snapshot in records:
+                payment_id = snapshot["payment_id"]
+                record = self._records.get(payment_id)
+                if record is None or record["updated_at"] != snapshot["updated_at"]:
+                    continue
+                self._unindex(record)
+                del self._records[payment_id]
+                self._changed.pop(payment_id, None)
+                removed.append(payment_id)
+            if removed:
+                gone = set(removed)
+                for reference in [r for r, pid in self._references.items() if pid in gone]:
+                    del self._references[reference]
+        return removed
+
+    def changes(self, since, limit=100, payment_id=None):
+        with self._lock:
+            if payment_id is not None:
+                seq = self._changed.get(payment_id, 0)
+                if seq <= since:
+                    return []
+                return [dict(self._records[payment_id], seq=seq)]
+            # walk back from the newest change until we pass ``since``
+            newer = []
+            for pid in reversed(self._changed):
+                seq = self._changed[pid]
+                if seq <= since:
+                    break
+                newer.append((seq, pid))
+            newer.reverse()
+            return [dict(self._records[pid], seq=seq) for seq, pid in newer[:limit]]
+
+
+class SQLitePaymentStore(PaymentStore):
+    """SQLite-backed store shared across processes.
+
+    Each thread gets its own connection (SQLite connections must not cross
+    threads or a fork). WAL mode lets readers proceed while a writer holds
+    the lock, and ``BEGIN IMMEDIATE`` makes ``transition`` a proper
+    compare-and-set across workers.
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS payments (
+        payment_id TEXT PRIMARY KEY,
+        phone TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        data TEXT NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS idx_payments_phone ON payments (phone, created_at);
+    CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status, created_at);
+    CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at);
+    CREATE INDEX IF NOT EXISTS idx_payments_payout ON payments (json_extract(data, '$.payout_status'), created_at);
+    CREATE TABLE IF NOT EXISTS payment_references (
+        reference TEXT PRIMARY KEY,
+        payment_id TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_payment_references_payment ON payment_references (payment_id);
+    CREATE TABLE IF NOT EXISTS payment_events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        payment_id TEXT NOT NULL,
+        status TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_payment_events_payment ON payment_events (payment_id, seq);
+    CREATE TABLE IF NOT EXISTS payment_totals (
+        key TEXT PRIMARY KEY,
+        value REAL NOT NULL
+    );
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        super().__init__()
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(self._SCHEMA)
+        self._backfill_totals(conn)
+        self._canonicalize_phones(conn)
+
+    def _backfill_totals(self, conn: sqlite3.Connection) -> None:
+        """Build ``payment_totals`` once for databases created before it existed."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            has_totals = conn.execute("SELECT 1 FROM payment_totals LIMIT 1").fetchone()
+            if not has_totals:
+                for row in conn.execute("SELECT * FROM payments").fetchall():
+                    self._apply_totals(conn, _totals_delta(None, self._row_to_record(row)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _canonicalize_phones(self, conn: sqlite3.Connection) -> None:
+        """Rewrite phones stored before normalisation (``07...``, ``254...``)."""
+        stale = [r[0] for r in conn.execute("SELECT DISTINCT phone FROM payments WHERE phone NOT LIKE '+%'")]
+        renames = [(_phone_key(p), p) for p in stale if _phone_key(p) != p]
+        if renames:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("UPDATE payments SET phone = ? WHERE phone = ?", renames)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            logger.info("Normalised %d stored phone numbers", len(renames))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _row_to_record(row: sqlite3.Row) -> dict:
+        record = json.loads(row["data"])
+        for field in _CORE_FIELDS:
+            record[field] = row[field]
+        return record
+
+    @staticmethod
+    def _split(record: dict) -> tuple:
+        data = {k: v for k, v in record.items() if k not in _CORE_FIELDS}
+        return tuple(record[f] for f in _CORE_FIELDS) + (json.dumps(data),)
+
+    @staticmethod
+    def _apply_totals(conn: sqlite3.Connection, delta: dict) -> None:
+        for key, value in delta.items():
+            conn.execute(
+                "INSERT INTO payment_totals (key, value) VALUES (?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = value + excluded.value",
+                (key, value),
+            )
+
+    def _log_change(self, conn: sqlite3.Connection, record: dict, old: Optional[dict] = None) -> None:
+        self._apply_totals(conn, _totals_delta(old, record))
+        conn.execute(
+            "INSERT INTO payment_events (payment_id, status) VALUES (?, ?)",
+            (record["payment_id"], record["status"]),
+        )
+
+    def _find_open(self, conn: sqlite3.Connection, phone: str, since: float, open_statuses: tuple) -> Optional[dict]:
+        marks = ", ".join("?" * len(open_statuses))
+        row = conn.execute(
+            f"SELECT * FROM payments WHERE phone = ? AND created_at >= ? AND status IN ({marks})"
+            " ORDER BY created_at DESC LIMIT 1",
+            (phone, since) + open_statuses,
+        ).fetchone()
+        return self._row_to_record(row) if row else None
+
+    def find_open(self, phone, since, open_statuses=(QUEUED, PENDING)):
+        return self._find_open(self._connect(), _phone_key(phone), since, tuple(open_statuses))
+
+    def create_unless_open(self, payment_id, phone, amount, since, status=PENDING,
+                           open_statuses=(QUEUED, PENDING), **extra):
+        record = _new_record(payment_id, phone, amount, status, extra)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            existing = self._find_open(conn, record["phone"], since, tuple(open_statuses))
+            if existing is not None:
+                conn.execute("COMMIT")
+                return existing, False
+            self._insert(conn, record)
+            conn.execute("COMMIT")
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK")
+            raise KeyError(f"Payment {payment_id} already exists")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify(record)
+        return record, True
+
+    def _insert(self, conn: sqlite3.Connection, record: dict) -> None:
+        conn.execute(
+            "INSERT INTO payments (payment_id, phone, amount, status, created_at, updated_at, data)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            self._split(record),
+        )
+        self._log_change(conn, record)
+
+    def create(self, payment_id, phone, amount, status=PENDING, **extra):
+        record = _new_record(payment_id, phone, amount, status, extra)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert(conn, record)
+            conn.execute("COMMIT")
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK")
+            raise KeyError(f"Payment {payment_id} already exists")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify(record)
+        return record
+
+    def get(self, payment_id):
+        row = self._connect().execute(
+            "SELECT * FROM payments WHERE payment_id = ?", (payment_id,)
+        ).fetchone()
+        return self._row_to_record(row) if row else None
+
+    def _write(self, conn: sqlite3.Connection, record: dict, fields: dict) -> dict:
+        record.update(fields)
+        record["updated_at"] = time.time()
+        values = self._split(record)
+        conn.execute(
+            "UPDATE payments SET phone = ?, amount = ?, status = ?, created_at = ?, updated_at = ?, data = ?"
+            " WHERE payment_id = ?",
+            values[1:] + (record["payment_id"],),
+        )
+        return record
+
+    def _modify(self, payment_id: str, fields: dict, from_statuses: Optional[tuple], expected: Optional[dict] = None) -> Optional[dict]:
+        fields.pop("payment_id", None)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT * FROM payments WHERE payment_id = ?", (payment_id,)
+            ).fetchone()
+            if row is None or (from_statuses is not None and row["status"] not in from_statuses):
+                conn.execute("ROLLBACK")
+                return None
+            old = self._row_to_record(row)
+            if expected is not None and not _matches(old, expected):
+                conn.execute("ROLLBACK")
+                return None
+            record = self._write(conn, dict(old), fields)
+            self._log_change(conn, record, old)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._notify(record)
+        return record
+
+    def update(self, payment_id, **fields):
+        return self._modify(payment_id, fields, None)
+
+    def update_if(self, payment_id, expected, **fields):
+        return self._modify(payment_id, fields, None, expected)
+
+    def transition(self, payment_id, to_status, from_statuses=(PENDING,), **fields):
+        fields["status"] = to_status
+        return self._modify(payment_id, fields, tuple(from_statuses))
+
+    def transition_many(self, payment_ids, to_status, from_statuses=(PENDING,), **fields):
+        from_statuses = tuple(from_statuses)
+        fields["status"] = to_status
+        fields.pop("payment_id", None)
+        results = {}
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for payment_id in dict.fromkeys(payment_ids):
+                row = conn.execute(
+                    "SELECT * FROM payments WHERE payment_id = ?", (payment_id,)
+                ).fetchone()
+                if row is None or row["status"] not in from_statuses:
+                    results[payment_id] = None
+                    continue
+                old = self._row_to_record(row)
+                record = self._write(conn, dict(old), dict(fields))
+                self._log_change(conn, record, old)
+                results[payment_id] = record
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for record in results.values():
+            if record:
+                self._notify(record)
+        return results
+
+    def add_reference(self, payment_id, reference):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO payment_references (reference, payment_id) VALUES (?, ?)",
+            (reference, payment_id),
+        )
+
+    def resolve(self, reference):
+        conn = self._connect()
+        row = conn.execute("SELECT payment_id FROM payments WHERE payment_id = ?", (reference,)).fetchone()
+        if row is None:
+            row = conn.execute(
+                "SELECT payment_id FROM payment_references WHERE reference = ?", (reference,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def by_phone(self, phone, status=None):
+        sql = "SELECT * FROM payments WHERE phone = ?"
+        params = [_phone_key(phone)]
+        if status is not None:
+            sql += " AND status = ?"
+            params.append(status)
+        rows = self._connect().execute(sql + " ORDER BY created_at", params).fetchall()
+        return [self._row_to_record(r) for r in rows]
+
+    def by_status(self, status, limit=None):
+        sql = "SELECT * FROM payments WHERE status = ? ORDER BY created_at"
+        params = [status]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        rows = self._connect().execute(sql, params).fetchall()
+        return [self._row_to_record(r) for r in rows]
+
+    def by_payout_status(self, payout_statuses, limit=None):
+        payout_statuses = tuple(payout_statuses)
+        marks = ", ".join("?" * len(payout_statuses))
+        # same expression as idx_payments_payout, so the index is used
+        sql = f"SELECT * FROM payments WHERE json_extract(data, '$.payout_status') IN ({marks}) ORDER BY created_at"
+        params = list(payout_statuses)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        rows = self._connect().execute(sql, params).fetchall()
+        return [self._row_to_record(r) for r in rows]
+
+    def count(self, status=None):
+        if status is None:
+            row = self._connect().execute("SELECT COUNT(*) FROM payments").fetchone()
+        else:
+            row = self._connect().execute(
+                "SELECT COUNT(*) FROM payments WHERE status = ?", (status,)
+            ).fetchone()
+        return row[0]
+
+    def query(self, status=None, phone=None, since=None, until=None, cursor=None, limit=50):
+        clauses, params = [], []
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        if phone is not None:
+            clauses.append("phone = ?")
+            params.append(_phone_key(phone))
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(until)
+        if cursor:
+            created_at, payment_id = decode_cursor(cursor)
+            clauses.append("(created_at < ? OR (created_at = ? AND payment_id < ?))")
+            params += [created_at, created_at, payment_id]
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connect().execute(
+            f"SELECT * FROM payments {where} ORDER BY created_at DESC, payment_id DESC LIMIT ?",
+            params + [int(limit) + 1],
+        ).fetchall()
+        page = [self._row_to_record(r) for r in rows[:limit]]
+        next_cursor = encode_cursor(page[-1]) if len(rows) > limit else None
+        return page, next_cursor
+
+    def totals(self):
+        rows = self._connect().execute("SELECT key, value FROM payment_totals").fetchall()
+        return _totals_view({k: v for k, v in rows})
+
+    def latest_seq(self):
+        row = self._connect().execute("SELECT MAX(seq) FROM payment_events").fetchone()
+        return row[0] or 0
+
+    def changes(self, since, limit=100, payment_id=None):
+        where = "seq > ?"
+        params = [since]
+        if payment_id is not None:
+            where += " AND payment_id = ?"
+            params.append(payment_id)
+        rows = self._connect().execute(
+            "SELECT e.seq AS seq, p.* FROM"
+            f" (SELECT payment_id, MAX(seq) AS seq FROM payment_events WHERE {where} GROUP BY payment_id) e"
+            " JOIN payments p ON p.payment_id = e.payment_id ORDER BY e.seq LIMIT ?",
+            params + [int(limit)],
+        ).fetchall()
+        return [dict(self._row_to_record(r), seq=r["seq"]) for r in rows]
+
+    def remove_many(self, records):
+        removed = []
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for snapshot in records:
+                cur = conn.execute(
+                    "DELETE FROM payments WHERE payment_id = ? AND updated_at = ?",
+                    (snapshot["payment_id"], snapshot["updated_at"]),
+                )
+                if cur.rowcount:
+                    removed.append(snapshot["payment_id"])
+            for payment_id in removed:
+                conn.execute("DELETE FROM payment_references WHERE payment_id = ?", (payment_id,))
+                conn.execute("DELETE FROM payment_events WHERE payment_id = ?", (payment_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return removed
+
+    def compact_events(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute(
+                "DELETE FROM payment_events WHERE EXISTS (SELECT 1 FROM payment_events later"
+                " WHERE later.payment_id = payment_events.payment_id AND later.seq > payment_events.seq)"
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def create_store(backend: Optional[str] = None, path: Optional[str] = None) -> PaymentStore:
+    """Build a store for ``backend`` ('memory' or 'sqlite')."""
+    backend = (backend or config.PAYMENT_STORE).lower()
+    if backend == "memory":
+        return MemoryPaymentStore()
+    if backend == "sqlite":
+        return SQLitePaymentStore(path or config.PAYMENT_DB_PATH)
+    raise ValueError(f"Unknown payment store backend: {backend}")
+
+
+# Store calls timed in ``payment_store_operation_seconds``
+TIMED_OPS = ("get", "create", "create_unless_open", "find_open", "update", "transition", "transition_many",
+             "update_if", "resolve", "by_status", "by_phone", "count", "query", "changes", "totals", "remove_many")
+
+
+def _register_metrics(store: PaymentStore) -> None:
+    backend = "sqlite" if isinstance(store, SQLitePaymentStore) else "memory"
+    metrics.time_methods(store, TIMED_OPS, backend=backend)
+    store.add_listener(lambda record: metrics.PAYMENT_CHANGES.inc(status=record["status"]))
+    # the SQLite totals are shared, so read them once per scrape, not per worker
+    metrics.gauge_callback("payments", "Payments per status (lifetime, including archived)",
+                           lambda: store.totals()["counts"], ("status",),
+                           scope="global" if backend == "sqlite" else "process")
+
+
+def get_store() -> PaymentStore:
+    """Return the process-wide store, creating it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store()
+                _register_metrics(_store)
+                logger.info("Payment store ready: %s", type(_store).__name__)
+    return _store
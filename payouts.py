@@ -0,0 +1,378 @@
+"""Batched winner payouts over M-Pesa B2C.
+
+Winners used to be paid one request at a time from an admin form. Here a
+won game is handed to ``PayoutEngine.submit``: prizes up to
+``auto_approve_max`` are queued straight away, larger ones wait as
+``awaiting_approval`` until an admin calls ``approve``. Queued payouts are
+sent in the background:
+
+- a collector thread coalesces queued winners into batches of up to
+  ``batch_size``, waiting at most ``linger`` seconds for a batch to fill
+- batches run on a ``DispatchQueue``, so several are in flight at once and
+  a full pool pushes back on the collector instead of piling up threads
+- a token bucket caps B2C requests per second for this worker process
+
+Every payout is tracked on its payment record (``payout_status`` and
+friends) and each state change is a store compare-and-set, so a payment is
+queued once and only one thread in one worker ever sends it. Retries reuse
+the same ``payout_key`` (sent as the OriginatorConversationID). A payout
+whose outcome is unknown (timeout or 5xx after sending) is parked as
+``unknown`` for reconciliation rather than resent. ``needs_attention()``
+lists those, payouts that ran out of attempts, ones left ``sending`` by a
+process that died mid-request, and ones awaiting approval, for an admin to
+resolve by hand.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Optional
+
+import config
+import metrics
+from payment_store import CONFIRMED, PaymentStore
+import stk_dispatch
+from stk_dispatch import DispatchQueue
+
+logger = logging.getLogger(__name__)
+
+# ``payout_status`` values on a payment record
+PAYOUT_AWAITING_APPROVAL = "awaiting_approval"
+PAYOUT_QUEUED = "queued"
+PAYOUT_SENDING = "sending"
+PAYOUT_SENT = "sent"
+PAYOUT_FAILED = "failed"
+PAYOUT_UNKNOWN = "unknown"
+
+# Window for the rolling payouts-per-second figure
+RATE_WINDOW = 60.0
+
+# A payout still ``sending`` after this long was claimed by a process that died
+STALE_SENDING_SECONDS = 300.0
+
+
+def payout_key(payment_id: str) -> str:
+    """Idempotency key for the prize won with ``payment_id``."""
+    return f"PAYOUT-{payment_id}"
+
+
+class _Throttle:
+    """Blocking token bucket: at most ``rate`` acquisitions per second."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class PayoutEngine:
+    """Queues winners and pays them in rate-limited concurrent batches.
+
+    ``send(phone, amount, key)`` performs one payout and returns a provider
+    reference. Exceptions listed in ``retryable`` mean the provider refused
+    the request (safe to try again, up to ``max_attempts``); any other
+    exception marks the payout ``unknown``. ``submit`` queues prizes up to
+    ``auto_approve_max`` without review (0 holds every prize for an admin).
+    """
+
+    def __init__(self, store: PaymentStore, send: Callable[[str, int, str], str], dispatcher: DispatchQueue,
+                 retryable: tuple = (), batch_size: int = 20, linger: float = 0.5, rate: float = 5.0,
+                 max_queue: int = 1000, max_attempts: int = 3, auto_approve_max: int = 0):
+        self.store = store
+        self.send = send
+        self.dispatcher = dispatcher
+        self.retryable = tuple(retryable)
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self.auto_approve_max = auto_approve_max
+        self._throttle = _Throttle(rate)
+        self._pending = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._closed = False
+        self._overflowed = False
+        self._recent = deque()
+        self.counts = {}
+        self.batched = 0
+        self.send_seconds = 0.0
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def submit(self, payment_id: str) -> Optional[dict]:
+        """Queue the prize won with ``payment_id``, or hold it for approval if
+        it is above ``auto_approve_max``.
+
+        Returns the updated payment, or None if there is nothing to pay or
+        the payout was already submitted (by this or another worker).
+        """
+        payment = self.store.get(payment_id)
+        if not payment or payment["status"] != CONFIRMED or not payment.get("prize"):
+            return None
+        if payment["prize"] <= self.auto_approve_max:
+            return self._queue(payment, None)
+        record = self.store.update_if(
+            payment_id, {"status": CONFIRMED, "payout_status": None},
+            payout_status=PAYOUT_AWAITING_APPROVAL,
+            payout_amount=payment["prize"],
+        )
+        if record is None:
+            self._count("duplicates")
+            return None
+        self._count("held")
+        logger.info("Payout for %s (%s) held for approval", payment_id, payment["prize"])
+        return record
+
+    def approve(self, payment_id: str) -> Optional[dict]:
+        """Queue a payout held as ``awaiting_approval``; None if there is none."""
+        payment = self.store.get(payment_id)
+        if not payment or payment.get("payout_status") != PAYOUT_AWAITING_APPROVAL:
+            return None
+        return self._queue(payment, PAYOUT_AWAITING_APPROVAL)
+
+    def enqueue(self, payment_id: str) -> Optional[dict]:
+        """Queue the prize won with ``payment_id`` for payout, skipping approval.
+
+        Returns the updated payment, or None if there is nothing to pay or
+        the payout was already queued (by this or another worker).
+        """
+        payment = self.store.get(payment_id)
+        if not payment or payment["status"] != CONFIRMED or not payment.get("prize"):
+            return None
+        return self._queue(payment, None)
+
+    def _queue(self, payment: dict, expected: Optional[str]) -> Optional[dict]:
+        payment_id = payment["payment_id"]
+        record = self.store.update_if(
+            payment_id, {"status": CONFIRMED, "payout_status": expected},
+            payout_status=PAYOUT_QUEUED,
+            payout_key=payout_key(payment_id),
+            payout_amount=payment["prize"],
+            payout_attempts=0,
+            payout_queued_at=datetime.now().isoformat(),
+        )
+        if record is None:
+            self._count("duplicates")
+            return None
+        self._count("enqueued")
+        self._offer(payment_id)
+        return record
+
+    def _offer(self, payment_id: str) -> None:
+        self._ensure_collector()
+        try:
+            self._pending.put_nowait(payment_id)
+        except queue.Full:
+            # still queued in the store; resume() picks it up once there is room
+            self._overflowed = True
+            self._count("overflow")
+            logger.warning("Payout queue full; %s left for the next sweep", payment_id)
+
+    def resume(self) -> int:
+        """Re-queue payouts left ``queued`` in the store (restart, overflow)."""
+        offered = 0
+        room = self._pending.maxsize - self._pending.qsize()
+        for payment in self.store.by_payout_status((PAYOUT_QUEUED,), limit=max(room, 1)):
+            try:
+                self._pending.put_nowait(payment["payment_id"])
+            except queue.Full:
+                self._overflowed = True
+                break
+            offered += 1
+        if offered:
+            logger.info("Resumed %d queued payouts", offered)
+        return offered
+
+    def start(self) -> None:
+        """Start the collector in this process, which first resumes ``queued`` payouts."""
+        self._ensure_collector()
+
+    def needs_attention(self, limit: int = 100) -> list:
+        """Payouts that will not finish on their own: ``unknown``, ``failed``,
+        stale ``sending``, or ``awaiting_approval``."""
+        cutoff = time.time() - STALE_SENDING_SECONDS
+        stuck = self.store.by_payout_status((PAYOUT_UNKNOWN, PAYOUT_FAILED, PAYOUT_AWAITING_APPROVAL), limit=limit)
+        sending = self.store.by_payout_status((PAYOUT_SENDING,), limit=limit)
+        stale = [p for p in sending if p.get("payout_sending_at", 0) <= cutoff]
+        return [{
+            "payment_id": payment["payment_id"],
+            "phone": payment["phone"],
+            "payout_status": payment["payout_status"],
+            "payout_amount": payment.get("payout_amount"),
+            "payout_key": payment.get("payout_key"),
+            "payout_attempts": payment.get("payout_attempts"),
+            "payout_error": payment.get("payout_error"),
+            "payout_queued_at": payment.get("payout_queued_at"),
+        } for payment in sorted(stuck + stale, key=lambda p: p["created_at"])[:limit]]
+
+    def _ensure_collector(self) -> None:
+        if self._pid == os.getpid() or self._closed:
+            return
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+            # started lazily so the thread lives in the gunicorn worker
+            self._pid = pid
+            threading.Thread(target=self._collect, name="payout-collector", daemon=True).start()
+
+    def _collect(self) -> None:
+        self.resume()
+        while not self._closed:
+            try:
+                first = self._pending.get(timeout=1.0)
+            except queue.Empty:
+                if self._overflowed:
+                    self._overflowed = False
+                    self.resume()
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: list) -> None:
+        while True:
+            try:
+                self.dispatcher.submit("b2c", self._send_batch, batch)
+            except queue.Full:
+                # every batch slot is busy: hold this one (backpressure)
+                time.sleep(max(self.linger, 0.05))
+                continue
+            except RuntimeError:
+                logger.warning("Payout dispatcher is shut down; %d payouts stay queued", len(batch))
+                return
+            with self._lock:
+                self.counts["batches"] = self.counts.get("batches", 0) + 1
+                self.batched += len(batch)
+            return
+
+    def _send_batch(self, batch: list) -> None:
+        for payment_id in dict.fromkeys(batch):
+            self._send_one(payment_id)
+
+    def _send_one(self, payment_id: str) -> None:
+        claimed = self.store.update_if(payment_id, {"payout_status": PAYOUT_QUEUED}, payout_status=PAYOUT_SENDING,
+                                       payout_sending_at=time.time())
+        if claimed is None:
+            # sent by another worker, or queued twice locally
+            self._count("skipped")
+            return
+        attempts = claimed.get("payout_attempts", 0) + 1
+        self._throttle.acquire()
+        started = time.monotonic()
+        try:
+            reference = self.send(claimed["phone"], claimed["payout_amount"], claimed["payout_key"])
+        except self.retryable as e:
+            retry = attempts < self.max_attempts
+            self.store.update_if(payment_id, {"payout_status": PAYOUT_SENDING},
+                                 payout_status=PAYOUT_QUEUED if retry else PAYOUT_FAILED,
+                                 payout_attempts=attempts, payout_error=str(e))
+            logger.warning("Payout %s refused (attempt %d): %s", payment_id, attempts, e)
+            if retry:
+                self._count("retried")
+                self._offer(payment_id)
+            else:
+                self._count("failed")
+            return
+        except Exception as e:
+            logger.exception("Payout %s outcome unknown", payment_id)
+            self.store.update_if(payment_id, {"payout_status": PAYOUT_SENDING},
+                                 payout_status=PAYOUT_UNKNOWN, payout_attempts=attempts, payout_error=str(e))
+            self._count("unknown")
+            return
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.send_seconds += elapsed
+        self.store.update_if(payment_id, {"payout_status": PAYOUT_SENDING},
+                             payout_status=PAYOUT_SENT, payout_ref=reference,
+                             payout_attempts=attempts, paid_at=datetime.now().isoformat())
+        now = time.monotonic()
+        with self._lock:
+            self.counts["sent"] = self.counts.get("sent", 0) + 1
+            self._recent.append(now)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > RATE_WINDOW:
+                self._recent.popleft()
+            counts = dict(self.counts)
+            batches = counts.get("batches", 0)
+            attempts = counts.get("sent", 0) + counts.get("retried", 0) + counts.get("failed", 0) + counts.get("unknown", 0)
+            return dict(
+                counts,
+                queue_depth=self._pending.qsize(),
+                max_queue=self._pending.maxsize,
+                avg_batch=round(self.batched / batches, 2) if batches else 0,
+                per_second=round(len(self._recent) / RATE_WINDOW, 3),
+                avg_send_ms=round(self.send_seconds / attempts * 1000, 1) if attempts else 0,
+                dispatcher=self.dispatcher.stats(),
+            )
+
+    def close(self, timeout: Optional[float] = 30.0) -> None:
+        """Stop collecting and finish batches already handed to workers.
+
+        Payouts still waiting in memory stay ``queued`` in the store and are
+        resumed by the next process.
+        """
+        self._closed = True
+        self.dispatcher.shutdown(timeout)
+
+
+def create_engine(store: PaymentStore) -> PayoutEngine:
+    """Engine wired to ``mpesa.send_payout`` with settings from ``config``."""
+    import mpesa
+
+    dispatcher = DispatchQueue(
+        workers=config.PAYOUT_WORKERS,
+        max_queue=config.PAYOUT_WORKERS,
+        max_in_flight={"b2c": config.PAYOUT_WORKERS},
+    )
+    engine = PayoutEngine(
+        store,
+        mpesa.send_payout,
+        dispatcher,
+        retryable=(mpesa.PayoutRejected,),
+        batch_size=config.PAYOUT_BATCH_SIZE,
+        linger=config.PAYOUT_LINGER,
+        rate=config.PAYOUT_RATE,
+        max_queue=config.PAYOUT_MAX_QUEUE,
+        max_attempts=config.PAYOUT_MAX_ATTEMPTS,
+        auto_approve_max=config.PAYOUT_AUTO_APPROVE_MAX,
+    )
+    stk_dispatch.register_metrics(dispatcher, "payouts")
+    metrics.gauge_callback("payout_queue_depth", "Winners waiting to be batched for B2C",
+                           lambda: engine._pending.qsize())
+    atexit.register(engine.close)
+    return engine
@@ -0,0 +1,135 @@
+"""Kenyan phone number normalisation.
+
+Every entry point used to clean numbers its own way (or not at all), so
+``0712 345 678``, ``254712345678`` and ``+254712345678`` were stored as three
+different players. Everything now goes through ``normalize``, which returns
+the canonical E.164 form ``+2547XXXXXXXX`` / ``+2541XXXXXXXX``:
+
+- a single precompiled pattern validates and captures the subscriber part
+- results (including rejections) are memoised in an LRU cache, since the
+  same numbers come back on every poll, callback and payout. Input is
+  untrusted, so overlong values are rejected before the cache and the key
+  is the short separator-free form, never the raw string
+- ``normalize_many`` / ``normalize_csv`` handle bulk imports
+
+Daraja wants the bare MSISDN (``2547XXXXXXXX``); use ``msisdn`` for that.
+"""
+import csv
+import re
+from functools import lru_cache
+from typing import Iterable, Iterator, Optional
+
+# Separators people type or paste: spaces, dashes, dots, brackets
+_SEPARATORS = re.compile(r"[\s\-.()]+")
+
+# Optional +254 / 00254 / 254 / 0 prefix, then a 9-digit mobile number
+# starting with 7 or 1 (Safaricom, Airtel and Telkom ranges)
+_KENYAN_MOBILE = re.compile(r"(?:(?:\+|00)?254|0)?([71]\d{8})")
+
+CACHE_SIZE = 65536
+
+# "00 254 (712) 345-678" is 20 characters; anything much longer is not a number
+MAX_RAW_LENGTH = 24
+# "00254" plus the 9-digit subscriber number
+_MAX_COMPACT_LENGTH = 14
+
+
+class InvalidPhone(ValueError):
+    """The input is not a Kenyan mobile number."""
+
+
+def _compact(raw) -> Optional[str]:
+    """``raw`` without separators, or None if it is too long to be a number."""
+    if raw is None:
+        return None
+    raw = str(raw).strip()
+    if len(raw) > MAX_RAW_LENGTH:
+        return None
+    compact = _SEPARATORS.sub("", raw)
+    return compact if len(compact) <= _MAX_COMPACT_LENGTH else None
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _canonical(compact: str) -> Optional[str]:
+    match = _KENYAN_MOBILE.fullmatch(compact)
+    return f"+254{match.group(1)}" if match else None
+
+
+def _uncached(raw) -> Optional[str]:
+    compact = _compact(raw)
+    return _canonical.__wrapped__(compact) if compact is not None else None
+
+
+def try_normalize(raw) -> Optional[str]:
+    """Canonical ``+254...`` form, or None if ``raw`` is not valid."""
+    compact = _compact(raw)
+    return _canonical(compact) if compact is not None else None
+
+
+def normalize(raw) -> str:
+    """Canonical ``+254...`` form; raises ``InvalidPhone`` otherwise."""
+    phone = try_normalize(raw)
+    if phone is None:
+        raise InvalidPhone(f"Not a Kenyan mobile number: {raw!r}")
+    return phone
+
+
+def msisdn(raw) -> str:
+    """``254...`` without the plus, as Daraja's PartyA/PartyB expect."""
+    return normalize(raw)[1:]
+
+
+def normalize_many(values: Iterable) -> Iterator[tuple]:
+    """Yield ``(raw, canonical or None)`` for each value, lazily.
+
+    Bypasses the LRU cache so a large import does not evict the numbers
+    the web workers keep looking up.
+    """
+    for raw in values:
+        yield raw, _uncached(raw)
+
+
+def normalize_csv(src: str, dst: str, column: str = "phone", dedupe: bool = True) -> dict:
+    """Rewrite ``column`` of CSV file ``src`` in canonical form into ``dst``.
+
+    Rows with an invalid number are dropped, as are repeats when
+    ``dedupe`` is set. The file is streamed row by row, bypassing the LRU
+    cache like ``normalize_many``. Returns counts of
+    ``written``, ``invalid`` and ``duplicate`` rows.
+    """
+    counts = {"written": 0, "invalid": 0, "duplicate": 0}
+    seen = set()
+    with open(src, newline="", encoding="utf-8") as fin, open(dst, "w", newline="", encoding="utf-8") as fout:
+        reader = csv.DictReader(fin)
+        if column not in (reader.fieldnames or ()):
+            raise ValueError(f"No {column!r} column in {src}")
+        writer = csv.DictWriter(fout, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for row in reader:
+            phone = _uncached(row[column])
+            if phone is None:
+                counts["invalid"] += 1
+                continue
+            if dedupe:
+                if phone in seen:
+                    counts["duplicate"] += 1
+                    continue
+                seen.add(phone)
+            row[column] = phone
+            writer.writerow(row)
+            counts["written"] += 1
+    return counts
+
+
+def cache_info():
+    return _canonical.cache_info()
+
+
+if __name__ == "__main__":
+    # python phones.py players.csv players_clean.csv [column]
+    import json
+    import sys
+
+    if len(sys.argv) < 3:
+        sys.exit("usage: python phones.py <src.csv> <dst.csv> [column]")
+    print(json.dumps(normalize_csv(sys.argv[1], sys.argv[2], *sys.argv[3:4])))
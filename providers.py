@@ -0,0 +1,103 @@
+"""Provider clients created on first use.
+
+Building a provider client at import time is paid by every gunicorn worker
+at boot and on every respawn, whether or not that worker ever sends an SMS
+or an STK push (``twilio.rest`` alone takes ~140 ms to import). Modules
+register a factory instead and ask for the client when they need it::
+
+    _twilio = providers.register("twilio", _make_twilio_client)
+    client = _twilio()          # same as providers.get("twilio")
+
+- the factory runs on the first ``get``; concurrent first callers wait for
+  that one build instead of each running it
+- a forked worker builds its own client (sockets and locks are not shared)
+- a factory returning None means "not configured", and that is cached too;
+  one that raises is retried on the next ``get``
+- ``stats()`` lists which clients exist in this process and how long each
+  took to build (also the ``provider_init_seconds`` metric)
+"""
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_INIT_SECONDS = metrics.histogram(
+    "provider_init_seconds", "Time to build a provider client on first use", ("provider",))
+
+_lock = threading.Lock()
+_factories = {}
+# name -> (pid, client, seconds to build)
+_clients = {}
+# name -> (pid, lock held while the client is built)
+_build_locks = {}
+
+
+def register(name: str, factory: Callable[[], object]) -> Callable[[], object]:
+    """Register ``factory`` for ``name``; returns a shortcut for ``get(name)``.
+
+    Registering a name again replaces its factory and drops the client.
+    """
+    with _lock:
+        _factories[name] = factory
+        _clients.pop(name, None)
+    return lambda: get(name)
+
+
+def _build_lock(name: str, pid: int) -> threading.Lock:
+    # a lock inherited from the parent may have been held at fork time
+    with _lock:
+        entry = _build_locks.get(name)
+        if entry is None or entry[0] != pid:
+            entry = _build_locks[name] = (pid, threading.Lock())
+        return entry[1]
+
+
+def get(name: str):
+    """The client for ``name``, built by its factory on first use."""
+    pid = os.getpid()
+    entry = _clients.get(name)
+    if entry is not None and entry[0] == pid:
+        return entry[1]
+    with _build_lock(name, pid):
+        entry = _clients.get(name)
+        if entry is not None and entry[0] == pid:
+            return entry[1]
+        factory = _factories[name]
+        started = time.perf_counter()
+        client = factory()
+        seconds = time.perf_counter() - started
+        with _lock:
+            if _factories.get(name) is factory:
+                _clients[name] = (pid, client, seconds)
+    PROVIDER_INIT_SECONDS.observe(seconds, provider=name)
+    logger.info("Provider %s ready in %.1f ms%s", name, seconds * 1000, "" if client is not None else " (not configured)")
+    return client
+
+
+def reset(name: Optional[str] = None) -> None:
+    """Drop the client for ``name`` (or all), so the next ``get`` builds a new one."""
+    with _lock:
+        if name is None:
+            _clients.clear()
+        else:
+            _clients.pop(name, None)
+
+
+def stats() -> dict:
+    """Registered providers and, for those built in this process, the build time."""
+    pid = os.getpid()
+    with _lock:
+        result = {}
+        for name in sorted(_factories):
+            entry = _clients.get(name)
+            if entry is None or entry[0] != pid:
+                result[name] = {"initialized": False}
+            else:
+                result[name] = {"initialized": True, "configured": entry[1] is not None,
+                                "init_ms": round(entry[2] * 1000, 2)}
+        return result
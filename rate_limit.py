@@ -0,0 +1,263 @@
+"""Token-bucket admission control for ``/pay``.
+
+Every accepted ``/pay`` creates a payment record and, in ``app_auto``, an
+STK push, so a client hammering the form costs memory and Daraja quota.
+``RateLimiter.check`` runs before any of that work and answers with a
+``Decision``; routes turn a refusal into a 429 with ``Retry-After``.
+
+Limits are token buckets ("5 per 300 seconds" = burst 5, refilled at
+5/300 per second) keyed by scope: per phone, per client IP and one global
+bucket. A request must fit in all of them; tokens are only taken when it
+does.
+
+Two tiers:
+
+- an in-process ``MemoryBuckets`` sees this worker's attempts and rejects
+  obvious floods without any I/O
+- ``SQLiteBuckets`` (a small WAL database) holds the buckets shared by
+  every gunicorn worker
+
+Buckets that have refilled completely carry no information, so both
+backends drop them; ``MemoryBuckets`` also caps its key count. Memory stays
+bounded by recent distinct clients.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+Limit = namedtuple("Limit", "count seconds")
+Decision = namedtuple("Decision", "allowed retry_after scope")
+
+ALLOWED = Decision(True, 0.0, None)
+
+
+def parse_limit(value: str) -> Optional[Limit]:
+    """``"5/300"`` -> ``Limit(5, 300.0)``; empty or ``"0"`` disables."""
+    if not value or value.strip() in ("0", "off"):
+        return None
+    count, _, seconds = value.partition("/")
+    return Limit(int(count), float(seconds or 1))
+
+
+def _refill(tokens: float, updated: float, now: float, limit: Limit) -> float:
+    return min(float(limit.count), tokens + (now - updated) * limit.count / limit.seconds)
+
+
+def _full_at(tokens: float, now: float, limit: Limit) -> float:
+    return now + (limit.count - tokens) * limit.seconds / limit.count
+
+
+def _decide(buckets: list) -> tuple:
+    """``buckets`` is ``[(scope, key, limit, tokens)]`` after refill.
+
+    Returns the Decision and the new token counts (None if refused).
+    """
+    worst = None
+    for scope, _, limit, tokens in buckets:
+        if tokens < 1:
+            wait = (1 - tokens) * limit.seconds / limit.count
+            if worst is None or wait > worst.retry_after:
+                worst = Decision(False, wait, scope)
+    if worst:
+        return worst, None
+    return ALLOWED, [tokens - 1 for _, _, _, tokens in buckets]
+
+
+class MemoryBuckets:
+    """Process-local buckets in an LRU-ordered dict (O(1) per key)."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, checks: list, now: Optional[float] = None) -> Decision:
+        now = time.time() if now is None else now
+        with self._lock:
+            buckets = []
+            for scope, key, limit in checks:
+                entry = self._buckets.get(key)
+                tokens = _refill(entry[0], entry[1], now, limit) if entry else float(limit.count)
+                buckets.append((scope, key, limit, tokens))
+            decision, remaining = _decide(buckets)
+            if remaining is not None:
+                for (_, key, limit, _), tokens in zip(buckets, remaining):
+                    self._buckets[key] = (tokens, now, _full_at(tokens, now, limit))
+                    self._buckets.move_to_end(key)
+            self._expire(now)
+            return decision
+
+    def _expire(self, now: float) -> None:
+        # least recently used first: drop refilled buckets, then enforce the cap
+        while self._buckets:
+            key, (_, _, full_at) = next(iter(self._buckets.items()))
+            if full_at > now and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class SQLiteBuckets:
+    """Buckets shared by all workers through one SQLite file.
+
+    Each ``take`` is a single ``BEGIN IMMEDIATE`` transaction, so concurrent
+    workers never overspend a bucket. Rows whose bucket has refilled are
+    deleted every ``sweep_interval`` seconds.
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL,
+        full_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_rate_buckets_full ON rate_buckets (full_at);
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 2.0, sweep_interval: float = 30.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = 0.0
+        self._connect().executescript(self._SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def take(self, checks: list, now: Optional[float] = None) -> Decision:
+        now = time.time() if now is None else now
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            buckets = []
+            for scope, key, limit in checks:
+                row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                tokens = _refill(row[0], row[1], now, limit) if row else float(limit.count)
+                buckets.append((scope, key, limit, tokens))
+            decision, remaining = _decide(buckets)
+            if remaining is not None:
+                conn.executemany(
+                    "INSERT INTO rate_buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens,"
+                    " updated = excluded.updated, full_at = excluded.full_at",
+                    [(key, tokens, now, _full_at(tokens, now, limit))
+                     for (_, key, limit, _), tokens in zip(buckets, remaining)],
+                )
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                conn.execute("DELETE FROM rate_buckets WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return decision
+
+    def __len__(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM rate_buckets").fetchone()[0]
+
+
+class RateLimiter:
+    """Checks one request against the per-phone, per-IP and global limits.
+
+    ``limits`` maps a scope name to a ``Limit`` (or None to disable it).
+    With a ``shared`` backend, the local tier only screens this worker's
+    own traffic; the shared buckets decide.
+    """
+
+    def __init__(self, limits: dict, shared=None, local: Optional[MemoryBuckets] = None, prefix: str = "pay"):
+        self.limits = {scope: limit for scope, limit in limits.items() if limit}
+        self.shared = shared
+        self.local = local or MemoryBuckets()
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.counts = {"allowed": 0, "local_rejects": 0, "shared_rejects": 0, "errors": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+    def check(self, **keys) -> Decision:
+        """``check(phone=..., ip=...)``; the ``global`` scope needs no key."""
+        checks = []
+        for scope, limit in self.limits.items():
+            key = "" if scope == "global" else keys.get(scope)
+            if key is None:
+                continue
+            checks.append((scope, f"{self.prefix}:{scope}:{key}", limit))
+        if not checks:
+            return ALLOWED
+        decision = self.local.take(checks)
+        if not decision.allowed:
+            self._count("local_rejects")
+            return decision
+        if self.shared is not None:
+            try:
+                decision = self.shared.take(checks)
+            except sqlite3.Error:
+                # fail open: the local tier still bounds this worker
+                logger.exception("Shared rate limit backend failed")
+                self._count("errors")
+                return ALLOWED
+            if not decision.allowed:
+                self._count("shared_rejects")
+                return decision
+        self._count("allowed")
+        return decision
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counts)
+        stats["local_keys"] = len(self.local)
+        return stats
+
+
+def client_ip(request, trusted_hops: Optional[int] = None) -> str:
+    """Client address as seen by the outermost of ``trusted_hops`` proxies.
+
+    Each trusted proxy appends the address it received from, so the client
+    is ``trusted_hops`` entries from the end of ``X-Forwarded-For``; earlier
+    entries are whatever the client sent. With no trusted proxies
+    (``RATE_LIMIT_TRUST_PROXY=0``, the default) the header is ignored.
+    """
+    hops = config.RATE_LIMIT_TRUST_PROXY if trusted_hops is None else trusted_hops
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded and hops > 0:
+        entries = [e.strip() for e in forwarded.split(",")]
+        if len(entries) >= hops and entries[-hops]:
+            return entries[-hops]
+    return request.remote_addr or "unknown"
+
+
+def create_pay_limiter() -> RateLimiter:
+    """``/pay`` limiter configured from ``config``."""
+    shared = None
+    if config.RATE_LIMIT_BACKEND == "sqlite":
+        shared = SQLiteBuckets(config.RATE_LIMIT_DB_PATH)
+    return RateLimiter(
+        {
+            "phone": parse_limit(config.PAY_LIMIT_PER_PHONE),
+            "ip": parse_limit(config.PAY_LIMIT_PER_IP),
+            "global": parse_limit(config.PAY_LIMIT_GLOBAL),
+        },
+        shared=shared,
+    )
@@ -0,0 +1,441 @@
+"""Payment status reconciliation against Daraja and Flutterwave.
+
+Callbacks get lost, and the only other way to learn an outcome used to be
+``flutterwave_pay.verify_payment``, a live HTTP call on every
+``/payment/callback`` hit; Daraja's STK Push Query was never asked at all.
+``Reconciler`` closes that gap:
+
+- ``verify(provider, reference)`` answers from a ``StatusCache``. Final
+  answers (paid / declined) are kept for ``ttl``; "not yet", "not found"
+  and provider errors are kept for ``negative_ttl`` so a burst of retries
+  costs one request. Concurrent lookups of one reference share a single
+  request.
+- a background poller walks PENDING payments that carry a provider
+  reference (``checkout_id`` / ``tx_ref``) in batches. Each payment is
+  first asked about ``first_poll`` seconds after its push, then at
+  intervals that grow by ``backoff`` up to ``max_interval`` while the
+  customer has not answered.
+- ``verify_async`` is the same lookup for the async serving mode
+  (app_async.py): it awaits the providers' ``*_async`` calls and shares
+  the cache, so sync and async workers see the same entries.
+- final states are written to the store with the same PENDING ->
+  CONFIRMED/FAILED compare-and-set the callbacks use, so whichever
+  arrives first wins and the other is a no-op.
+
+With the SQLite store one worker polls (``flock`` election, as in
+payment_expiry.py); every worker can still ``verify``.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Optional
+
+import config
+import metrics
+from payment_store import QUEUED, PENDING, CONFIRMED, CONFIRMABLE, FAILED, PaymentStore
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# A provider's answer: ``status`` is CONFIRMED or FAILED once final, None
+# while the payment is still open (or the provider could not be asked)
+Verdict = namedtuple("Verdict", "status fields")
+
+OPEN = Verdict(None, {})
+
+# Payment field holding each provider's reference
+REFERENCE_FIELDS = {"daraja": "checkout_id", "flutterwave": "tx_ref"}
+
+
+def daraja_verdict(result: Optional[dict]) -> Verdict:
+    """Verdict for an ``mpesa.stk_query`` result."""
+    if result is None:
+        return OPEN
+    fields = {"result_code": result["result_code"], "result_desc": result["result_desc"]}
+    if result["result_code"] == 0:
+        fields["confirmed_at"] = datetime.now().isoformat()
+        return Verdict(CONFIRMED, fields)
+    return Verdict(FAILED, fields)
+
+
+def flutterwave_verdict(status: Optional[str]) -> Verdict:
+    """Verdict for a ``flutterwave_pay.query_status`` result."""
+    if status == "successful":
+        return Verdict(CONFIRMED, {"flw_status": status, "confirmed_at": datetime.now().isoformat()})
+    if status == "failed":
+        return Verdict(FAILED, {"flw_status": status})
+    return OPEN
+
+
+class _Call:
+    __slots__ = ("done", "verdict")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.verdict = OPEN
+
+
+class StatusCache:
+    """TTL cache of provider verdicts with single-flight lookups.
+
+    Entries live in an LRU-ordered dict capped at ``max_entries``.
+    """
+
+    def __init__(self, ttl: float = 3600.0, negative_ttl: float = 5.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "joined": 0, "errors": 0}
+
+    def _cached(self, key) -> Optional[Verdict]:
+        # caller holds self._lock
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.counts["hits"] += 1
+            return entry[0]
+        return None
+
+    def _failed(self, key, error: Exception) -> Verdict:
+        logger.warning("Status lookup %s failed: %s", key, error)
+        with self._lock:
+            self.counts["errors"] += 1
+        return Verdict(None, {"error": str(error)})
+
+    def _remember(self, key, verdict: Verdict) -> None:
+        # caller holds self._lock
+        ttl = self.ttl if verdict.status else self.negative_ttl
+        self._entries[key] = (verdict, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def lookup(self, key, fetch: Callable[[], Verdict]) -> Verdict:
+        """Cached verdict for ``key``, calling ``fetch()`` at most once per expiry."""
+        with self._lock:
+            cached = self._cached(key)
+            if cached is not None:
+                return cached
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.counts["misses"] += 1
+            else:
+                self.counts["joined"] += 1
+        if not leader:
+            call.done.wait()
+            return call.verdict
+        try:
+            verdict = fetch()
+        except Exception as e:
+            verdict = self._failed(key, e)
+        with self._lock:
+            self._remember(key, verdict)
+            del self._calls[key]
+        call.verdict = verdict
+        call.done.set()
+        return verdict
+
+    async def lookup_async(self, key, fetch: Callable[[], "asyncio.Future"]) -> Verdict:
+        """``lookup`` for coroutines: ``fetch()`` returns an awaitable.
+
+        Concurrent lookups on one event loop share an ``asyncio`` future
+        instead of blocking the loop on a thread event.
+        """
+        import asyncio  # not at module level: sync workers never need it
+
+        with self._lock:
+            cached = self._cached(key)
+            if cached is not None:
+                return cached
+            call = self._async_calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._async_calls[key] = asyncio.get_running_loop().create_future()
+                self.counts["misses"] += 1
+            else:
+                self.counts["joined"] += 1
+        if not leader:
+            return await asyncio.shield(call)
+        try:
+            verdict = await fetch()
+        except asyncio.CancelledError:
+            # a cancelled leader must not strand the joiners
+            with self._lock:
+                del self._async_calls[key]
+            call.cancel()
+            raise
+        except Exception as e:
+            verdict = self._failed(key, e)
+        with self._lock:
+            self._remember(key, verdict)
+            del self._async_calls[key]
+        call.set_result(verdict)
+        return verdict
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.counts["hits"], self.counts["misses"]
+            return dict(self.counts, size=len(self._entries),
+                        hit_ratio=round(hits / (hits + misses), 3) if hits + misses else 0)
+
+
+class Reconciler:
+    """Settles payments from provider status queries.
+
+    ``providers`` maps a provider name (see ``REFERENCE_FIELDS``) to
+    ``query(reference) -> Verdict``; ``async_providers`` likewise to a
+    coroutine function, for ``verify_async``.
+    """
+
+    def __init__(self, store: PaymentStore, providers: dict, cache: Optional[StatusCache] = None,
+                 async_providers: Optional[dict] = None,
+                 batch_size: int = 20, concurrency: int = 4, first_poll: float = 15.0, backoff: float = 2.0,
+                 max_interval: float = 120.0, sweep_interval: float = 30.0, lock_path: Optional[str] = None):
+        self.store = store
+        self.providers = providers
+        self.async_providers = async_providers or {}
+        self.cache = cache or StatusCache()
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.first_poll = first_poll
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.sweep_interval = sweep_interval
+        self.lock_path = lock_path
+        self._hooks = []
+        self._heap = []
+        self._scheduled = set()
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._lock_file = None
+        self._leading = False
+        self._closed = False
+        self.counts = {}
+        store.add_listener(self._on_change)
+
+    def on_settled(self, fn: Callable[[dict], None]) -> Callable[[dict], None]:
+        """Register ``fn(payment)`` to run after a query confirms or fails a payment."""
+        self._hooks.append(fn)
+        return fn
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    @staticmethod
+    def _reference(record: dict) -> Optional[tuple]:
+        for provider, field in REFERENCE_FIELDS.items():
+            if record.get(field):
+                return provider, record[field]
+        return None
+
+    def verify(self, provider: str, reference: str) -> Verdict:
+        """Provider's verdict for ``reference``; final states are applied to the store."""
+        query = self.providers[provider]
+        verdict = self.cache.lookup((provider, reference), lambda: query(reference))
+        if verdict.status:
+            self._settle(provider, reference, verdict)
+        return verdict
+
+    async def verify_async(self, provider: str, reference: str) -> Verdict:
+        """``verify`` without blocking the event loop on the provider call or the store write."""
+        import asyncio
+
+        query = self.async_providers[provider]
+        verdict = await self.cache.lookup_async((provider, reference), lambda: query(reference))
+        if verdict.status:
+            # a contended SQLite write can wait seconds for its lock
+            await asyncio.to_thread(self._settle, provider, reference, verdict)
+        return verdict
+
+    def _settle(self, provider: str, reference: str, verdict: Verdict) -> Optional[dict]:
+        payment_id = self.store.resolve(reference)
+        if payment_id is None:
+            self._count("unknown")
+            return None
+        from_statuses = CONFIRMABLE if verdict.status == CONFIRMED else (QUEUED, PENDING)
+        payment = self.store.transition(payment_id, verdict.status, from_statuses=from_statuses,
+                                        reconciled_by=provider, **verdict.fields)
+        if payment is None:
+            # settled already, by a callback or an earlier verify
+            return None
+        self._count(verdict.status.lower())
+        logger.info("Payment %s %s by %s status query", payment_id, verdict.status, provider)
+        for hook in self._hooks:
+            try:
+                hook(payment)
+            except Exception:
+                logger.exception("Settled hook %s failed for %s", getattr(hook, "__name__", hook), payment_id)
+        return payment
+
+    # -- background polling -------------------------------------------------
+
+    def _schedule(self, payment_id: str, due: float, interval: float) -> None:
+        # caller holds self._cond
+        if payment_id in self._scheduled:
+            return
+        self._scheduled.add(payment_id)
+        heapq.heappush(self._heap, (due, payment_id, interval))
+        if self._heap[0][1] == payment_id:
+            self._cond.notify()
+
+    def _on_change(self, record: dict) -> None:
+        if self._leading and record["status"] == PENDING and self._reference(record):
+            with self._cond:
+                self._schedule(record["payment_id"], time.time() + self.first_poll, self.first_poll)
+
+    def _seed(self) -> None:
+        records = [r for r in self.store.by_status(PENDING) if self._reference(r)]
+        with self._cond:
+            for record in records:
+                due = record.get("updated_at", record["created_at"]) + self.first_poll
+                self._schedule(record["payment_id"], due, self.first_poll)
+
+    def start(self) -> None:
+        """Start the poller thread in this process (idempotent, fork-aware)."""
+        if self._pid == os.getpid() or self._closed:
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._heap, self._scheduled = [], set()
+            self._leading = False
+        threading.Thread(target=self._run, name="payment-reconcile", daemon=True).start()
+
+    def _lead(self) -> bool:
+        if not self.lock_path or fcntl is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _run(self) -> None:
+        while not self._lead():
+            if self._closed:
+                return
+            time.sleep(self.sweep_interval)
+        self._leading = True
+        logger.info("Payment reconciliation running in pid %s", os.getpid())
+        next_sweep = 0.0
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="reconcile") as pool:
+            while not self._closed:
+                try:
+                    if time.time() >= next_sweep:
+                        self._seed()
+                        next_sweep = time.time() + self.sweep_interval
+                    while self.poll_due(pool=pool):
+                        pass
+                except Exception:
+                    logger.exception("Reconciliation pass failed")
+                with self._cond:
+                    wake = next_sweep
+                    if self._heap:
+                        wake = min(wake, self._heap[0][0])
+                    self._cond.wait(max(0.05, wake - time.time()))
+
+    def poll_due(self, now: Optional[float] = None, pool: Optional[ThreadPoolExecutor] = None) -> int:
+        """Query one batch of payments whose next poll is due; returns its size."""
+        now = time.time() if now is None else now
+        with self._cond:
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                _, payment_id, interval = heapq.heappop(self._heap)
+                self._scheduled.discard(payment_id)
+                due.append((payment_id, interval))
+        batch = []
+        for payment_id, interval in due:
+            record = self.store.get(payment_id)
+            reference = record and record["status"] == PENDING and self._reference(record)
+            if reference:
+                batch.append((payment_id, interval, reference))
+        if not batch:
+            return len(due)
+
+        def ask(item):
+            provider, reference = item[2]
+            return self.verify(provider, reference)
+
+        verdicts = list(pool.map(ask, batch) if pool is not None else map(ask, batch))
+        with self._cond:
+            for (payment_id, interval, _), verdict in zip(batch, verdicts):
+                if verdict.status is None:
+                    # still open (or the provider failed): ask again later
+                    interval = min(self.max_interval, interval * self.backoff)
+                    self._schedule(payment_id, time.time() + interval, interval)
+        self._count("polled", len(batch))
+        return len(due)
+
+    def stats(self) -> dict:
+        with self._cond:
+            scheduled = len(self._heap)
+        with self._lock:
+            counts = dict(self.counts)
+        return dict(counts, scheduled=scheduled, leader=self._leading, cache=self.cache.stats())
+
+    def close(self) -> None:
+        self._closed = True
+        with self._cond:
+            self._cond.notify_all()
+
+
+def create_reconciler(store: PaymentStore, stk_query: Optional[Callable[[str], Optional[dict]]] = None,
+                      stk_query_async: Optional[Callable] = None) -> Reconciler:
+    """Reconciler for ``store`` configured from ``config``; call ``start()`` in the worker.
+
+    ``stk_query`` / ``stk_query_async`` default to ``mpesa``'s; apps with
+    their own Daraja credentials pass theirs.
+    """
+    import flutterwave_pay
+    import mpesa
+
+    stk_query = stk_query or mpesa.stk_query
+    stk_query_async = stk_query_async or mpesa.stk_query_async
+
+    async def daraja_async(checkout_id):
+        return daraja_verdict(await stk_query_async(checkout_id))
+
+    async def flutterwave_async(tx_ref):
+        return flutterwave_verdict(await flutterwave_pay.query_status_async(tx_ref))
+
+    lock_path = None
+    if getattr(store, "path", None):
+        lock_path = store.path + ".reconcile.lock"
+    reconciler = Reconciler(
+        store,
+        {
+            "daraja": lambda checkout_id: daraja_verdict(stk_query(checkout_id)),
+            "flutterwave": lambda tx_ref: flutterwave_verdict(flutterwave_pay.query_status(tx_ref)),
+        },
+        async_providers={"daraja": daraja_async, "flutterwave": flutterwave_async},
+        cache=StatusCache(ttl=config.STATUS_CACHE_TTL, negative_ttl=config.STATUS_CACHE_NEGATIVE_TTL),
+        batch_size=config.RECONCILE_BATCH_SIZE,
+        concurrency=config.RECONCILE_CONCURRENCY,
+        first_poll=config.RECONCILE_FIRST_POLL,
+        max_interval=config.RECONCILE_MAX_INTERVAL,
+        sweep_interval=config.PAYMENT_SWEEP_INTERVAL,
+        lock_path=lock_path,
+    )
+    metrics.gauge_callback("reconcile_scheduled", "Pending payments waiting for a status query",
+                           lambda: len(reconciler._heap))
+    return reconciler
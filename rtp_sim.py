@@ -0,0 +1,212 @@
+"""Monte Carlo return-to-player and payout-liability simulator.
+
+Checks a prize table against the entry fee before it goes live:
+
+- return-to-player (RTP), house edge and per-play variance over any number
+  of plays, drawn in fixed-size NumPy chunks so memory stays flat at 10^9
+  plays
+- a day's traffic played many times over, giving drawdown percentiles for
+  the house and the risk of ruin for a starting float
+
+Two tables ship with ``game.py``: ``wheel`` (``PRIZES``/``WEIGHTS``, used by
+``get_random_prize``) and ``boxes`` (one pick among ``BOX_PRIZES``, the
+mystery-box game). Custom tables can be passed with ``--prizes``/``--weights``.
+
+NumPy is only needed here, not by the web apps: ``pip install numpy``.
+
+Usage::
+
+    python rtp_sim.py --table boxes --plays 200000000
+    python rtp_sim.py --prizes 0,20,50,100 --weights 50,25,15,10 --bankroll 5000
+"""
+import argparse
+import json
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import config
+import game
+
+DEFAULT_CHUNK = 1 << 20
+
+TABLES = {
+    "wheel": (game.PRIZES, game.WEIGHTS),
+    "boxes": (list(game.BOX_PRIZES), [1] * len(game.BOX_PRIZES)),
+}
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("rtp_sim needs NumPy: pip install numpy")
+
+
+class PrizeSampler:
+    """Vectorised draws from a weighted prize table.
+
+    Integer weights use a flat lookup table (one ``integers`` call and a
+    gather per chunk); anything else falls back to ``searchsorted`` on the
+    cumulative distribution.
+    """
+
+    def __init__(self, prizes, weights, rng=None):
+        _require_numpy()
+        if len(prizes) != len(weights) or not prizes:
+            raise ValueError("prizes and weights must be non-empty and the same length")
+        weights = np.asarray(weights, dtype=np.float64)
+        if (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError("weights must be non-negative with a positive sum")
+        self.prizes = np.asarray(prizes, dtype=np.int64)
+        self.probs = weights / weights.sum()
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self._lookup = None
+        if np.all(weights == np.round(weights)) and weights.sum() <= 1 << 16:
+            self._lookup = np.repeat(self.prizes, weights.astype(np.int64))
+        else:
+            self._cdf = np.cumsum(self.probs)
+            self._cdf[-1] = 1.0
+
+    def expected(self) -> tuple:
+        """Exact mean and variance of one payout."""
+        mean = float(np.dot(self.probs, self.prizes))
+        var = float(np.dot(self.probs, (self.prizes - mean) ** 2))
+        return mean, var
+
+    def draw(self, n: int):
+        if self._lookup is not None:
+            return self._lookup[self.rng.integers(0, len(self._lookup), size=n)]
+        return self.prizes[np.searchsorted(self._cdf, self.rng.random(n), side="right")]
+
+
+def simulate_rtp(sampler: PrizeSampler, entry_fee: int, plays: int, chunk: int = DEFAULT_CHUNK) -> dict:
+    """RTP, house edge and payout variance over ``plays`` independent plays."""
+    paid = 0
+    sum_sq = 0.0
+    hits = 0
+    remaining = plays
+    while remaining > 0:
+        n = min(chunk, remaining)
+        payouts = sampler.draw(n)
+        paid += int(payouts.sum())
+        sum_sq += float(np.dot(payouts, payouts))
+        hits += int(np.count_nonzero(payouts))
+        remaining -= n
+    mean = paid / plays
+    variance = sum_sq / plays - mean * mean
+    exp_mean, exp_var = sampler.expected()
+    return {
+        "plays": plays,
+        "collected": plays * entry_fee,
+        "paid_out": paid,
+        "rtp": mean / entry_fee,
+        "expected_rtp": exp_mean / entry_fee,
+        "house_edge": 1 - mean / entry_fee,
+        "hit_rate": hits / plays,
+        "payout_mean": mean,
+        "payout_variance": variance,
+        "expected_variance": exp_var,
+    }
+
+
+def simulate_days(sampler: PrizeSampler, entry_fee: int, plays_per_day: int, days: int,
+                  bankroll: float, chunk: int = DEFAULT_CHUNK, percentiles=(50, 90, 95, 99)) -> dict:
+    """Replay ``days`` days of ``plays_per_day`` plays each.
+
+    The house balance starts at ``bankroll``; a day is ruined if it ever
+    goes negative. Days are simulated side by side in blocks of at most
+    ``chunk`` draws, carrying running peak/trough per day between blocks.
+    """
+    drawdowns = np.empty(days, dtype=np.float64)
+    day_net = np.empty(days, dtype=np.float64)
+    troughs = np.empty(days, dtype=np.float64)
+    batch = max(1, min(days, chunk // max(1, min(plays_per_day, chunk))))
+    step = max(1, min(plays_per_day, chunk // batch))
+
+    for start in range(0, days, batch):
+        rows = min(batch, days - start)
+        balance = np.zeros(rows)
+        peak = np.zeros(rows)
+        worst_dd = np.zeros(rows)
+        trough = np.zeros(rows)
+        done = 0
+        while done < plays_per_day:
+            n = min(step, plays_per_day - done)
+            net = entry_fee - sampler.draw(rows * n).reshape(rows, n)
+            path = balance[:, None] + np.cumsum(net, axis=1)
+            running_peak = np.maximum(np.maximum.accumulate(path, axis=1), peak[:, None])
+            np.maximum(worst_dd, (running_peak - path).max(axis=1), out=worst_dd)
+            np.minimum(trough, path.min(axis=1), out=trough)
+            peak = running_peak[:, -1]
+            balance = path[:, -1]
+            done += n
+        drawdowns[start:start + rows] = worst_dd
+        day_net[start:start + rows] = balance
+        troughs[start:start + rows] = trough
+
+    return {
+        "days": days,
+        "plays_per_day": plays_per_day,
+        "bankroll": bankroll,
+        "day_net_mean": float(day_net.mean()),
+        "day_net_percentiles": {f"p{p}": float(v) for p, v in zip(percentiles, np.percentile(day_net, percentiles))},
+        "losing_days": float((day_net < 0).mean()),
+        "drawdown_percentiles": {f"p{p}": float(v) for p, v in zip(percentiles, np.percentile(drawdowns, percentiles))},
+        "max_drawdown": float(drawdowns.max()),
+        "risk_of_ruin": float((troughs < -bankroll).mean()),
+    }
+
+
+def run(prizes, weights, entry_fee: int, plays: int, plays_per_day: int, days: int,
+        bankroll: float, chunk: int = DEFAULT_CHUNK, seed=None) -> dict:
+    _require_numpy()
+    sampler = PrizeSampler(prizes, weights, rng=np.random.default_rng(seed))
+    started = time.perf_counter()
+    report = {"entry_fee": entry_fee, "prizes": list(prizes), "weights": list(weights), "chunk": chunk}
+    if plays:
+        report["rtp"] = simulate_rtp(sampler, entry_fee, plays, chunk)
+    if days and plays_per_day:
+        report["liability"] = simulate_days(sampler, entry_fee, plays_per_day, days, bankroll, chunk)
+    elapsed = time.perf_counter() - started
+    simulated = plays + plays_per_day * days
+    report["seconds"] = round(elapsed, 3)
+    report["plays_per_second"] = round(simulated / elapsed) if elapsed else None
+    return report
+
+
+def _number_list(value: str) -> list:
+    return [float(x) if "." in x else int(x) for x in value.split(",") if x.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--table", choices=sorted(TABLES), default="boxes", help="prize table from game.py")
+    parser.add_argument("--prizes", type=_number_list, help="comma-separated prizes (overrides --table)")
+    parser.add_argument("--weights", type=_number_list, help="comma-separated weights for --prizes")
+    parser.add_argument("--entry-fee", type=int, default=config.ENTRY_FEE)
+    parser.add_argument("--plays", type=int, default=10_000_000, help="independent plays for RTP")
+    parser.add_argument("--plays-per-day", type=int, default=2000, help="traffic for liability runs")
+    parser.add_argument("--days", type=int, default=10_000, help="simulated days (0 to skip)")
+    parser.add_argument("--bankroll", type=float, default=5000, help="house float at the start of a day")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK, help="draws per vectorised block")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    prizes, weights = TABLES[args.table]
+    if args.prizes:
+        prizes = args.prizes
+        weights = args.weights or [1] * len(prizes)
+    elif args.weights:
+        parser.error("--weights needs --prizes")
+    try:
+        report = run(prizes, weights, args.entry_fee, args.plays, args.plays_per_day, args.days,
+                     args.bankroll, chunk=args.chunk, seed=args.seed)
+    except (RuntimeError, ValueError) as e:
+        parser.exit(1, f"{e}\n")
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
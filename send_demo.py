@@ -1,8 +1,24 @@
-"""Small CLI to demo sending an SMS (real via Twilio if configured, else simulated)."""
-from sms import send_game_sms
+"""Small CLI to demo sending an SMS (real via Twilio if configured, else simulated).
+
+``python send_demo.py --bulk players.csv`` sends the game SMS to every phone
+in the first column of a CSV instead.
+"""
+import csv
+import sys
+
+from sms import send_bulk_sms, send_game_sms, summarize
+
+
+def bulk(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        phones = (row[0] for row in csv.reader(f) if row)
+        print("Results:", summarize(send_bulk_sms(phones)))
 
 
 def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--bulk':
+        bulk(sys.argv[2])
+        return
     phone = input("Enter phone number (e.g. +2547...): ").strip()
     choice = input("Send using Twilio if available? (y/N): ").strip().lower()
     use_twilio = True if choice == 'y' else False
@@ -1,19 +1,52 @@
-"""SMS helper with optional Twilio usage and a simulated fallback."""
-from typing import Optional
+"""SMS helper with optional Twilio usage and a simulated fallback.
+
+``send_game_sms`` sends one message. ``send_bulk_sms`` is for blasts to a
+player list: it streams phones from any iterable, drops invalid and repeat
+numbers, and sends through a thread pool paced to ``SMS_RATE`` messages per
+second, yielding one result per recipient.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, Optional
 import logging
-from config import ENTRY_FEE, TWILIO_SID, TWILIO_TOKEN, TWILIO_NUMBER, USE_TWILIO
+import os
+import threading
+import time
+from datetime import datetime
+import ledger
+import metrics
+import providers
+from phones import normalize_many, try_normalize
+from config import ENTRY_FEE, TWILIO_SID, TWILIO_TOKEN, TWILIO_NUMBER, USE_TWILIO, SMS_RATE, SMS_WORKERS
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-try:
-    from twilio.rest import Client
-except Exception:
-    Client = None
 
-_twilio_client = None
-if USE_TWILIO and Client:
-    _twilio_client = Client(TWILIO_SID, TWILIO_TOKEN)
+def _make_twilio_client():
+    # twilio.rest is slow to import; only load it once an SMS is sent
+    if not USE_TWILIO:
+        return None
+    try:
+        from twilio.rest import Client
+    except Exception:
+        logger.warning("Twilio is configured but the 'twilio' package could not be imported")
+        return None
+    return Client(TWILIO_SID, TWILIO_TOKEN)
+
+
+_twilio_client = providers.register("twilio", _make_twilio_client)
+
+GAME_SMS = f"⚡ OddsMtaani\nPay KES {ENTRY_FEE} to play.\nProceed after payment."
+
+# Per-recipient outcomes reported by ``send_bulk_sms``
+SENT = "sent"
+SIMULATED = "simulated"
+FAILED = "failed"
+INVALID = "invalid"
+DUPLICATE = "duplicate"
+
+# Simulated sends are written to the ledger in batches of this size
+SIMULATED_BATCH = 500
 
 
 def send_game_sms(phone: str, use_twilio: Optional[bool] = None) -> str:
@@ -22,19 +55,20 @@ def send_game_sms(phone: str, use_twilio: Optional[bool] = None) -> str:
     If `use_twilio` is True and Twilio is configured, attempt to send via
     Twilio. If Twilio is not available (or `use_twilio` is False), the
     function will simulate sending by printing and writing to
-    `simulated_sms.log`.
+    the ``simulated`` ledger.
 
     Returns the Twilio message SID if sent, or the string 'SIMULATED'.
     """
-    body = f"⚡ OddsMtaani\nPay KES {ENTRY_FEE} to play.\nProceed after payment."
+    body = GAME_SMS
+    phone = try_normalize(phone) or phone
 
     if use_twilio is None:
-        use_twilio = bool(_twilio_client)
+        use_twilio = bool(_twilio_client())
 
     if use_twilio:
-        if not _twilio_client:
+        if not _twilio_client():
             raise RuntimeError("Twilio client not initialized. Check credentials and install 'twilio'.")
-        msg = _twilio_client.messages.create(body=body, from_=TWILIO_NUMBER, to=phone)
+        msg = _twilio_send(phone, body)
         logger.info("Sent SMS via Twilio to %s (sid=%s)", phone, getattr(msg, 'sid', None))
         return getattr(msg, 'sid', 'UNKNOWN')
 
@@ -44,7 +78,116 @@ def send_game_sms(phone: str, use_twilio: Optional[bool] = None) -> str:
     print(f"To: {phone}")
     print(body)
     print("-------------------------")
-    with open("simulated_sms.log", "a", encoding="utf-8") as f:
-        f.write(f"To: {phone}\n{body}\n---\n")
+    ledger.get_ledger("simulated").append("sms_simulated", to=phone, body=body)
     return "SIMULATED"
 
+
+class _Pacer:
+    """Spaces calls at least ``1 / rate`` seconds apart across threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _unique_recipients(phones: Iterable) -> Iterator[tuple]:
+    """Yield ``(phone, None)`` for each new valid number, or ``(raw, outcome)``."""
+    seen = set()
+    for raw, phone in normalize_many(phones):
+        if phone is None:
+            yield raw, INVALID
+        elif phone in seen:
+            yield phone, DUPLICATE
+        else:
+            seen.add(phone)
+            yield phone, None
+
+
+@metrics.timed_call("twilio.sms")
+def _twilio_send(phone: str, body: str):
+    return _twilio_client().messages.create(body=body, from_=TWILIO_NUMBER, to=phone)
+
+
+def _send_twilio(phone: str, body: str, pacer: _Pacer) -> dict:
+    pacer.wait()
+    try:
+        msg = _twilio_send(phone, body)
+    except Exception as e:
+        logger.warning("SMS to %s failed: %s", phone, e)
+        return {"phone": phone, "status": FAILED, "error": str(e)}
+    return {"phone": phone, "status": SENT, "sid": getattr(msg, "sid", None)}
+
+
+def send_bulk_sms(phones: Iterable, body: Optional[str] = None, use_twilio: Optional[bool] = None,
+                  rate: float = SMS_RATE, workers: int = SMS_WORKERS) -> Iterator[dict]:
+    """Send ``body`` (default: the game SMS) to every distinct phone.
+
+    ``phones`` is consumed lazily, so a generator over a large CSV is fine;
+    at most ``2 * workers`` sends are outstanding at any time. Yields a dict
+    per input number with ``phone``, ``status`` (sent, simulated, failed,
+    invalid or duplicate) and ``sid``/``error`` where relevant. Results for
+    real sends arrive in completion order.
+
+    The simulated backend is not paced and writes the ``simulated`` ledger
+    in batches instead of printing each message.
+    """
+    body = body or GAME_SMS
+    if use_twilio is None:
+        use_twilio = bool(_twilio_client())
+    if use_twilio and not _twilio_client():
+        raise RuntimeError("Twilio client not initialized. Check credentials and install 'twilio'.")
+
+    if not use_twilio:
+        yield from _simulate_bulk(phones, body)
+        return
+
+    pacer = _Pacer(rate)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sms") as pool:
+        pending = set()
+        for phone, outcome in _unique_recipients(phones):
+            if outcome:
+                yield {"phone": phone, "status": outcome}
+                continue
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(_send_twilio, phone, body, pacer))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def _simulate_bulk(phones: Iterable, body: str) -> Iterator[dict]:
+    simulated = ledger.get_ledger("simulated")
+    batch = []
+    for phone, outcome in _unique_recipients(phones):
+        if outcome:
+            yield {"phone": phone, "status": outcome}
+            continue
+        batch.append({"ts": datetime.now().isoformat(), "event": "sms_simulated", "pid": os.getpid(), "to": phone, "body": body})
+        if len(batch) >= SIMULATED_BATCH:
+            simulated.append_many(batch)
+            batch = []
+        yield {"phone": phone, "status": SIMULATED, "sid": "SIMULATED"}
+    simulated.append_many(batch)
+
+
+def summarize(results: Iterable[dict]) -> dict:
+    """Count ``send_bulk_sms`` results by status."""
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return counts
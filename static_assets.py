@@ -0,0 +1,317 @@
+"""Build and serve the fingerprinted CSS/JS under ``assets/``.
+
+The player pages used to inline ~100-170 lines of CSS and JS each, resent on
+every view over mobile data. The sources now live in ``assets/css`` and
+``assets/js``; ``build()`` turns each into ``static/dist/<name>.<hash>.<ext>``:
+
+- minified (comments and layout whitespace removed; the JS minifier keeps
+  every line break and leaves strings, template literals and regex
+  literals untouched, so automatic semicolon insertion works as before)
+- named by content hash, so the files are served ``immutable`` for a year
+  and a changed file gets a new URL rather than a stale cache hit
+- with ``.gz`` (and ``.br`` when the ``brotli`` package is installed)
+  siblings next to it, so nothing is compressed per request
+
+``manifest.json`` maps source names to built files. Templates call
+``asset_url('css/theme.css')``; ``init_app(app)`` registers that helper and
+the ``/assets/<file>`` route, which picks the precompressed sibling the
+client accepts. Build at deploy time (``python static_assets.py``);
+``init_app`` also rebuilds when the manifest is missing or older than a
+source file.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+from typing import Optional
+
+from page_cache import accepts_encoding
+
+try:
+    import brotli
+except ImportError:  # optional: gzip siblings only
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(ROOT, "assets")
+OUTPUT_DIR = os.path.join(ROOT, "static", "dist")
+MANIFEST = "manifest.json"
+URL_PREFIX = "/assets"
+
+# Fingerprinted names never change content, so clients may keep them a year
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+_CSS_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+_CSS_SPACE = re.compile(r"\s*([{};,>])\s*")
+# innermost {...}: declarations, never selectors (those sit before a "{")
+_CSS_BLOCK = re.compile(r"\{[^{}]*\}")
+_CSS_COLON = re.compile(r":\s+")
+
+
+def minify_css(text: str) -> str:
+    text = _CSS_COMMENT.sub("", text)
+    text = " ".join(text.split())
+    text = _CSS_SPACE.sub(r"\1", text)
+    # "color: red" -> "color:red", but not in selectors ("a :hover" != "a:hover")
+    text = _CSS_BLOCK.sub(lambda m: _CSS_COLON.sub(":", m.group()), text)
+    return text.replace(";}", "}").strip()
+
+
+# a "/" after one of these (or at the start) begins a regex literal, not a division
+_JS_REGEX_AFTER = set("(,=:[!&|?{};+-*%<>~^")
+_JS_REGEX_KEYWORDS = re.compile(r"(?:^|[^\w$])(?:return|typeof|instanceof|in|of|new|delete|void|throw|case|do|else|yield|await)$")
+# trailing spaces, the line break, blank lines and the next line's indentation
+_JS_LAYOUT = re.compile(r"[ \t]*\n\s*")
+
+
+def _js_quoted_end(text: str, i: int) -> int:
+    """Index just past the '...' or "..." string starting at ``i``."""
+    quote, j = text[i], i + 1
+    while j < len(text):
+        if text[j] == "\\":
+            j += 2
+        elif text[j] == quote or text[j] == "\n":
+            return j + 1
+        else:
+            j += 1
+    return len(text)
+
+
+def _js_template_end(text: str, i: int) -> int:
+    """Index just past the template literal starting at ``i``, ``${...}`` included."""
+    j = i + 1
+    while j < len(text):
+        if text[j] == "\\":
+            j += 2
+        elif text[j] == "`":
+            return j + 1
+        elif text.startswith("${", j):
+            depth, j = 1, j + 2
+            while j < len(text) and depth:
+                if text[j] in "'\"":
+                    j = _js_quoted_end(text, j)
+                    continue
+                if text[j] == "`":
+                    j = _js_template_end(text, j)
+                    continue
+                depth += {"{": 1, "}": -1}.get(text[j], 0)
+                j += 1
+        else:
+            j += 1
+    return len(text)
+
+
+def _js_regex_end(text: str, i: int) -> int:
+    """Index just past the regex literal starting at ``i`` (flags included)."""
+    j, in_class = i + 1, False
+    while j < len(text) and text[j] != "\n":
+        if text[j] == "\\":
+            j += 2
+            continue
+        if text[j] == "[":
+            in_class = True
+        elif text[j] == "]":
+            in_class = False
+        elif text[j] == "/" and not in_class:
+            j += 1
+            while j < len(text) and (text[j].isalnum() or text[j] in "_$"):
+                j += 1
+            return j
+        j += 1
+    return j
+
+
+def minify_js(text: str) -> str:
+    out = []
+    code = []  # source between literals, laid out in one go by _JS_LAYOUT
+
+    def flush_code():
+        out.append(_JS_LAYOUT.sub("\n", "".join(code)))
+        code.clear()
+
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            continue
+        if text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            end = n if end < 0 else end + 2
+            # a comment spanning lines still separates them for ASI
+            code.append("\n" if "\n" in text[i:end] else " ")
+            i = end
+            continue
+        if c in "'\"`" or c == "/":
+            if c == "/":
+                before = "".join(code).rstrip() or "".join(out).rstrip()
+                if before and before[-1] not in _JS_REGEX_AFTER and not _JS_REGEX_KEYWORDS.search(before[-12:]):
+                    code.append(c)
+                    i += 1
+                    continue
+                end = _js_regex_end(text, i)
+            else:
+                end = _js_template_end(text, i) if c == "`" else _js_quoted_end(text, i)
+            flush_code()
+            out.append(text[i:end])
+            i = end
+            continue
+        code.append(c)
+        i += 1
+    flush_code()
+    return "".join(out).strip() + "\n"
+
+
+MINIFIERS = {".css": minify_css, ".js": minify_js}
+
+
+def _write(path: str, data: bytes) -> None:
+    # atomic: every gunicorn worker may build at start-up
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _sources(source_dir: str) -> list:
+    found = []
+    for dirpath, _, filenames in os.walk(source_dir):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] in MINIFIERS:
+                found.append(os.path.relpath(os.path.join(dirpath, filename), source_dir).replace(os.sep, "/"))
+    return sorted(found)
+
+
+def build(source_dir: str = SOURCE_DIR, output_dir: str = OUTPUT_DIR) -> dict:
+    """Minify, fingerprint and precompress every asset; returns the manifest."""
+    manifest = {}
+    for name in _sources(source_dir):
+        stem, ext = os.path.splitext(name)
+        with open(os.path.join(source_dir, name), encoding="utf-8") as f:
+            data = MINIFIERS[ext](f.read()).encode("utf-8")
+        built = f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+        path = os.path.join(output_dir, built)
+        if not os.path.exists(path):
+            _write(path, data)
+            _write(path + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                _write(path + ".br", brotli.compress(data, quality=11))
+        manifest[name] = built
+    _write(os.path.join(output_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def clean(output_dir: str = OUTPUT_DIR, keep: Optional[dict] = None) -> int:
+    """Delete built files not in the manifest (older builds); returns how many."""
+    keep = set(keep.values()) if keep is not None else set(load_manifest(output_dir).values())
+    removed = 0
+    for dirpath, _, filenames in os.walk(output_dir):
+        for filename in filenames:
+            rel = os.path.relpath(os.path.join(dirpath, filename), output_dir).replace(os.sep, "/")
+            base = re.sub(r"\.(gz|br)$", "", rel)
+            if rel != MANIFEST and base not in keep:
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+    return removed
+
+
+def load_manifest(output_dir: str = OUTPUT_DIR) -> dict:
+    try:
+        with open(os.path.join(output_dir, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _stale(source_dir: str, output_dir: str) -> bool:
+    try:
+        built = os.path.getmtime(os.path.join(output_dir, MANIFEST))
+    except OSError:
+        return True
+    return any(os.path.getmtime(os.path.join(source_dir, name)) > built for name in _sources(source_dir))
+
+
+def choose_file(filename: str, accept_encoding: str, output_dir: str = OUTPUT_DIR):
+    """(path, content_encoding) of the best built variant of ``filename``."""
+    path = os.path.join(output_dir, filename)
+    for coding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if accepts_encoding(accept_encoding, coding) and os.path.exists(path + suffix):
+            return path + suffix, coding
+    return path, None
+
+
+def init_app(app, source_dir: str = SOURCE_DIR, output_dir: str = OUTPUT_DIR) -> None:
+    """Register ``asset_url`` for templates and the ``/assets/<file>`` route on a Flask or Quart ``app``."""
+    if os.path.isdir(source_dir) and _stale(source_dir, output_dir):
+        logger.info("Building static assets into %s", output_dir)
+        build(source_dir, output_dir)
+    manifest = load_manifest(output_dir)
+    built_files = set(manifest.values())
+
+    def asset_url(name: str) -> str:
+        built = manifest.get(name)
+        if built is None:
+            raise KeyError(f"Unknown asset {name!r}; run python static_assets.py")
+        return f"{URL_PREFIX}/{built}"
+
+    app.jinja_env.globals["asset_url"] = asset_url
+    quart = type(app).__module__.startswith("quart")
+
+    def headers(coding: Optional[str]) -> dict:
+        result = {"Cache-Control": IMMUTABLE, "Vary": "Accept-Encoding"}
+        if coding:
+            result["Content-Encoding"] = coding
+        return result
+
+    if quart:
+        from quart import abort, request, send_file
+
+        async def serve_asset(filename):
+            if filename not in built_files:
+                abort(404)
+            path, coding = choose_file(filename, request.headers.get("Accept-Encoding"), output_dir)
+            response = await send_file(path, mimetype=mimetypes.guess_type(filename)[0])
+            response.headers.update(headers(coding))
+            return response
+    else:
+        from flask import abort, request, send_file
+
+        def serve_asset(filename):
+            if filename not in built_files:
+                abort(404)
+            path, coding = choose_file(filename, request.headers.get("Accept-Encoding"), output_dir)
+            response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+            response.headers.update(headers(coding))
+            return response
+
+    app.add_url_rule(f"{URL_PREFIX}/<path:filename>", "static_asset", serve_asset)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Minify, fingerprint and precompress assets/ into static/dist/")
+    parser.add_argument("--clean", action="store_true", help="delete files from earlier builds")
+    args = parser.parse_args(argv)
+    manifest = build()
+    for name, built in sorted(manifest.items()):
+        path = os.path.join(OUTPUT_DIR, built)
+        source = os.path.getsize(os.path.join(SOURCE_DIR, name))
+        sizes = [f"{os.path.getsize(path)} B"]
+        for suffix in (".gz", ".br"):
+            if os.path.exists(path + suffix):
+                sizes.append(f"{suffix[1:]} {os.path.getsize(path + suffix)} B")
+        print(f"{name:<28} {source:>6} B -> {built}  ({', '.join(sizes)})")
+    if args.clean:
+        print(f"Removed {clean(keep=manifest)} files from earlier builds")
+
+
+if __name__ == "__main__":
+    main()
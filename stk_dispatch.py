@@ -0,0 +1,160 @@
+"""Background dispatch queue for upstream payment requests.
+
+An STK push means a token fetch plus a POST to Daraja, which can hold a
+gunicorn thread for up to ~25s. ``/pay`` instead submits the work here and
+returns a reference straight away; the client then polls for the outcome.
+
+- the queue is bounded: ``submit`` raises ``queue.Full`` when it is full so
+  the route can answer 503 instead of piling up work (backpressure)
+- each job key has its own in-flight limit, independent of the worker
+  count. STK jobs share the ``stk`` key: payment_router picks Daraja or
+  Flutterwave inside the job, and a job calls one provider at a time
+  (hedged calls run on the router's own small pool), so the one limit
+  caps the calls in flight to each provider too
+- ``shutdown`` stops accepting jobs and drains what is already queued
+"""
+import atexit
+import logging
+import queue
+import threading
+from typing import Callable, Optional
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class DispatchQueue:
+    """Bounded job queue served by a fixed pool of worker threads."""
+
+    def __init__(self, workers: int = 4, max_queue: int = 100, max_in_flight: Optional[dict] = None, default_in_flight: int = 4):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.default_in_flight = default_in_flight
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._limits = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._closed = False
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        for provider, limit in (max_in_flight or {}).items():
+            self._limits[provider] = threading.BoundedSemaphore(limit)
+
+    def _limit(self, provider: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._limits.get(provider)
+            if sem is None:
+                sem = self._limits[provider] = threading.BoundedSemaphore(self.default_in_flight)
+            return sem
+
+    def _start(self) -> None:
+        # Threads are started on first use so they are created in the
+        # gunicorn worker, not in a parent that later forks.
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"dispatch-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, provider: str, fn: Callable, *args, **kwargs) -> None:
+        """Queue ``fn(*args, **kwargs)`` to run against ``provider``.
+
+        Raises ``queue.Full`` if the queue is at capacity and
+        ``RuntimeError`` after ``shutdown``.
+        """
+        if self._closed:
+            raise RuntimeError("Dispatch queue is shut down")
+        self._start()
+        try:
+            self._queue.put_nowait((provider, fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise
+        with self._lock:
+            self.submitted += 1
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                provider, fn, args, kwargs = job
+                sem = self._limit(provider)
+                with sem:
+                    with self._lock:
+                        self._in_flight[provider] = self._in_flight.get(provider, 0) + 1
+                    try:
+                        fn(*args, **kwargs)
+                        ok = True
+                    except Exception:
+                        logger.exception("Dispatch job for %s failed", provider)
+                        ok = False
+                    finally:
+                        with self._lock:
+                            self._in_flight[provider] -= 1
+                with self._lock:
+                    if ok:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self.max_queue,
+                "workers": len(self._threads),
+                "in_flight": dict(self._in_flight),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+    def shutdown(self, timeout: Optional[float] = 30.0) -> None:
+        """Stop accepting jobs, let queued ones finish, then stop workers."""
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            threads = list(self._threads)
+        for _ in threads:
+            # blocking put: stop markers queue up behind real jobs
+            self._queue.put(_STOP)
+        for t in threads:
+            t.join(timeout)
+        logger.info("Dispatch queue drained: %s", self.stats())
+
+
+def register_metrics(dispatcher: DispatchQueue, name: str) -> None:
+    """Export ``dispatcher``'s queue depth and in-flight jobs as ``queue=name``."""
+    metrics.gauge_callback("dispatch_queue_depth", "Jobs waiting in a dispatch queue",
+                           lambda: {name: dispatcher.stats()["queue_depth"]}, ("queue",))
+    metrics.gauge_callback("dispatch_in_flight", "Dispatch jobs running per provider",
+                           lambda: {(name, p): n for p, n in dispatcher.stats()["in_flight"].items()},
+                           ("queue", "provider"))
+
+
+def create_dispatcher(name: str = "stk") -> DispatchQueue:
+    """Build a queue from ``config`` and drain it when the process exits."""
+    dispatcher = DispatchQueue(
+        workers=config.DISPATCH_WORKERS,
+        max_queue=config.DISPATCH_MAX_QUEUE,
+        max_in_flight={"stk": config.DISPATCH_MAX_IN_FLIGHT},
+    )
+    register_metrics(dispatcher, name)
+    atexit.register(dispatcher.shutdown)
+    return dispatcher